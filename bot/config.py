@@ -11,7 +11,7 @@ BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 
 # Admin Access
 ADMIN_IDS_STR = os.getenv("ADMIN_IDS", "")
-ADMIN_IDS = [int(x.strip()) for x in ADMIN_IDS_STR.split(",") if x.strip()]
+ADMIN_IDS = frozenset(int(x.strip()) for x in ADMIN_IDS_STR.split(",") if x.strip())
 
 # Database
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///nebular_cassini_v2.db")
@@ -21,3 +21,8 @@ DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
 
 # Phase Mastery Thresholds
 PHASE_UNLOCK_THRESHOLD = 80.0  # 80% accuracy required to unlock next phase
+
+# Review Queue
+# When enabled, wrong/skipped answers are written to the review queue in one batch at the
+# quiz summary instead of on every tap (faster answers; a quiz abandoned mid-way records none)
+DEFER_REVIEW_QUEUE = os.getenv("DEFER_REVIEW_QUEUE", "false").lower() == "true"
@@ -1,36 +1,54 @@
 """
 CRUD operations for Nebular Cassini Bot
 """
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import and_, or_, func, insert, select, text, tuple_
 from datetime import datetime, timedelta
 from typing import Optional, List
+from contextvars import ContextVar
 import json
 import time
 
-from .models import User, Progress, Session as SessionModel, FlaggedQuestion, ReviewQueue, Challenge
-from .db import SessionLocal
+from .models import User, Progress, Session as SessionModel, FlaggedQuestion, ReviewQueue, Challenge, SystemLock
+from .db import SessionLocal, engine
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 from config import PHASE_UNLOCK_THRESHOLD
+from utils.json_codec import dumps as json_dumps
 
 
 # ==================== USER OPERATIONS ====================
+# Read helpers used while rendering accept an optional db session: when given, they run on it
+# and leave closing to the caller (one session per screen render).
 
-def get_or_create_user(telegram_id: int, username: Optional[str], full_name: str) -> User:
-    """Get existing user or create new one"""
-    db = SessionLocal()
+# User row loaded once per Telegram update by the callback router (set/reset in route_callback)
+REQUEST_USER = ContextVar("request_user", default=None)
+
+
+def get_or_create_user(telegram_id: int, username: Optional[str], full_name: str, db: Optional[Session] = None, with_progress: bool = False) -> User:
+    """
+    Get existing user or create new one.
+    with_progress=True also loads user.progress_records in the same SELECT (joined eager load),
+    which gives the screen renderer its user and progress context in one round trip.
+    """
+    own_db = db is None
+    if own_db:
+        db = SessionLocal()
     try:
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
+        query = db.query(User)
+        if with_progress:
+            query = query.options(joinedload(User.progress_records))
+        user = query.filter(User.telegram_id == telegram_id).first()
         if user:
-            # Update username/name if changed
+            # Update username/name if changed (commit only then, so eager-loaded progress isn't expired)
             if username and user.username != username:
                 user.username = username
             if full_name and full_name != "User" and user.full_name != full_name:
                 user.full_name = full_name
-            db.commit()
-            db.refresh(user)
+            if db.dirty:
+                db.commit()
+                db.refresh(user)
             return user
         
         # Create new user
@@ -50,7 +68,16 @@ def get_or_create_user(telegram_id: int, username: Optional[str], full_name: str
         db.refresh(user)
         return user
     finally:
-        db.close()
+        if own_db:
+            db.close()
+
+
+def get_request_user(telegram_id: int) -> User:
+    """User already loaded for the current update, falling back to get_or_create_user"""
+    user = REQUEST_USER.get()
+    if user is not None and user.telegram_id == telegram_id:
+        return user
+    return get_or_create_user(telegram_id, None, "User")
 
 
 def update_user_streak(user_id: int) -> int:
@@ -84,6 +111,27 @@ def update_user_streak(user_id: int) -> int:
         db.close()
 
 
+def _apply_xp(user: User, xp_amount: int):
+    """Adds XP to a loaded user row (weekly reset + level recalculation), no commit."""
+    # Check if we need to reset weekly XP (Monday 00:00 UTC)
+    now = datetime.utcnow()
+    if user.week_start_date:
+        days_since_start = (now - user.week_start_date).days
+        # If it's been 7+ days, reset weekly XP
+        if days_since_start >= 7:
+            user.weekly_xp = 0
+            user.week_start_date = now
+    else:
+        # Initialize week_start_date if not set
+        user.week_start_date = now
+    
+    user.total_xp += xp_amount
+    user.weekly_xp += xp_amount
+    
+    # Calculate level (simple formula: level = sqrt(XP / 100))
+    user.level = int((user.total_xp / 100) ** 0.5) + 1
+
+
 def add_xp(user_id: int, xp_amount: int) -> int:
     """Add XP to user and recalculate level. Returns new total XP."""
     db = SessionLocal()
@@ -92,23 +140,7 @@ def add_xp(user_id: int, xp_amount: int) -> int:
         if not user:
             return 0
         
-        # Check if we need to reset weekly XP (Monday 00:00 UTC)
-        now = datetime.utcnow()
-        if user.week_start_date:
-            days_since_start = (now - user.week_start_date).days
-            # If it's been 7+ days, reset weekly XP
-            if days_since_start >= 7:
-                user.weekly_xp = 0
-                user.week_start_date = now
-        else:
-            # Initialize week_start_date if not set
-            user.week_start_date = now
-        
-        user.total_xp += xp_amount
-        user.weekly_xp += xp_amount
-        
-        # Calculate level (simple formula: level = sqrt(XP / 100))
-        user.level = int((user.total_xp / 100) ** 0.5) + 1
+        _apply_xp(user, xp_amount)
         
         db.commit()
         db.refresh(user)
@@ -135,6 +167,37 @@ def get_weekly_leaderboard(limit: int = 10) -> List[User]:
         db.close()
 
 
+def get_leaderboard_with_rank(user_id: int, scope: str = "Global", limit: int = 10, db: Optional[Session] = None) -> tuple:
+    """
+    Top users plus the given user's rank in one query (window functions over a subquery).
+    scope "Weekly" ranks by weekly_xp, anything else by total_xp.
+    Returns (top_users, user_rank); rank counts users with strictly more XP, so ties share it.
+    """
+    xp_col = User.weekly_xp if scope == "Weekly" else User.total_xp
+    ranked = select(
+        User.id.label("uid"),
+        func.rank().over(order_by=xp_col.desc()).label("rk"),
+        func.row_number().over(order_by=xp_col.desc()).label("rn")
+    ).subquery()
+    
+    own_db = db is None
+    if own_db:
+        db = SessionLocal()
+    try:
+        rows = db.query(User, ranked.c.rk, ranked.c.rn).join(
+            ranked, User.id == ranked.c.uid
+        ).filter(
+            or_(ranked.c.rn <= limit, User.id == user_id)
+        ).order_by(ranked.c.rn).all()
+        
+        top_users = [u for u, _, rn in rows if rn <= limit]
+        user_rank = next((rk for u, rk, _ in rows if u.id == user_id), None)
+        return top_users, user_rank
+    finally:
+        if own_db:
+            db.close()
+
+
 # ==================== PROGRESS OPERATIONS ====================
 
 def get_user_progress(user_id: int, unit_id: str) -> Optional[Progress]:
@@ -204,6 +267,40 @@ def update_phase_progress(
         db.close()
 
 
+def _record_attempt(db: Session, user_id: int, unit_id: str, subject: str, grade: int, correct: bool) -> Progress:
+    """Adds one attempt to the unit's progress row (created if missing), no commit."""
+    progress = db.query(Progress).filter(
+        and_(Progress.user_id == user_id, Progress.unit_id == unit_id)
+    ).first()
+    
+    if not progress:
+        progress = Progress(
+            user_id=user_id,
+            unit_id=unit_id,
+            subject=subject,
+            grade=grade,
+            questions_attempted=0,
+            questions_correct=0,
+            completion_percent=0.0
+        )
+        db.add(progress)
+    
+    progress.questions_attempted += 1
+    if correct:
+        progress.questions_correct += 1
+    
+    # Recalculate completion percentage
+    if progress.questions_attempted > 0:
+        progress.completion_percent = (
+            progress.questions_correct / progress.questions_attempted
+        ) * 100
+        # Ensure 0% is not treated as non-existent in UI logic if attempts > 0
+        if progress.completion_percent == 0 and progress.questions_attempted > 0:
+             # It's technically 0%, but the record exists so it won't be "Not Started"
+             pass
+    return progress
+
+
 def record_quiz_attempt(
     user_id: int,
     unit_id: str,
@@ -214,36 +311,7 @@ def record_quiz_attempt(
     """Record a single question attempt"""
     db = SessionLocal()
     try:
-        progress = db.query(Progress).filter(
-            and_(Progress.user_id == user_id, Progress.unit_id == unit_id)
-        ).first()
-        
-        if not progress:
-            progress = Progress(
-                user_id=user_id,
-                unit_id=unit_id,
-                subject=subject,
-                grade=grade,
-                questions_attempted=0,
-                questions_correct=0,
-                completion_percent=0.0
-            )
-            db.add(progress)
-        
-        progress.questions_attempted += 1
-        if correct:
-            progress.questions_correct += 1
-        
-        # Recalculate completion percentage
-        if progress.questions_attempted > 0:
-            progress.completion_percent = (
-                progress.questions_correct / progress.questions_attempted
-            ) * 100
-            # Ensure 0% is not treated as non-existent in UI logic if attempts > 0
-            if progress.completion_percent == 0 and progress.questions_attempted > 0:
-                 # It's technically 0%, but the record exists so it won't be "Not Started"
-                 pass
-        
+        progress = _record_attempt(db, user_id, unit_id, subject, grade, correct)
         db.commit()
         db.refresh(progress)
         return progress
@@ -251,20 +319,63 @@ def record_quiz_attempt(
         db.close()
 
 
-def get_all_user_progress(user_id: int) -> List[Progress]:
+def get_all_user_progress(user_id: int, db: Optional[Session] = None) -> List[Progress]:
     """Get all progress records for a user"""
-    db = SessionLocal()
+    own_db = db is None
+    if own_db:
+        db = SessionLocal()
     try:
         return db.query(Progress).filter(Progress.user_id == user_id).all()
     finally:
-        db.close()
+        if own_db:
+            db.close()
+
+
+# Per-subject ranking {subject: (loaded_at, {user_id: rank})}, rebuilt after SUBJECT_RANK_TTL seconds
+SUBJECT_RANK_TTL = 60
+_subject_rank_cache = {}
+
+
+def get_subject_rank_map(subject: str, db: Optional[Session] = None) -> dict:
+    """
+    Maps user_id -> position by total correct answers in the subject (1 = best).
+    Users without progress in the subject are absent. Cached for SUBJECT_RANK_TTL seconds.
+    """
+    cached = _subject_rank_cache.get(subject)
+    if cached and time.monotonic() - cached[0] < SUBJECT_RANK_TTL:
+        return cached[1]
+    
+    own_db = db is None
+    if own_db:
+        db = SessionLocal()
+    try:
+        rows = db.query(Progress.user_id).filter(
+            Progress.subject == subject
+        ).group_by(Progress.user_id).order_by(func.sum(Progress.questions_correct).desc()).all()
+    finally:
+        if own_db:
+            db.close()
+    
+    rank_map = {uid: i + 1 for i, (uid,) in enumerate(rows)}
+    _subject_rank_cache[subject] = (time.monotonic(), rank_map)
+    return rank_map
+
+
+def invalidate_subject_ranks(subject: Optional[str] = None):
+    """Drops the cached ranking for one subject (or all) so the next lookup rebuilds it."""
+    if subject is None:
+        _subject_rank_cache.clear()
+    else:
+        _subject_rank_cache.pop(subject, None)
 
 
 # ==================== SESSION OPERATIONS ====================
 
-def get_or_create_session(user_id: int) -> SessionModel:
+def get_or_create_session(user_id: int, db: Optional[Session] = None) -> SessionModel:
     """Get or create session for user"""
-    db = SessionLocal()
+    own_db = db is None
+    if own_db:
+        db = SessionLocal()
     try:
         session = db.query(SessionModel).filter(SessionModel.user_id == user_id).first()
         if session:
@@ -281,7 +392,8 @@ def get_or_create_session(user_id: int) -> SessionModel:
         db.refresh(session)
         return session
     finally:
-        db.close()
+        if own_db:
+            db.close()
 
 
 def update_session_state(
@@ -290,7 +402,9 @@ def update_session_state(
     current_param: Optional[str] = None,
     message_id: Optional[int] = None,
     quiz_state: Optional[dict] = None,
-    add_to_nav_stack: bool = False
+    add_to_nav_stack: bool = False,
+    clear_nav_stack: bool = False,
+    quiz_questions: Optional[list] = None
 ) -> SessionModel:
     """Update session state"""
     db = SessionLocal()
@@ -300,6 +414,9 @@ def update_session_state(
             session = SessionModel(user_id=user_id)
             db.add(session)
         
+        if clear_nav_stack:
+            session.navigation_stack = "[]"
+        
         if screen:
             # Update navigation stack if requested
             if add_to_nav_stack and session.current_screen != screen:
@@ -318,7 +435,10 @@ def update_session_state(
             session.last_message_id = message_id
         
         if quiz_state is not None:
-            session.quiz_state = json.dumps(quiz_state)
+            session.quiz_state = json_dumps(quiz_state)
+        
+        if quiz_questions is not None:
+            session.quiz_questions = json_dumps(quiz_questions)
         
         session.updated_at = datetime.utcnow()
         
@@ -329,6 +449,38 @@ def update_session_state(
         db.close()
 
 
+# Server-side "current_index + 1" on the JSON text in sessions.quiz_state, per dialect
+_INCREMENT_INDEX_SQL = {
+    "sqlite": "json_set(quiz_state, '$.current_index', json_extract(quiz_state, '$.current_index') + 1)",
+    "postgresql": "jsonb_set(quiz_state::jsonb, '{current_index}', to_jsonb((quiz_state::jsonb->>'current_index')::int + 1))::text",
+}
+
+
+def increment_quiz_index(user_id: int) -> Optional[datetime]:
+    """
+    Advances quiz_state.current_index by one in a single UPDATE, without reading and
+    re-serializing the whole state. Returns the new updated_at, or None if nothing was
+    updated (no active quiz, or a database without JSON functions - caller saves normally).
+    """
+    db = SessionLocal()
+    try:
+        expr = _INCREMENT_INDEX_SQL.get(db.get_bind().dialect.name)
+        if not expr:
+            return None
+        now = datetime.utcnow()
+        updated = db.query(SessionModel).filter(
+            SessionModel.user_id == user_id,
+            SessionModel.quiz_state.isnot(None)
+        ).update(
+            {SessionModel.quiz_state: text(expr), SessionModel.updated_at: now},
+            synchronize_session=False
+        )
+        db.commit()
+        return now if updated else None
+    finally:
+        db.close()
+
+
 def pop_navigation_stack(user_id: int) -> Optional[tuple]:
     """Pop last screen from navigation stack. Returns (screen, param) or None."""
     db = SessionLocal()
@@ -398,8 +550,100 @@ def get_flagged_questions(min_flags: int = 1) -> List[FlaggedQuestion]:
         db.close()
 
 
+# ==================== SYSTEM LOCK OPERATIONS ====================
+
+# Active SystemLock targets by lock_type, reloaded at most every LOCK_CACHE_TTL seconds.
+# Locks change rarely; the admin toggles call invalidate_lock_cache() so they apply at once.
+LOCK_CACHE_TTL = 60
+_lock_cache = {"loaded_at": 0.0, "locks": {}, "units": {}}
+# Core statement (compiled once and reused by SQLAlchemy's statement cache), run without an ORM session
+_ACTIVE_LOCKS_SQL = select(SystemLock.lock_type, SystemLock.lock_target).where(SystemLock.is_locked == True)
+
+
+def get_active_locks() -> dict:
+    """Returns {lock_type: set(lock_target)} for every active lock."""
+    now = time.monotonic()
+    if now - _lock_cache["loaded_at"] >= LOCK_CACHE_TTL:
+        with engine.connect() as conn:
+            rows = conn.execute(_ACTIVE_LOCKS_SQL).all()
+        locks = {}
+        for lock_type, target in rows:
+            locks.setdefault(lock_type, set()).add(target)
+        _lock_cache.update(loaded_at=now, locks=locks, units={})
+    return _lock_cache["locks"]
+
+
+def get_locked_units(sub_code: str, grade) -> set:
+    """Locked unit ids (e.g. "BIO_G12_U1") for one subject code and grade number, from the lock cache."""
+    locks = get_active_locks()
+    key = (sub_code, str(grade))
+    locked = _lock_cache["units"].get(key)
+    if locked is None:
+        prefix = f"{sub_code}_G{grade}_U"
+        locked = {t for t in locks.get("UNIT", ()) if t.startswith(prefix)}
+        _lock_cache["units"][key] = locked
+    return locked
+
+
+def get_locks_bulk(pairs: List[tuple], db: Optional[Session] = None) -> dict:
+    """
+    Current is_locked flag for each (lock_type, lock_target) pair that has a row, read in one query.
+    Bypasses the lock cache so admin screens always show the state just written.
+    """
+    if not pairs:
+        return {}
+    own_db = db is None
+    if own_db:
+        db = SessionLocal()
+    try:
+        rows = db.execute(
+            select(SystemLock.lock_type, SystemLock.lock_target, SystemLock.is_locked)
+            .where(tuple_(SystemLock.lock_type, SystemLock.lock_target).in_(pairs))
+        ).all()
+    finally:
+        if own_db:
+            db.close()
+    return {(lock_type, target): is_locked for lock_type, target, is_locked in rows}
+
+
+def invalidate_lock_cache():
+    """Forces the next get_active_locks() call to reload from the DB."""
+    _lock_cache["loaded_at"] = 0.0
+
+
 # ==================== REVIEW QUEUE OPERATIONS ====================
 
+def _upsert_review_item(db: Session, user_id: int, question_id: str, status: str, subject: str, grade: int, unit: str) -> ReviewQueue:
+    """Adds the question to the queue or refreshes the existing entry, no commit."""
+    # Check if already exists
+    existing = db.query(ReviewQueue).filter(
+        and_(
+            ReviewQueue.user_id == user_id,
+            ReviewQueue.question_id == question_id
+        )
+    ).first()
+    
+    if existing:
+        # Update status if changed (e.g. SKIPPED -> MISTAKE)
+        # We prioritize MISTAKE over SKIPPED if needed, or just update timestamp
+        if existing.status != status:
+            existing.status = status
+        existing.added_at = datetime.utcnow()
+        return existing
+    
+    # Create new entry
+    item = ReviewQueue(
+        user_id=user_id,
+        question_id=question_id,
+        status=status,
+        subject=subject,
+        grade=grade,
+        unit=unit
+    )
+    db.add(item)
+    return item
+
+
 def add_to_review_queue(
     user_id: int, 
     question_id: str, 
@@ -414,37 +658,56 @@ def add_to_review_queue(
     """
     db = SessionLocal()
     try:
-        # Check if already exists
+        item = _upsert_review_item(db, user_id, question_id, status, subject, grade, unit)
+        db.commit()
+        db.refresh(item)
+        return item
+    finally:
+        db.close()
+
+
+def bulk_add_to_review_queue(user_id: int, rows: List[dict]) -> int:
+    """
+    Adds several questions to the review queue in one transaction.
+    rows: dicts with question_id, status, subject, grade, unit (later rows win for repeated IDs).
+    Existing entries are refreshed like add_to_review_queue; new ones go in as a single executemany INSERT.
+    Returns the number of distinct questions written.
+    """
+    by_qid = {row["question_id"]: row for row in rows}
+    written = len(by_qid)
+    if not written:
+        return 0
+    
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
         existing = db.query(ReviewQueue).filter(
             and_(
                 ReviewQueue.user_id == user_id,
-                ReviewQueue.question_id == question_id
+                ReviewQueue.question_id.in_(list(by_qid))
             )
-        ).first()
-        
-        if existing:
-            # Update status if changed (e.g. SKIPPED -> MISTAKE)
-            # We prioritize MISTAKE over SKIPPED if needed, or just update timestamp
-            if existing.status != status:
-                existing.status = status
-            existing.added_at = datetime.utcnow()
-            db.commit()
-            db.refresh(existing)
-            return existing
-        
-        # Create new entry
-        item = ReviewQueue(
-            user_id=user_id,
-            question_id=question_id,
-            status=status,
-            subject=subject,
-            grade=grade,
-            unit=unit
-        )
-        db.add(item)
+        ).all()
+        for item in existing:
+            row = by_qid.pop(item.question_id, None)
+            if row:
+                item.status = row["status"]
+            item.added_at = now
+        
+        if by_qid:
+            db.execute(insert(ReviewQueue), [
+                {
+                    "user_id": user_id,
+                    "question_id": qid,
+                    "status": row["status"],
+                    "subject": row["subject"],
+                    "grade": row["grade"],
+                    "unit": row["unit"],
+                    "added_at": now
+                }
+                for qid, row in by_qid.items()
+            ])
         db.commit()
-        db.refresh(item)
-        return item
+        return written
     finally:
         db.close()
 
@@ -466,14 +729,71 @@ def remove_from_review_queue(user_id: int, question_id: str):
         db.close()
 
 
-def get_review_queue_counts(user_id: int, subject: Optional[str] = None, grade: Optional[int] = None) -> dict:
+def apply_answer_effects(
+    user_id: int,
+    question_id: str,
+    subject: str,
+    grade: int,
+    unit: str,
+    is_correct: bool,
+    quiz_state: Optional[dict] = None,
+    progress_unit_id: Optional[str] = None,
+    review_status: Optional[str] = "MISTAKE",
+    xp_amount: int = 10
+) -> Optional[SessionModel]:
+    """
+    Applies everything one answered (or skipped) question changes in a single transaction:
+    progress attempt, XP, review queue add/remove and the session's quiz_state.
+    progress_unit_id=None skips the attempt record (used for skips).
+    review_status=None leaves wrong answers out of the queue (caller flushes them in bulk).
+    Returns the updated session row.
+    """
+    db = SessionLocal()
+    try:
+        if progress_unit_id:
+            _record_attempt(db, user_id, progress_unit_id, subject, grade, is_correct)
+        
+        if is_correct:
+            user = db.query(User).filter(User.id == user_id).first()
+            if user:
+                _apply_xp(user, xp_amount)
+            # Mastery achieved, drop it from the queue
+            db.query(ReviewQueue).filter(
+                and_(
+                    ReviewQueue.user_id == user_id,
+                    ReviewQueue.question_id == question_id
+                )
+            ).delete(synchronize_session=False)
+        elif review_status:
+            _upsert_review_item(db, user_id, question_id, review_status, subject, grade, unit)
+        
+        session = None
+        if quiz_state is not None:
+            session = db.query(SessionModel).filter(SessionModel.user_id == user_id).first()
+            if not session:
+                session = SessionModel(user_id=user_id)
+                db.add(session)
+            session.quiz_state = json_dumps(quiz_state)
+            session.updated_at = datetime.utcnow()
+        
+        db.commit()
+        if session is not None:
+            db.refresh(session)
+        return session
+    finally:
+        db.close()
+
+
+def get_review_queue_counts(user_id: int, subject: Optional[str] = None, grade: Optional[int] = None, db: Optional[Session] = None) -> dict:
     """
     Get counts of SKIPPED and MISTAKE items.
     Returns: {'SKIPPED': count, 'MISTAKE': count}
     """
-    db = SessionLocal()
+    own_db = db is None
+    if own_db:
+        db = SessionLocal()
     try:
-        query = db.query(ReviewQueue.status, ReviewQueue.subject).filter(ReviewQueue.user_id == user_id)
+        query = db.query(ReviewQueue.status, func.count(ReviewQueue.id)).filter(ReviewQueue.user_id == user_id)
         
         if subject:
             # Handle short codes if passed
@@ -485,15 +805,16 @@ def get_review_queue_counts(user_id: int, subject: Optional[str] = None, grade:
         if grade and grade > 0: # Only filter if grade is valid integer > 0
             query = query.filter(ReviewQueue.grade == grade)
             
-        results = query.all()
+        results = query.group_by(ReviewQueue.status).all()
         
         counts = {"SKIPPED": 0, "MISTAKE": 0, "PINNED": 0}
-        for status, _ in results:
+        for status, count in results:
             if status in counts:
-                counts[status] += 1
+                counts[status] = count
         return counts
     finally:
-        db.close()
+        if own_db:
+            db.close()
 
 
 def get_review_queue_items(
@@ -539,7 +860,8 @@ def create_challenge(creator_id: int, subject: Optional[str], grade: int, questi
             creator_id=creator_id,
             subject=subject,
             grade=grade,
-            questions_json=json.dumps(questions)
+            questions_json=json.dumps(questions),
+            question_count=len(questions)
         )
         db.add(challenge)
         db.commit()
@@ -563,3 +885,39 @@ def get_challenge(challenge_id: str) -> Optional[dict]:
         return None
     finally:
         db.close()
+
+
+# ==================== ADMIN STATS ====================
+
+# Bot-wide totals for the admin dashboard (loaded_at, totals), rebuilt after ADMIN_TOTALS_TTL seconds
+ADMIN_TOTALS_TTL = 30
+_admin_totals_cache = None
+
+
+def get_admin_totals(db: Optional[Session] = None) -> dict:
+    """
+    Returns total_users, total_xp, total_attempts, total_correct and total_flagged,
+    read in one round trip and cached for ADMIN_TOTALS_TTL seconds.
+    """
+    global _admin_totals_cache
+    if _admin_totals_cache and time.monotonic() - _admin_totals_cache[0] < ADMIN_TOTALS_TTL:
+        return _admin_totals_cache[1]
+    
+    stmt = select(
+        select(func.count(User.id)).scalar_subquery().label("total_users"),
+        select(func.coalesce(func.sum(User.total_xp), 0)).scalar_subquery().label("total_xp"),
+        select(func.coalesce(func.sum(Progress.questions_attempted), 0)).scalar_subquery().label("total_attempts"),
+        select(func.coalesce(func.sum(Progress.questions_correct), 0)).scalar_subquery().label("total_correct"),
+        select(func.count(FlaggedQuestion.id)).scalar_subquery().label("total_flagged"),
+    )
+    own_db = db is None
+    if own_db:
+        db = SessionLocal()
+    try:
+        totals = dict(db.execute(stmt).first()._mapping)
+    finally:
+        if own_db:
+            db.close()
+    
+    _admin_totals_cache = (time.monotonic(), totals)
+    return totals
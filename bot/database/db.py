@@ -17,7 +17,9 @@ engine = create_engine(
     echo=False,  # Set to True for SQL debug logging
     connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {},
     pool_pre_ping=True,      # Check connection before using it
-    pool_recycle=300         # Recycle connections every 5 minutes
+    pool_recycle=300,        # Recycle connections every 5 minutes
+    # Room for concurrent callback renders (each holds one connection while composing)
+    **({} if "sqlite" in DATABASE_URL else {"pool_size": 10, "max_overflow": 10})
 )
 
 # Create session factory
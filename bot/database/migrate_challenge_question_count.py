@@ -0,0 +1,50 @@
+"""
+Migration script to store challenge sizes
+Adds question_count column to challenges table and backfills it from questions_json
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from database.db import engine
+from sqlalchemy import inspect, text
+
+# JSON array length per dialect (questions_json is a TEXT column)
+_ARRAY_LENGTH_SQL = {
+    "sqlite": "json_array_length(questions_json)",
+    "postgresql": "json_array_length(questions_json::json)",
+}
+
+def migrate():
+    """Add question_count column to challenges table"""
+    print("[MIGRATION] Adding challenges.question_count...")
+    
+    with engine.connect() as conn:
+        try:
+            # Check if column already exists (works for SQLite and PostgreSQL)
+            columns = [col["name"] for col in inspect(conn).get_columns("challenges")]
+            
+            if 'question_count' not in columns:
+                print("[MIGRATION] Adding question_count column...")
+                conn.execute(text("ALTER TABLE challenges ADD COLUMN question_count INTEGER"))
+                conn.commit()
+                print("[OK] question_count column added")
+            else:
+                print("[SKIP] question_count column already exists")
+            
+            length_sql = _ARRAY_LENGTH_SQL.get(conn.dialect.name)
+            if length_sql:
+                result = conn.execute(text(f"UPDATE challenges SET question_count = {length_sql} WHERE question_count IS NULL"))
+                conn.commit()
+                print(f"[OK] Backfilled question_count for {result.rowcount} challenge(s)")
+            else:
+                print("[SKIP] No JSON functions for this database; old challenges are counted when listed")
+            
+            print("[OK] Migration completed successfully!")
+            
+        except Exception as e:
+            print(f"[ERROR] Migration failed: {e}")
+            raise
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,36 @@
+"""
+Migration script for the admin flag list ordering
+Adds index ix_flagged_questions_flag_count on flagged_questions (flag_count)
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from database.db import engine
+from sqlalchemy import inspect, text
+
+def migrate():
+    """Add flag_count index to flagged_questions table"""
+    print("[MIGRATION] Adding flagged_questions.flag_count index...")
+
+    with engine.connect() as conn:
+        try:
+            # Check if index already exists (works for SQLite and PostgreSQL)
+            indexes = [ix["name"] for ix in inspect(conn).get_indexes("flagged_questions")]
+
+            if 'ix_flagged_questions_flag_count' not in indexes:
+                print("[MIGRATION] Creating ix_flagged_questions_flag_count...")
+                conn.execute(text("CREATE INDEX ix_flagged_questions_flag_count ON flagged_questions (flag_count DESC)"))
+                conn.commit()
+                print("[OK] ix_flagged_questions_flag_count created")
+            else:
+                print("[SKIP] ix_flagged_questions_flag_count already exists")
+
+            print("[OK] Migration completed successfully!")
+
+        except Exception as e:
+            print(f"[ERROR] Migration failed: {e}")
+            raise
+
+if __name__ == "__main__":
+    migrate()
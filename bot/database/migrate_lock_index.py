@@ -0,0 +1,36 @@
+"""
+Migration script for the SystemLock lookup index
+Adds composite index ix_lock_type_target on system_locks (lock_type, lock_target)
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from database.db import engine
+from sqlalchemy import inspect, text
+
+def migrate():
+    """Add (lock_type, lock_target) index to system_locks table"""
+    print("[MIGRATION] Adding system_locks index...")
+
+    with engine.connect() as conn:
+        try:
+            # Check if index already exists (works for SQLite and PostgreSQL)
+            indexes = [ix["name"] for ix in inspect(conn).get_indexes("system_locks")]
+
+            if 'ix_lock_type_target' not in indexes:
+                print("[MIGRATION] Creating ix_lock_type_target...")
+                conn.execute(text("CREATE INDEX ix_lock_type_target ON system_locks (lock_type, lock_target)"))
+                conn.commit()
+                print("[OK] ix_lock_type_target created")
+            else:
+                print("[SKIP] ix_lock_type_target already exists")
+
+            print("[OK] Migration completed successfully!")
+
+        except Exception as e:
+            print(f"[ERROR] Migration failed: {e}")
+            raise
+
+if __name__ == "__main__":
+    migrate()
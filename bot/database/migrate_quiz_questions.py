@@ -0,0 +1,36 @@
+"""
+Migration script to move the active question batch out of quiz_state
+Adds quiz_questions column to sessions table
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from database.db import engine
+from sqlalchemy import inspect, text
+
+def migrate():
+    """Add quiz_questions column to sessions table"""
+    print("[MIGRATION] Adding sessions.quiz_questions...")
+    
+    with engine.connect() as conn:
+        try:
+            # Check if column already exists (works for SQLite and PostgreSQL)
+            columns = [col["name"] for col in inspect(conn).get_columns("sessions")]
+            
+            if 'quiz_questions' not in columns:
+                print("[MIGRATION] Adding quiz_questions column...")
+                conn.execute(text("ALTER TABLE sessions ADD COLUMN quiz_questions TEXT"))
+                conn.commit()
+                print("[OK] quiz_questions column added")
+            else:
+                print("[SKIP] quiz_questions column already exists")
+            
+            print("[OK] Migration completed successfully!")
+            
+        except Exception as e:
+            print(f"[ERROR] Migration failed: {e}")
+            raise
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,36 @@
+"""
+Migration script for the review hub counts
+Adds composite index ix_review_user_subject_grade_status on review_queue (user_id, subject, grade, status)
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from database.db import engine
+from sqlalchemy import inspect, text
+
+def migrate():
+    """Add (user_id, subject, grade, status) index to review_queue table"""
+    print("[MIGRATION] Adding review_queue counts index...")
+
+    with engine.connect() as conn:
+        try:
+            # Check if index already exists (works for SQLite and PostgreSQL)
+            indexes = [ix["name"] for ix in inspect(conn).get_indexes("review_queue")]
+
+            if 'ix_review_user_subject_grade_status' not in indexes:
+                print("[MIGRATION] Creating ix_review_user_subject_grade_status...")
+                conn.execute(text("CREATE INDEX ix_review_user_subject_grade_status ON review_queue (user_id, subject, grade, status)"))
+                conn.commit()
+                print("[OK] ix_review_user_subject_grade_status created")
+            else:
+                print("[SKIP] ix_review_user_subject_grade_status already exists")
+
+            print("[OK] Migration completed successfully!")
+
+        except Exception as e:
+            print(f"[ERROR] Migration failed: {e}")
+            raise
+
+if __name__ == "__main__":
+    migrate()
@@ -1,7 +1,7 @@
 """
 Database models for Nebular Cassini Bot
 """
-from sqlalchemy import Boolean, Column, Integer, BigInteger, String, Float, DateTime, Text, ForeignKey
+from sqlalchemy import Boolean, Column, Integer, BigInteger, String, Float, DateTime, Text, ForeignKey, Index
 from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -118,6 +118,7 @@ class Session(Base):
     last_message_id = Column(BigInteger, nullable=True)  # The message to edit
     session_active = Column(Boolean, default=True, nullable=False)
     quiz_state = Column(Text, nullable=True)  # JSON: current quiz data
+    quiz_questions = Column(Text, nullable=True)  # JSON: [question_id, source_unit] refs of the active batch, written once per batch
     updated_at = Column(SafeDateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     
     # Relationship
@@ -133,7 +134,7 @@ class FlaggedQuestion(Base):
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     question_id = Column(String(255), unique=True, nullable=False, index=True)
-    flag_count = Column(Integer, default=1, nullable=False)
+    flag_count = Column(Integer, default=1, nullable=False, index=True)
     reasons = Column(Text, default="[]", nullable=False)  # JSON array of flag reasons
     last_flagged = Column(SafeDateTime, default=datetime.utcnow, nullable=False)
     
@@ -164,6 +165,11 @@ class ReviewQueue(Base):
     # Relationship
     user = relationship("User", back_populates="review_items")
     
+    __table_args__ = (
+        # Covers the per-subject/grade status counts on the review hub
+        Index('ix_review_user_subject_grade_status', 'user_id', 'subject', 'grade', 'status'),
+    )
+    
     def __repr__(self):
         return f"<ReviewQueue(user={self.user_id}, q={self.question_id}, status={self.status})>"
 
@@ -178,6 +184,7 @@ class Challenge(Base):
     subject = Column(String(50), nullable=True) # None for mixed
     grade = Column(Integer, nullable=False)
     questions_json = Column(Text, nullable=False) # JSON list of questions
+    question_count = Column(Integer, nullable=True) # len(questions_json), stored so listings skip the JSON
     creator_score = Column(Integer, default=0, nullable=False) # Score of the creator (out of 10)
     created_at = Column(SafeDateTime, default=datetime.utcnow, nullable=False)
 
@@ -196,6 +203,10 @@ class SystemLock(Base):
     locked_at = Column(SafeDateTime, default=datetime.utcnow, nullable=False)
     lock_reason = Column(Text, nullable=True)  # Optional reason for the lock
     
+    __table_args__ = (
+        Index('ix_lock_type_target', 'lock_type', 'lock_target'),
+    )
+    
     def __repr__(self):
         status = "LOCKED" if self.is_locked else "UNLOCKED"
         return f"<SystemLock({self.lock_type}:{self.lock_target} = {status})>"
@@ -1,11 +1,13 @@
 """Handlers package initialization"""
 from .start_handler import handle_start
+from .admin_handler import handle_reload
 from .callback_router import route_callback
 from .navigation import navigate_to, go_back, go_home
 from .screen_renderer import render_screen
 
 __all__ = [
     'handle_start',
+    'handle_reload',
     'route_callback',
     'navigate_to',
     'go_back',
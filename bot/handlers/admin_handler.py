@@ -0,0 +1,30 @@
+"""
+/reload command handler (admins only)
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from config import ADMIN_IDS
+from utils.blueprint_loader import reload_blueprint
+from utils.question_engine import QuestionEngine
+import handlers.game_handler as gh
+
+
+def handle_reload(bot, update):
+    """
+    Handle /reload command.
+    Drops every cached view of the data folder and the blueprint so edits on disk are served
+    without a restart: grade/unit listings, parsed units, the question index and game pools.
+    """
+    telegram_id = update.effective_user.id
+    if telegram_id not in ADMIN_IDS:
+        return
+
+    QuestionEngine.clear_caches()
+    gh._POOL_CACHE.clear()
+    gh._DISPLAYS.clear()
+    gh._VERSION_CHECKS.clear()
+    reload_blueprint()
+    print(f"[ADMIN] Data caches reloaded by {telegram_id}")
+    bot.send_message(chat_id=telegram_id, text="✅ Question data and blueprint reloaded.")
@@ -3,27 +3,33 @@ Callback router - routes ACTION|SCREEN|PARAM callbacks to appropriate handlers
 """
 import sys
 import os
+import re
 import json
+import io
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from datetime import datetime, timedelta
 import datetime as dt_lib
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from handlers.quiz_handler import handle_answer_selection, next_question, start_quiz_session, skip_question, start_next_batch, replay_batch, start_next_part, start_review_session, start_smart_review, start_random_quiz
+from handlers.quiz_handler import handle_answer_selection, next_question, start_quiz_session, skip_question, start_next_batch, replay_batch, start_next_part, start_review_session, start_smart_review, start_random_quiz, get_quiz_questions
 from handlers.navigation import navigate_to, go_back, go_home
-from handlers.screen_renderer import render_screen
+from handlers.screen_renderer import render_screen, forget_render
 import handlers.game_handler as gh
 from database.crud import (
     get_or_create_user, get_or_create_session, update_session_state, 
-    flag_question, add_to_review_queue, get_challenge, SessionLocal
+    flag_question, add_to_review_queue, get_challenge, SessionLocal, REQUEST_USER,
+    invalidate_lock_cache
 )
 from database.models import User as UserModel, Progress as ProgressModel, FlaggedQuestion, Session as SessionModel, ReviewQueue, Challenge, SystemLock
 from utils.question_engine import QuestionEngine
-from utils.pdf_generator import generate_unit_pdf, generate_all_units_pdf
-from utils.lock_manager import is_content_locked
+from utils.pdf_generator import generate_unit_pdf, generate_all_units_pdf, unit_pdf_cache_path, all_units_pdf_cache_path, load_cached_pdf
+from utils.lock_manager import is_content_locked, forget_user_grade
 from sqlalchemy import func
 import traceback
 
+# Unit lock targets look like BIO_G12_U1
+_UNIT_RE = re.compile(r"^([A-Z]+)_G(\d+)_U(\d+)$")
+
 def escape_md(val):
     if not val or not isinstance(val, str): return str(val)
     return val.replace("*", "\\*").replace("_", "\\_").replace("`", "\\`")
@@ -77,7 +83,8 @@ def route_callback(bot, update):
         print(f"[LOCK CHECK FAIL] {e}")
         # Fail open if check fails to prevent system lockout due to bug
     
-    # Route based on action
+    # Route based on action (handlers reuse this user row for the rest of the update)
+    request_token = REQUEST_USER.set(user)
     try:
         if action == "NAV":
             handle_navigation(bot, query, screen, param)
@@ -93,6 +100,8 @@ def route_callback(bot, update):
             # Polite user-facing error
             query.answer("⚠️ The bot is currently under repair. Please try again in a moment.", show_alert=True)
         except: pass
+    finally:
+        REQUEST_USER.reset(request_token)
 
     # Answer the callback query (removes loading indicator)
     query.answer()
@@ -125,6 +134,7 @@ def handle_navigation(bot, query, screen, param):
                     u.current_grade = g_num
                     db.commit()
                     db.close()
+                    forget_user_grade(telegram_id)
             except: pass
 
     # Debug log for navigation
@@ -151,7 +161,10 @@ def handle_navigation(bot, query, screen, param):
     is_root = param == "ROOT"
     add_to_stack = not is_root or (screen in game_screens)
     
-    msg = navigate_to(bot, telegram_id, screen, param=param if not is_root else None, add_to_stack=add_to_stack)
+    # Grade tabs re-render to identical content, so repeat taps skip the render entirely
+    is_grade_tab = screen in ("SCR_STATS", "SCR_GAMEMODE") and bool(param) and param.isdigit()
+    
+    msg = navigate_to(bot, telegram_id, screen, param=param if not is_root else None, add_to_stack=add_to_stack, skip_if_current=is_grade_tab)
     if msg is None:
         # Provide a subtle toast if content didn't change (e.g. clicking same grade)
         if screen == "SCR_STATS" and param and param.isdigit():
@@ -180,7 +193,7 @@ def handle_action(bot, query, screen, param):
              if session.quiz_state:
                  qs = json.loads(session.quiz_state)
                  idx = qs.get("current_index", 0)
-                 q_list = qs.get("questions", [])
+                 q_list = get_quiz_questions(user.id, qs, session)
                  if idx < len(q_list):
                      q = q_list[idx]
                      add_to_review_queue(
@@ -292,6 +305,7 @@ def handle_action(bot, query, screen, param):
                 g_num = int(param.split("|")[1])
                 user_db.current_grade = g_num
                 db.commit()
+                forget_user_grade(telegram_id)
                 query.answer(f"✅ Grade set to {g_num}", show_alert=True)
                 
                 # Navigate: Profile settings for updates, Home for onboarding
@@ -312,6 +326,7 @@ def handle_action(bot, query, screen, param):
                     user_db.streak_count = 0
                     user_db.current_grade = 9
                 db.commit()
+                forget_user_grade(telegram_id)
                 query.answer("✅ All progress has been reset.", show_alert=True)
                 navigate_to(bot, telegram_id, "SCR_HUB", add_to_stack=False)
             except Exception as e:
@@ -819,6 +834,7 @@ We're committed to your success! 🌟
         
         # We don't want to navigate, just edit text and add a BACK button
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Help", callback_data="NAV|SCR_HELP|ROOT")]])
+        forget_render(telegram_id, query.message.message_id)
         bot.edit_message_text(chat_id=telegram_id, message_id=query.message.message_id, text=text, reply_markup=kb, parse_mode="Markdown")
 
     
@@ -847,17 +863,17 @@ We're committed to your success! 🌟
                 pdf_path = f"{code}_{grade.replace(' ', '')}_{unit.replace(' ', '')}.pdf"
                 
                 # PRE-CHECK CACHE for instant delivery
-                from utils.pdf_generator import CACHE_DIR
-                cache_key = f"{subject}_{grade}_{unit_title or unit}".replace(" ", "_").replace(":", "_")
-                cached_file = os.path.join(CACHE_DIR, f"{cache_key}.pdf")
+                cached_file = unit_pdf_cache_path(subject, grade, unit_title or unit, questions)
+                cached_pdf = load_cached_pdf(cached_file)
                 
-                if os.path.exists(cached_file):
+                if cached_pdf is not None:
                     # INSTANT SEND
                     query.answer("🚀 Retrieving Study Guide...", show_alert=False)
-                    with open(cached_file, "rb") as f:
+                    with io.BytesIO(cached_pdf) as f:
                         bot.send_document(
                             chat_id=telegram_id, 
                             document=f, 
+                            filename=os.path.basename(cached_file),
                             caption=f"📄 *{subject} - {unit}*\n\n✅ Complete MCQ Study Guide\n📝 {len(questions)} Questions\n✔️ Answers & Explanations Included\n\nGenerated by @NebularCassiniBot",
                             parse_mode="Markdown"
                         )
@@ -866,6 +882,7 @@ We're committed to your success! 🌟
                 
                 # If not cached, continue with generation feedback
                 try:
+                    forget_render(telegram_id, query.message.message_id)
                     bot.edit_message_text(chat_id=telegram_id, message_id=query.message.message_id, text=f"⏳ *Generating Study Guide...*\n\n{subject} - {unit}\n\nPlease wait while we prepare your high-quality PDF.", parse_mode="Markdown")
                     
                     generate_unit_pdf(subject, grade, unit_title or unit, questions, pdf_path)
@@ -917,8 +934,7 @@ We're committed to your success! 🌟
                 # Load questions for all units
                 unit_data_list = []
                 total_questions = 0
-                for u in units:
-                    qs, _, ut = QuestionEngine.load_unit_questions(subject, grade, u)
+                for u, (qs, _, ut) in zip(units, QuestionEngine.load_units_questions(subject, grade, units)):
                     if qs:
                         unit_data_list.append((ut or u, qs))
                         total_questions += len(qs)
@@ -931,17 +947,17 @@ We're committed to your success! 🌟
                 pdf_path = f"{code}_{grade.replace(' ', '')}_FullVolume.pdf"
                 
                 # PRE-CHECK CACHE for instant delivery
-                from utils.pdf_generator import CACHE_DIR
-                cache_key = f"COMPREHENSIVE_{subject}_{grade}_{len(unit_data_list)}".replace(" ", "_")
-                cached_file = os.path.join(CACHE_DIR, f"{cached_file_name}.pdf" if 'cached_file_name' in locals() else f"{cache_key}.pdf")
+                cached_file = all_units_pdf_cache_path(subject, grade, unit_data_list)
+                cached_pdf = load_cached_pdf(cached_file)
                 
-                if os.path.exists(cached_file):
+                if cached_pdf is not None:
                     # INSTANT SEND
                     query.answer("📚 Retrieving Comprehensive Volume...", show_alert=False)
-                    with open(cached_file, "rb") as f:
+                    with io.BytesIO(cached_pdf) as f:
                         bot.send_document(
                             chat_id=telegram_id, 
                             document=f, 
+                            filename=os.path.basename(cached_file),
                             caption=f"📚 *{subject} {grade} - Complete Volume*\n\n✅ All Units Included\n📝 {total_questions} Questions\n✔️ Full Answers & Explanations\n\nGenerated by @NebularCassiniBot",
                             parse_mode="Markdown"
                         )
@@ -950,6 +966,7 @@ We're committed to your success! 🌟
 
                 try:
                     # Visual feedback
+                    forget_render(telegram_id, query.message.message_id)
                     bot.edit_message_text(chat_id=telegram_id, message_id=query.message.message_id, text=f"⏳ *Generating Full Volume...*\n\n{subject} - {grade}\n\nThis may take up to 30 seconds. Please stay on this screen.", parse_mode="Markdown")
                     
                     generate_all_units_pdf(subject, grade, unit_data_list, pdf_path)
@@ -1024,6 +1041,7 @@ We're committed to your success! 🌟
             ])
             
             try:
+                forget_render(telegram_id, query.message.message_id)
                 bot.edit_message_text(chat_id=telegram_id, message_id=query.message.message_id, text="\n".join(lines), reply_markup=kb, parse_mode="Markdown")
             except Exception as e:
                 if "Message is not modified" in str(e):
@@ -1355,6 +1373,7 @@ Last Updated: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC"""
                 ])
                 
                 try:
+                    forget_render(telegram_id, query.message.message_id)
                     bot.edit_message_text(chat_id=telegram_id, message_id=query.message.message_id, text=msg, reply_markup=kb, parse_mode="Markdown")
                 except Exception as e:
                     if "Message is not modified" in str(e):
@@ -1556,10 +1575,9 @@ Last Updated: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC"""
                 query.answer(action_text, show_alert=True)
                 # Navigate back to the unit list with proper context
                 # Extract subject and grade from unit_id (e.g., "BIO_G12_U1" -> BIO, 12)
-                parts = unit_id.split("_")
-                if len(parts) >= 2:
-                    subject = parts[0]
-                    grade = parts[1].replace("G", "")
+                m = _UNIT_RE.match(unit_id)
+                if m:
+                    subject, grade = m.group(1, 2)
                     navigate_to(bot, telegram_id, "SCR_LOCK_UNIT_LIST", param=f"{subject}:{grade}", add_to_stack=False)
                 else:
                     navigate_to(bot, telegram_id, "SCR_LOCK_UNITS", add_to_stack=False)
@@ -1573,6 +1591,7 @@ Last Updated: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC"""
             print(f"[LOCK] Error: {e}")
         finally:
             db.close()
+            invalidate_lock_cache()
 
 
     elif screen == "REPORT_OPTIONS":
@@ -1581,7 +1600,7 @@ Last Updated: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC"""
         session = get_or_create_session(user.id)
         if session.quiz_state:
             qs = json.loads(session.quiz_state)
-            q_list = qs.get("questions", [])
+            q_list = get_quiz_questions(user.id, qs, session)
             idx = qs.get("current_index", 0)
             if idx < len(q_list):
                 q = q_list[idx]
@@ -1,27 +1,43 @@
 """
 Game mode handler - Logic for Speed Run, Survival, and Multiplayer
 """
-import json
+import html
+import os
 import random
 import time
 from database.crud import (
     get_or_create_user, get_or_create_session, 
-    update_session_state, add_xp
+    update_session_state, add_xp, get_active_locks,
+    create_challenge
 )
 from utils.question_engine import QuestionEngine
+from utils.json_codec import loads as _loads
 from handlers.screen_renderer import render_screen
 from handlers.navigation import navigate_to
 
 # Time Tracking for Jobs
 _ACTIVE_SPEEDRUNS = {} # {telegram_id: job}
 
+# Subject code <-> folder name (MIXED means all subjects)
+SUBJ_NAME = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics", "MIXED": None}
+SUBJ_CODE = {v: k for k, v in SUBJ_NAME.items() if v}
+_OPT_KEYS = ("A", "B", "C", "D")
+
+# Parsed question pools: {(grade, subject, content_version): [(subject, unit_id, questions), ...]}
+_POOL_CACHE = {}
+# Escaped SCR_GAME_PRES text per question_id, filled when a pool is built.
+# Kept beside the questions: the question dicts are shared with every other loader and get persisted.
+_DISPLAYS = {}
+# Seconds between data-folder scans for a pool; game starts in between reuse the last version
+CONTENT_CHECK_INTERVAL = 5.0
+_VERSION_CHECKS = {}  # {(grade, subjects): (checked_at, version)}
+
 def start_speedrun(bot, telegram_id, duration_seconds, subject_code=None, count=20, grade=None):
     """Starts a Speed Run session with a fixed timer."""
     user = get_or_create_user(telegram_id, None, "User")
     active_grade = grade if grade else user.current_grade
     
-    subj_map = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics", "MIXED": None}
-    subject = subj_map.get(subject_code)
+    subject = SUBJ_NAME.get(subject_code)
     
     # Load questions from active grade
     questions = _get_random_questions(active_grade, subject=subject, count=count)
@@ -55,8 +71,7 @@ def start_survival(bot, telegram_id, subject_code, grade=None):
     """Starts a Survival session - ends on first mistake."""
     user = get_or_create_user(telegram_id, None, "User")
     active_grade = grade if grade else user.current_grade
-    subj_map = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
-    subject = subj_map.get(subject_code, subject_code)
+    subject = SUBJ_NAME.get(subject_code) or subject_code
     
     questions = _get_random_questions(active_grade, subject=subject, count=100)
     
@@ -80,17 +95,28 @@ def start_survival(bot, telegram_id, subject_code, grade=None):
     update_session_state(user.id, screen="SCR_GAME_PRES", quiz_state=quiz_state)
     present_game_question(bot, telegram_id)
 
-def _escape_markdown(text):
-    """Helper to escape common markdown characters that break rendering in legacy Markdown."""
-    if not isinstance(text, str): return str(text)
-    # Legacy Markdown only really cares about *, _, `, [
-    return text.replace("*", "\\*").replace("_", "\\_").replace("`", "\\`").replace("[", "\\[")
+def _build_display(q):
+    """HTML-escaped question stem followed by the A-D options, ready for SCR_GAME_PRES."""
+    q_text = html.escape(str(q.get('question', '')), quote=False)
+    options = q.get("options", {})
+    # Force sort A, B, C, D
+    options_parts = [
+        f"<b>{opt})</b> {html.escape(str(v), quote=False)}"
+        for opt in _OPT_KEYS if (v := options.get(opt)) is not None
+    ]
+    
+    return f"{q_text}\n\n" + "\n\n".join(options_parts)
+
+def _display_for(q):
+    """Game display for a question, from the pool-time cache when available."""
+    display = _DISPLAYS.get(q.get("question_id"))
+    return display if display is not None else _build_display(q)
 
 def present_game_question(bot, telegram_id):
     """Displays the current question for the active session."""
     user = get_or_create_user(telegram_id, None, "User")
     session = get_or_create_session(user.id)
-    state = json.loads(session.quiz_state) if session.quiz_state else {}
+    state = _loads(session.quiz_state) if session.quiz_state else {}
     
     if not state: 
         print(f"[GAME] No state found for {telegram_id}")
@@ -110,17 +136,8 @@ def present_game_question(bot, telegram_id):
 
     q = state["questions"][idx]
     
-    # Text formatting with escaping
-    q_text = _escape_markdown(q.get('question', ''))
-    options = q.get("options", {})
-    options_parts = []
-    # Force sort A, B, C, D
-    for opt in ["A", "B", "C", "D"]:
-        if opt in options:
-            opt_text = _escape_markdown(options[opt])
-            options_parts.append(f"*{opt})* {opt_text}")
-    
-    question_display = f"{q_text}\n\n" + "\n\n".join(options_parts)
+    # Escaped stem + options are built once when the pool is loaded
+    question_display = _display_for(q)
     
     # Header logic with feedback
     last_fb = state.get("last_feedback", "🎮")
@@ -156,18 +173,16 @@ def present_game_question(bot, telegram_id):
         header_pre = f"⚔️ {last_fb} | 🏆 {state['score']} | {idx+1}/{total} Qs"
         dot_bar = "━━━━━━━━━━━━━━"
 
-    # Escape the header as well just in case feedback or score has weird chars
-    header_escaped = _escape_markdown(header_pre)
-
+    # Header is escaped by the renderer (HTML mode)
     extra_vars = {
-        "unit_title": header_escaped,
+        "unit_title": header_pre,
         "dot_progress_bar": dot_bar,
         "question_stem": question_display
     }
     
     # Use SCR_GAME_PRES instead of SCR_QUIZ_PRES to remove Skip/Pin buttons
     print(f"[GAME] Rendering {state['mode']} for {telegram_id}")
-    msg = render_screen(bot, user.id, telegram_id, "SCR_GAME_PRES", session.last_message_id, extra_vars)
+    msg = render_screen(bot, user.id, telegram_id, "SCR_GAME_PRES", session.last_message_id, extra_vars, parse_mode="HTML")
     if msg:
         update_session_state(user.id, message_id=msg.message_id)
 
@@ -175,7 +190,7 @@ def handle_game_answer(bot, telegram_id, selected_opt):
     """Processes user answer during game modes."""
     user = get_or_create_user(telegram_id, None, "User")
     session = get_or_create_session(user.id)
-    state = json.loads(session.quiz_state) if session.quiz_state else {}
+    state = _loads(session.quiz_state) if session.quiz_state else {}
     
     if not state: return
 
@@ -224,7 +239,7 @@ def show_game_summary(bot, telegram_id, reason):
     """Shows end-of-game stats with persistent buttons."""
     user = get_or_create_user(telegram_id, None, "User")
     session = get_or_create_session(user.id)
-    state = json.loads(session.quiz_state) if session.quiz_state else {}
+    state = _loads(session.quiz_state) if session.quiz_state else {}
     
     if not state: return
 
@@ -252,53 +267,88 @@ def show_game_summary(bot, telegram_id, reason):
     if msg:
          update_session_state(user.id, message_id=msg.message_id)
 
-def _get_random_questions(grade, subject=None, count=20):
-    """Utility to pull random questions from the data folder, respecting locks."""
-    from database.models import SystemLock
-    from database.crud import SessionLocal
-    db = SessionLocal()
-    
-    # 1. Fetch active locks for this grade
-    grade_locks = db.query(SystemLock).filter(
-        SystemLock.is_locked == True
-    ).all()
-    
-    locked_subjects = [l.lock_target.split(":")[0] for l in grade_locks if l.lock_type == "SUBJECT" and f":{grade}" in l.lock_target]
-    locked_units = [l.lock_target for l in grade_locks if l.lock_type == "UNIT"]
-    db.close()
+def _content_version(grade, subjects):
+    """
+    Newest mtime across the grade/unit folders and R-files feeding a pool.
+    The directory walk runs at most once per CONTENT_CHECK_INTERVAL per pool; /reload forces a rebuild.
+    """
+    key = (str(grade), tuple(subjects))
+    now = time.monotonic()
+    checked = _VERSION_CHECKS.get(key)
+    if checked and now - checked[0] < CONTENT_CHECK_INTERVAL:
+        return checked[1]
+    version = _scan_content_version(grade, subjects)
+    _VERSION_CHECKS[key] = (now, version)
+    return version
 
-    all_qs = []
-    subjects = [subject] if subject else ["Biology", "Chemistry", "Physics", "Mathematics"]
-    print(f"[RAND] Pulling questions for Grade {grade}, Subj={subject}")
-    
+def _scan_content_version(grade, subjects):
+    """Walks the grade folders behind _content_version."""
+    latest = 0.0
     for s in subjects:
-        # Skip locked subjects
-        if s in locked_subjects:
-            print(f"[RAND] Skipping locked subject: {s}")
+        grade_dir = os.path.join(QuestionEngine.BASE_DATA_DIR, s, f"Grade_{grade}")
+        if not os.path.isdir(grade_dir):
             continue
-            
+        latest = max(latest, os.stat(grade_dir).st_mtime)
+        for unit_entry in os.scandir(grade_dir):
+            if not unit_entry.is_dir():
+                continue
+            latest = max(latest, unit_entry.stat().st_mtime)
+            for f in os.scandir(unit_entry.path):
+                if f.name.endswith(".json"):
+                    latest = max(latest, f.stat().st_mtime)
+    return latest
+
+def _build_pool(grade, subjects):
+    """Loads every unit for the grade as [(subject, unit_id, questions), ...]."""
+    pool = []
+    grade_str = f"Grade {grade}"
+    for s in subjects:
         try:
-            grade_str = f"Grade {grade}"
             units = QuestionEngine.list_units(s, grade_str)
-            if not units:
-                continue
-                
             for u in units:
                 unit_num = u.split(" ")[1] if " " in u else u
                 # Normalize unit_id for lock check (e.g., BIO_G9_U1)
-                sub_code = {"Biology": "BIO", "Chemistry": "CHEM", "Physics": "PHYS", "Mathematics": "MATH"}.get(s, s)
-                unit_id = f"{sub_code}_G{grade}_U{unit_num}"
-                
-                # Skip locked units
-                if unit_id in locked_units:
-                    print(f"[RAND] Skipping locked unit: {unit_id}")
-                    continue
-                    
+                unit_id = f"{SUBJ_CODE.get(s, s)}_G{grade}_U{unit_num}"
                 qs, _, _ = QuestionEngine.load_unit_questions(s, grade_str, u)
-                if qs: 
-                    all_qs.extend(qs)
+                if qs:
+                    for q in qs:
+                        if q.get("question_id"):
+                            _DISPLAYS[q["question_id"]] = _build_display(q)
+                    pool.append((s, unit_id, qs))
         except Exception as e:
             print(f"[RAND] Error in {s}: {e}")
+    return pool
+
+def _get_random_questions(grade, subject=None, count=20):
+    """Utility to pull random questions from the data folder, respecting locks."""
+    # 1. Active locks from the shared lock cache (sets of targets, reset whenever an admin toggles one)
+    locks = get_active_locks()
+    grade_suffix = f":{grade}"
+    locked_subjects = {t.split(":")[0] for t in locks.get("SUBJECT", ()) if t.endswith(grade_suffix)}
+    locked_units = locks.get("UNIT", set())
+
+    subjects = [subject] if subject else ["Biology", "Chemistry", "Physics", "Mathematics"]
+    print(f"[RAND] Pulling questions for Grade {grade}, Subj={subject}")
+    
+    # 2. Reuse the parsed pool unless the data files changed since it was built
+    key = (str(grade), subject, _content_version(grade, subjects))
+    pool = _POOL_CACHE.get(key)
+    if pool is None:
+        stale_keys = [k for k in _POOL_CACHE if k[:2] == key[:2]]
+        if stale_keys:
+            # Data changed on disk since the last build, parsed units are stale too
+            QuestionEngine.clear_caches()
+        for stale in stale_keys:
+            del _POOL_CACHE[stale]
+        pool = _build_pool(grade, subjects)
+        _POOL_CACHE[key] = pool
+    
+    # 3. Lock filtering happens per request so toggles apply immediately
+    all_qs = [
+        q for s, unit_id, qs in pool
+        if s not in locked_subjects and unit_id not in locked_units
+        for q in qs
+    ]
             
     if not all_qs: 
         print(f"[RAND] TOTAL FAILURE: No questions found or all are locked.")
@@ -311,8 +361,7 @@ def _get_random_questions(grade, subject=None, count=20):
 def start_multiplayer_generation(bot, telegram_id, subject_code):
     """Generates a 10-question challenge and saves it to the DB."""
     user = get_or_create_user(telegram_id, None, "User")
-    subj_map = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics", "MIXED": None}
-    subject = subj_map.get(subject_code)
+    subject = SUBJ_NAME.get(subject_code)
     
     questions = _get_random_questions(user.current_grade, subject=subject, count=10)
     
@@ -320,7 +369,6 @@ def start_multiplayer_generation(bot, telegram_id, subject_code):
         bot.send_message(chat_id=telegram_id, text="❌ No questions found for this subject/grade combination.")
         return
 
-    from database.crud import create_challenge
     challenge = create_challenge(user.id, subject, user.current_grade, questions)
     
     extra_vars = {
@@ -330,9 +378,7 @@ def start_multiplayer_generation(bot, telegram_id, subject_code):
     
     # Save the challenge ID in both current_param and quiz_state for reliability
     print(f"DEBUG: Generated challenge {challenge.challenge_id}")
-    update_session_state(user.id, screen="SCR_MP_LINK_READY", current_param=challenge.challenge_id, quiz_state={"unit_id": challenge.challenge_id})
-    
-    session = get_or_create_session(user.id)
+    session = update_session_state(user.id, screen="SCR_MP_LINK_READY", current_param=challenge.challenge_id, quiz_state={"unit_id": challenge.challenge_id})
     render_screen(bot, user.id, telegram_id, "SCR_MP_LINK_READY", session.last_message_id, extra_vars)
 
 def handle_mp_share(bot, telegram_id):
@@ -343,7 +389,7 @@ def handle_mp_share(bot, telegram_id):
     # Retrieve challenge ID from current_param or quiz_state
     challenge_id = session.current_param
     if not challenge_id or not str(challenge_id).startswith("CH_"):
-        state = json.loads(session.quiz_state) if session.quiz_state else {}
+        state = _loads(session.quiz_state) if session.quiz_state else {}
         challenge_id = state.get("unit_id")
     
     if not challenge_id:
@@ -362,8 +408,7 @@ def handle_mp_share(bot, telegram_id):
 def start_challenge_session(bot, telegram_id, challenge):
     """Starts a challenge session for a recipient."""
     user = get_or_create_user(telegram_id, None, "User")
-    import json
-    questions = json.loads(challenge["questions_json"])
+    questions = _loads(challenge["questions_json"])
     
     quiz_state = {
         "mode": "CHALLENGE",
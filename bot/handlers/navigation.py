@@ -9,9 +9,11 @@ from database.crud import get_or_create_user, update_session_state, pop_navigati
 from handlers.screen_renderer import render_screen
 
 
-def navigate_to(bot, telegram_id, screen_id, param=None, add_to_stack=True, extra_vars=None):
+def navigate_to(bot, telegram_id, screen_id, param=None, add_to_stack=True, extra_vars=None, clear_nav_stack=False, skip_if_current=False):
     """
     Navigate to a new screen.
+    skip_if_current: return None without rendering when the session already
+    shows this screen/param (repeat taps on tab buttons).
     """
     # Get or create user
     user = get_or_create_user(telegram_id, None, "User")
@@ -19,6 +21,9 @@ def navigate_to(bot, telegram_id, screen_id, param=None, add_to_stack=True, extr
     # Get current session
     session = get_or_create_session(user.id)
     
+    if skip_if_current and not extra_vars and session.current_screen == screen_id and session.current_param == param:
+        return None
+    
     # Merge param into extra_vars if provided
     if extra_vars is None:
         extra_vars = {}
@@ -45,7 +50,8 @@ def navigate_to(bot, telegram_id, screen_id, param=None, add_to_stack=True, extr
         screen=screen_id,
         current_param=param,
         message_id=message.message_id,
-        add_to_nav_stack=add_to_stack
+        add_to_nav_stack=add_to_stack,
+        clear_nav_stack=clear_nav_stack
     )
     
     return message
@@ -74,12 +80,5 @@ def go_home(bot, telegram_id):
     """
     Navigate to hub and clear navigation stack.
     """
-    user = get_or_create_user(telegram_id, None, "User")
-    
-    # Clear navigation stack by updating with empty stack
-    session = get_or_create_session(user.id)
-    update_session_state(user.id, screen="SCR_HUB")
-    session.navigation_stack = "[]"
-    
-    # Navigate to hub
-    return navigate_to(bot, telegram_id, "SCR_HUB", add_to_stack=False)
+    # Stack is cleared in the same write that records the hub as current screen
+    return navigate_to(bot, telegram_id, "SCR_HUB", add_to_stack=False, clear_nav_stack=True)
@@ -1,35 +1,174 @@
-import json
 import time
+import math
 import random
+import bisect
+import itertools
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from database.crud import (
-    get_or_create_user, get_or_create_session, 
-    update_session_state, update_user_streak, add_xp,
-    update_phase_progress, add_to_review_queue, remove_from_review_queue,
-    get_review_queue_items
+    get_request_user, get_or_create_session, 
+    update_session_state, update_user_streak,
+    update_phase_progress, apply_answer_effects,
+    get_review_queue_items, bulk_add_to_review_queue,
+    increment_quiz_index, invalidate_subject_ranks,
+    get_active_locks
 )
 from utils.question_engine import QuestionEngine
+from utils.json_codec import loads as _loads
 from handlers.screen_renderer import render_screen
 from handlers.navigation import navigate_to
-from database.db import SessionLocal
-from database.models import SystemLock
 import handlers.game_handler as gh
+from config import DEFER_REVIEW_QUEUE
+
+# Mapping for shorthand codes to folder names
+SUBJECT_MAP = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
+SUBJECT_CODE = {v: k for k, v in SUBJECT_MAP.items()}
+_OPT_KEYS = ("A", "B", "C", "D")
+
+# Quiz progress bars: _DOT_BARS[bar_length][filled] for every bar length up to 20
+_DOT_BARS = tuple(tuple("●" * f + "○" * (length - f) for f in range(length + 1)) for length in range(21))
+_CHALLENGE_BAR = "━━━━━━━━━━━━━━"
+
+def _parse_grade(grade, default=9):
+    """Grade number from "Grade 10", "10" or 10; falls back to default."""
+    try:
+        return int(str(grade).replace("Grade", "").strip())
+    except (TypeError, ValueError):
+        return default
+
+def _grade_num(quiz_state):
+    """Grade number stored at session start (parsed on the fly for older states)."""
+    g = quiz_state.get("grade_num")
+    return g if g is not None else _parse_grade(quiz_state.get("grade"))
+
+# Parsed quiz_state per user: {user_id: (session.updated_at, state)}
+_STATE_CACHE = {}
+
+def _copy_state(state):
+    """Working copy of a cached quiz_state: handlers change counters and append to history in place."""
+    if "history" in state:
+        return dict(state, history=list(state["history"]))
+    return dict(state)
+
+def _load_quiz_state(session, user_id):
+    """
+    Returns the parsed quiz_state, reusing the cached parse while the session row is unchanged.
+    Callers get a copy, so edits only reach the cache once _save_session (or an
+    equivalent committed write) stores them.
+    """
+    cached = _STATE_CACHE.get(user_id)
+    if cached and cached[0] == session.updated_at:
+        return _copy_state(cached[1])
+    state = _loads(session.quiz_state) if session.quiz_state else {}
+    _STATE_CACHE[user_id] = (session.updated_at, state)
+    return _copy_state(state)
+
+def _save_session(user_id, quiz_state=None, **kwargs):
+    """update_session_state wrapper that keeps _STATE_CACHE in step with the row version."""
+    session = update_session_state(user_id, quiz_state=quiz_state, **kwargs)
+    if quiz_state is not None:
+        _STATE_CACHE[user_id] = (session.updated_at, quiz_state)
+    elif user_id in _STATE_CACHE:
+        # quiz_state untouched (e.g. message_id only), carry the parsed dict forward
+        _STATE_CACHE[user_id] = (session.updated_at, _STATE_CACHE[user_id][1])
+    return session
+
+# Question lists for active quiz sessions, kept out of the persisted quiz_state:
+# {user_id: (unit_id, ref_count, questions)}. The batch itself is stored once per start as
+# [question_id, source_unit] refs in Session.quiz_questions, never rewritten while answering.
+_QUESTION_POOL = {}
+
+def _quiz_display(q):
+    """Question stem followed by the A-D options, as shown on the quiz screens."""
+    # User wanted NO leading dots/indentation for the stem or options
+    opts = q.get("options", {})
+    return q.get("question", "") + "\n\n" + "\n\n".join(f"{k}) {v}" for k in _OPT_KEYS if (v := opts.get(k)) is not None)
+
+def _set_questions(user_id, quiz_state, questions):
+    """
+    Pools the question list in memory and returns the refs to persist in Session.quiz_questions.
+    The list is rewritten in place with copies: the loaded dicts are shared with other callers.
+    """
+    questions[:] = [dict(q, _quiz_display=_quiz_display(q)) for q in questions]
+    _QUESTION_POOL[user_id] = (quiz_state["unit_id"], len(questions), questions)
+    quiz_state["question_count"] = len(questions)
+    return [[q.get("question_id"), q.get("source_unit")] for q in questions]
+
+def _summarize(quiz_state, total):
+    """Returns (correct, incorrect, skipped) for a batch of `total` questions from the running counters."""
+    correct = quiz_state.get("score", 0)
+    skipped = quiz_state.get("skipped_count")
+    if skipped is None:  # states saved before the counter existed
+        skipped = sum(1 for h in quiz_state.get("history", []) if h.get("selected") == "SKIP")
+    # Unanswered questions count as incorrect
+    return correct, total - correct - skipped, skipped
+
+def _flush_review_queue(user_id, quiz_state, questions):
+    """Writes the batch's wrong/skipped answers to the review queue at once (DEFER_REVIEW_QUEUE)."""
+    by_id = {q.get("question_id"): q for q in questions}
+    rows = []
+    for h in quiz_state.get("history", []):
+        if h.get("is_correct"):
+            continue
+        q = by_id.get(h.get("q_id"))
+        if q is None:
+            continue
+        rows.append({
+            "question_id": h["q_id"],
+            "status": "SKIPPED" if h.get("selected") == "SKIP" else "MISTAKE",
+            "subject": quiz_state["subject"],
+            "grade": _grade_num(quiz_state),
+            "unit": q.get("source_unit", quiz_state["unit"])
+        })
+    if rows:
+        bulk_add_to_review_queue(user_id, rows)
+
+def get_quiz_questions(user_id, quiz_state, session=None):
+    """
+    Returns the question list for the active session.
+    Rebuilt from the data files via the stored refs if the pool was lost (e.g. restart).
+    """
+    if "questions" in quiz_state:
+        # Game/Challenge sessions still carry their questions inline
+        return quiz_state["questions"]
+    
+    # States saved before Session.quiz_questions existed carry their refs inline
+    refs = quiz_state.get("question_refs")
+    count = quiz_state.get("question_count", len(refs) if refs else 0)
+    pooled = _QUESTION_POOL.get(user_id)
+    if pooled and pooled[0] == quiz_state.get("unit_id") and pooled[1] == count:
+        return pooled[2]
+    
+    if refs is None:
+        session = session or get_or_create_session(user_id)
+        refs = _loads(session.quiz_questions) if session.quiz_questions else []
+    if not refs:
+        return []
+    
+    found = QuestionEngine.load_questions_by_ids([r[0] for r in refs])
+    questions = []
+    for qid, source_unit in refs:
+        q = found.get(qid)
+        if q is None:
+            # Placeholder keeps later questions at the index the history was built against;
+            # present_question steps over it
+            print(f"[QUIZ] Question {qid} no longer in data, skipping it in this session")
+            questions.append({"question_id": qid, "source_unit": source_unit, "_missing": True})
+            continue
+        # Copy before adding session-only keys, the loaded dict is shared
+        q = dict(q, source_unit=source_unit) if source_unit else dict(q)
+        q["_quiz_display"] = _quiz_display(q)
+        questions.append(q)
+    _QUESTION_POOL[user_id] = (quiz_state.get("unit_id"), len(questions), questions)
+    return questions
 
 def start_quiz_session(bot, telegram_id, subject_code, grade, unit):
     """
     Initializes a new quiz session by loading a batch of questions.
     """
-    # Mapping for shorthand codes to folder names
-    subject_map = {
-        "BIO": "Biology",
-        "CHEM": "Chemistry",
-        "PHYS": "Physics",
-        "MATH": "Mathematics"
-    }
-    subject = subject_map.get(subject_code, subject_code)
+    subject = SUBJECT_MAP.get(subject_code, subject_code)
     
     # Get user with all required fields
-    user = get_or_create_user(telegram_id, None, "User")
+    user = get_request_user(telegram_id)
     session = get_or_create_session(user.id)
     
     # Unit ID for database (e.g. BIO_G10_U1)
@@ -45,61 +184,65 @@ def start_quiz_session(bot, telegram_id, subject_code, grade, unit):
         return
 
     # [FIX] Inject source_unit for better tracking in Review Queue
-    for q in questions:
-        q["source_unit"] = unit
+    # (on copies - the loaded dicts are shared through the unit cache)
+    questions = [dict(q, source_unit=unit) for q in questions]
 
     # Initialize quiz state in session
     quiz_state = {
         "subject_code": subject_code,
         "subject": subject,
         "grade": grade,
+        "grade_num": _parse_grade(grade),
         "unit": unit,
         "unit_title": full_unit_title or unit, 
         "unit_id": unit_id,
-        "questions": questions,
         "current_index": 0,
         "score": 0,
+        "skipped_count": 0,
         "history": []
     }
+    refs = _set_questions(user.id, quiz_state, questions)
     
-    update_session_state(user.id, quiz_state=quiz_state)
+    session = _save_session(user.id, quiz_state=quiz_state, quiz_questions=refs)
     
     # Show first question
-    present_question(bot, telegram_id)
+    present_question(bot, telegram_id, user=user, session=session)
 
-def present_question(bot, telegram_id):
+def present_question(bot, telegram_id, user=None, session=None):
     """
     Renders the current question from the session state.
     """
-    user = get_or_create_user(telegram_id, None, "User")
-    session = get_or_create_session(user.id)
-    quiz_state = json.loads(session.quiz_state) if session.quiz_state else {}
+    user = user or get_request_user(telegram_id)
+    session = session or get_or_create_session(user.id)
+    quiz_state = _load_quiz_state(session, user.id)
     
-    if not quiz_state or "questions" not in quiz_state:
+    if not quiz_state or "current_index" not in quiz_state:
         return navigate_to(bot, telegram_id, "SCR_HUB")
 
     idx = quiz_state["current_index"]
-    questions = quiz_state["questions"]
+    questions = get_quiz_questions(user.id, quiz_state, session)
+    if not questions:
+        return navigate_to(bot, telegram_id, "SCR_HUB")
+    
+    # Step over questions that were removed from the data since the batch started
+    start_idx = idx
+    while idx < len(questions) and questions[idx].get("_missing"):
+        idx += 1
+    if idx != start_idx:
+        quiz_state["current_index"] = idx
+        session = _save_session(user.id, quiz_state=quiz_state)
     
     if idx >= len(questions):
-        return show_quiz_summary(bot, telegram_id)
+        return show_quiz_summary(bot, telegram_id, user=user, session=session)
 
     q = questions[idx]
     
     # Prepare variables for renderer (Match blueprint SCR_QUIZ_PRES)
-    # Extract just the number from "Grade X" if possible
-    grade_num = quiz_state["grade"].split(" ")[1] if " " in quiz_state["grade"] else quiz_state["grade"]
+    grade_num = _grade_num(quiz_state)
     
-    # Construct question body with options
-    q_text = q["question"]
+    # Question body with options (built once when the session's questions were pooled)
     opts = q.get("options", {})
-    options_parts = []
-    for key in ["A", "B", "C", "D"]:
-        if key in opts:
-            options_parts.append(f"{key}) {opts[key]}")
-    
-    # User wanted NO leading dots/indentation for the stem or options
-    question_display = f"{q_text}\n\n" + "\n\n".join(options_parts)
+    question_display = q.get("_quiz_display") or _quiz_display(q)
 
     # Scale progress bar: If 20 or fewer questions, show 1 dot per question. 
     # If more, scale to a fixed 10 dots to prevent screen overflow.
@@ -107,8 +250,7 @@ def present_question(bot, telegram_id):
     bar_length = total if total <= 20 else 10
     
     filled = int(((idx + 1) / total) * bar_length)
-    empty = bar_length - filled
-    dot_bar = "●" * filled + "○" * empty
+    dot_bar = _DOT_BARS[bar_length][filled]
 
     # If it's a Random Quiz, we want to override the header to avoid "Mixed Science - Grade 10" confusion
     # Blueprint: "📖 {subject} - Grade {grade}              {curr_index}/{total_count}\n{unit_title}"
@@ -130,19 +272,22 @@ def present_question(bot, telegram_id):
     }
     
     # Inject option variables for potential dynamic row mapping
-    for key in ["A", "B", "C", "D"]:
+    for key in _OPT_KEYS:
         extra_vars[f"opt_{key.lower()}"] = opts.get(key, "")
     
     # Use different screen for Game Modes if presentation differs
     target_screen = "SCR_QUIZ_PRES"
+    parse_mode = "Markdown"
     if quiz_state.get("mode") == "CHALLENGE":
         target_screen = "SCR_GAME_PRES"
+        parse_mode = "HTML"
+        extra_vars["question_stem"] = gh._display_for(q)
         # Match Game Mode Header Style: "⚔️ {last_fb} | 🏆 {score} | {idx+1}/{total} Qs"
         last_fb = quiz_state.get("last_feedback", "🎮")
         extra_vars["unit_title"] = f"⚔️ {last_fb} | 🏆 {quiz_state['score']} | {idx+1}/{total} Qs"
-        extra_vars["dot_progress_bar"] = "━━━━━━━━━━━━━━"
+        extra_vars["dot_progress_bar"] = _CHALLENGE_BAR
         
-    msg = render_screen(bot, user.id, telegram_id, target_screen, session.last_message_id, extra_vars)
+    msg = render_screen(bot, user.id, telegram_id, target_screen, session.last_message_id, extra_vars, parse_mode=parse_mode)
     
     # [FIX] If Random Quiz, we might need to update the Quit button action in the cache-rendered message
     # BUT render_screen generally handles the layout. The Action "NAV|SCR_UNITS|BACK" is in the blueprint.
@@ -151,15 +296,15 @@ def present_question(bot, telegram_id):
     # Strategy: Let's rely on callback_router to handle "SCR_UNITS|BACK" intelligently.
     
     if msg:
-        update_session_state(user.id, message_id=msg.message_id)
+        _save_session(user.id, message_id=msg.message_id)
 
-def handle_answer_selection(bot, telegram_id, selected_opt):
+def handle_answer_selection(bot, telegram_id, selected_opt, user=None, session=None):
     """
     Processes the user's answer selection.
     """
-    user = get_or_create_user(telegram_id, None, "User")
-    session = get_or_create_session(user.id)
-    quiz_state = json.loads(session.quiz_state) if session.quiz_state else {}
+    user = user or get_request_user(telegram_id)
+    session = session or get_or_create_session(user.id)
+    quiz_state = _load_quiz_state(session, user.id)
     
     if not quiz_state: return
     
@@ -168,44 +313,19 @@ def handle_answer_selection(bot, telegram_id, selected_opt):
         return gh.handle_game_answer(bot, telegram_id, selected_opt)
 
     idx = quiz_state["current_index"]
-    q = quiz_state["questions"][idx]
+    questions = get_quiz_questions(user.id, quiz_state, session)
+    if idx >= len(questions) or questions[idx].get("_missing"):
+        # Stale button: let present_question step forward or show the summary
+        return present_question(bot, telegram_id, user=user, session=session)
+    q = questions[idx]
     correct_opt = q["correct_answer"]
     
     is_correct = (selected_opt == correct_opt)
     
-    # [FIX] Record attempt in database for progress tracking
-    from database.crud import record_quiz_attempt
-    grade_val = 9
-    try:
-        g_raw = str(quiz_state["grade"])
-        grade_val = int(g_raw.split(" ")[1]) if " " in g_raw else int(g_raw)
-    except: pass
+    grade_val = _grade_num(quiz_state)
     
-    record_quiz_attempt(
-        user.id,
-        q.get("source_unit", quiz_state.get("unit_id", "UNKNOWN")),
-        quiz_state["subject"],
-        grade_val,
-        is_correct
-    )
-
     if is_correct:
         quiz_state["score"] += 1
-        add_xp(user.id, 10) # 10 XP per correct answer
-        
-        # Remove from review queue if it exists (Mastery achieved)
-        remove_from_review_queue(user.id, q["question_id"])
-    else:
-        # Add to review queue as MISTAKE
-        # Add to review queue as MISTAKE
-        add_to_review_queue(
-            user_id=user.id,
-            question_id=q["question_id"],
-            status="MISTAKE",
-            subject=quiz_state["subject"],
-            grade=int(quiz_state["grade"].split(" ")[1]) if " " in str(quiz_state["grade"]) else int(quiz_state["grade"]) if str(quiz_state["grade"]).isdigit() else 9,
-            unit=q.get("source_unit", quiz_state["unit"])
-        )
     
     quiz_state["history"].append({
         "q_id": q.get("question_id", f"Q_{idx}"),
@@ -214,7 +334,24 @@ def handle_answer_selection(bot, telegram_id, selected_opt):
         "is_correct": is_correct
     })
     
-    update_session_state(user.id, quiz_state=quiz_state)
+    if quiz_state.get("mode") == "CHALLENGE":
+        # Capture feedback for the next question header (saved with the answer)
+        quiz_state["last_feedback"] = "✅" if is_correct else "❌"
+    
+    # Attempt record, XP (10 per correct answer), review queue (mastered -> removed,
+    # wrong -> MISTAKE) and the new quiz_state are committed together
+    saved = apply_answer_effects(
+        user.id,
+        q["question_id"],
+        quiz_state["subject"],
+        grade_val,
+        q.get("source_unit", quiz_state["unit"]),
+        is_correct,
+        quiz_state=quiz_state,
+        progress_unit_id=q.get("source_unit", quiz_state.get("unit_id", "UNKNOWN")),
+        review_status=None if DEFER_REVIEW_QUEUE else "MISTAKE"
+    )
+    _STATE_CACHE[user.id] = (saved.updated_at, quiz_state)
     
     # Status should be ONLY one:
     status_text = "✅ correct" if is_correct else "❌ incorrect"
@@ -222,17 +359,8 @@ def handle_answer_selection(bot, telegram_id, selected_opt):
     # Textbook explanation with NO indentation
     explanation_body = q.get("explanation", "No explanation available.").strip()
 
-    # Re-construct question display for context
-    q_text = q.get("question", "")
-    opts = q.get("options", {})
-    options_parts = []
-    for key in ["A", "B", "C", "D"]:
-        if key in opts:
-            options_parts.append(f"{key}) {opts[key]}")
-    question_display = f"{q_text}\n\n" + "\n\n".join(options_parts)
-    
-    # Extract grade number for consistent parsing if needed elsewhere
-    grade_val = quiz_state.get("grade", "9").replace("Grade", "").strip()
+    # Question display for context
+    question_display = q.get("_quiz_display") or _quiz_display(q)
 
     extra_vars = {
         "unit_title": quiz_state.get("unit_title", quiz_state["unit"]),
@@ -245,31 +373,31 @@ def handle_answer_selection(bot, telegram_id, selected_opt):
     }
 
     if quiz_state.get("mode") == "CHALLENGE":
-        # Capture feedback for the next question header
-        quiz_state["last_feedback"] = "✅" if is_correct else "❌"
-        update_session_state(user.id, quiz_state=quiz_state)
         # Update current feedback header
-        extra_vars["unit_title"] = f"⚔️ {quiz_state['last_feedback']} | 🏆 {quiz_state['score']} | {idx+1}/{len(quiz_state['questions'])} Qs"
+        extra_vars["unit_title"] = f"⚔️ {quiz_state['last_feedback']} | 🏆 {quiz_state['score']} | {idx+1}/{len(questions)} Qs"
     
     msg = render_screen(bot, user.id, telegram_id, "SCR_QUIZ_FB", session.last_message_id, extra_vars)
     if msg:
-        update_session_state(user.id, message_id=msg.message_id)
+        _save_session(user.id, message_id=msg.message_id)
 
-def skip_question(bot, telegram_id):
+def skip_question(bot, telegram_id, user=None, session=None):
     """Marks current question as skipped and moves to next."""
-    user = get_or_create_user(telegram_id, None, "User")
-    session = get_or_create_session(user.id)
-    quiz_state = json.loads(session.quiz_state) if session.quiz_state else {}
+    user = user or get_request_user(telegram_id)
+    session = session or get_or_create_session(user.id)
+    quiz_state = _load_quiz_state(session, user.id)
     if not quiz_state: return
     
     idx = quiz_state["current_index"]
+    questions = get_quiz_questions(user.id, quiz_state, session)
     
     # [FIX] Crash protection: Ensure index is valid
-    if idx >= len(quiz_state["questions"]):
-        print(f"[SKIP] Index {idx} out of range (max {len(quiz_state['questions'])})")
-        return show_quiz_summary(bot, telegram_id)
+    if idx >= len(questions):
+        print(f"[SKIP] Index {idx} out of range (max {len(questions)})")
+        return show_quiz_summary(bot, telegram_id, user=user, session=session)
+    if questions[idx].get("_missing"):
+        return present_question(bot, telegram_id, user=user, session=session)
         
-    q = quiz_state["questions"][idx]
+    q = questions[idx]
     
     quiz_state["history"].append({
         "q_id": q.get("question_id", f"Q_{idx}"),
@@ -278,42 +406,62 @@ def skip_question(bot, telegram_id):
         "is_correct": False
     })
 
-    # Track as SKIPPED in review queue
-    add_to_review_queue(
-        user_id=user.id,
-        question_id=q["question_id"],
-        status="SKIPPED",
-        subject=quiz_state["subject"],
-        grade=int(quiz_state["grade"].split(" ")[1]) if " " in str(quiz_state["grade"]) else int(quiz_state["grade"]) if str(quiz_state["grade"]).isdigit() else 9,
-        unit=quiz_state["unit"]
-    )
-
     quiz_state["current_index"] += 1
-    update_session_state(user.id, quiz_state=quiz_state)
-    present_question(bot, telegram_id)
+    quiz_state["skipped_count"] = quiz_state.get("skipped_count", 0) + 1
+    
+    # Track as SKIPPED in review queue, saved with the advanced quiz_state
+    saved = apply_answer_effects(
+        user.id,
+        q["question_id"],
+        quiz_state["subject"],
+        _grade_num(quiz_state),
+        quiz_state["unit"],
+        False,
+        quiz_state=quiz_state,
+        review_status=None if DEFER_REVIEW_QUEUE else "SKIPPED"
+    )
+    _STATE_CACHE[user.id] = (saved.updated_at, quiz_state)
+    present_question(bot, telegram_id, user=user, session=saved)
 
-def next_question(bot, telegram_id):
+def next_question(bot, telegram_id, user=None, session=None):
     """Transitions to the next question in the batch."""
-    user = get_or_create_user(telegram_id, None, "User")
-    session = get_or_create_session(user.id)
-    quiz_state = json.loads(session.quiz_state) if session.quiz_state else {}
+    user = user or get_request_user(telegram_id)
+    session = session or get_or_create_session(user.id)
+    quiz_state = _load_quiz_state(session, user.id)
     if not quiz_state: return
     quiz_state["current_index"] += 1
-    update_session_state(user.id, quiz_state=quiz_state)
-    present_question(bot, telegram_id)
+    # Only the index changes: bump it in the DB instead of rewriting the whole state
+    stamp = increment_quiz_index(user.id)
+    if stamp is None:
+        session = _save_session(user.id, quiz_state=quiz_state)
+    else:
+        _STATE_CACHE[user.id] = (stamp, quiz_state)
+        session = None
+    present_question(bot, telegram_id, user=user, session=session)
 
-def show_quiz_summary(bot, telegram_id):
+def show_quiz_summary(bot, telegram_id, user=None, session=None):
     """Shows the final summary screen for the quiz batch."""
-    user = get_or_create_user(telegram_id, None, "User")
-    session = get_or_create_session(user.id)
-    quiz_state = json.loads(session.quiz_state) if session.quiz_state else {}
+    user = user or get_request_user(telegram_id)
+    session = session or get_or_create_session(user.id)
+    quiz_state = _load_quiz_state(session, user.id)
     if not quiz_state: return
     
+    questions = get_quiz_questions(user.id, quiz_state, session)
+    if DEFER_REVIEW_QUEUE and not quiz_state.get("review_flushed"):
+        _flush_review_queue(user.id, quiz_state, questions)
+        # Re-rendering the summary must not rewrite (and re-stamp) the same review rows
+        quiz_state["review_flushed"] = True
+        session = _save_session(user.id, quiz_state=quiz_state)
+    
     # Handle Game Mode Summaries
     if quiz_state.get("mode") == "CHALLENGE":
         return gh.show_game_summary(bot, telegram_id, "🏁 Shared Practice Completed!")
 
-    accuracy = (quiz_state["score"] / len(quiz_state["questions"])) * 100
+    # Questions removed from the data mid-batch were never shown, so they don't count
+    total = sum(1 for q in questions if not q.get("_missing"))
+    if not total: return
+    correct, incorrect, skipped = _summarize(quiz_state, total)
+    accuracy = (correct / total) * 100
     
     phase_data = {
         "BASELINE": {"num": "1", "name": "Initial Assessment", "bar": "🟢🟢⚪⚪⚪⚪⚪⚪⚪⚪"},
@@ -327,11 +475,12 @@ def show_quiz_summary(bot, telegram_id):
     update_phase_progress(
         user_id=user.id, unit_id=quiz_state["unit_id"],
         subject=quiz_state["subject"], 
-        grade=int(quiz_state["grade"].split(" ")[1]) if "Grade" in quiz_state["grade"] else 9, 
+        grade=_grade_num(quiz_state), 
         phase=curr_phase_str, accuracy=accuracy
     )
     update_user_streak(user.id)
-    skipped = len([h for h in quiz_state["history"] if h.get("selected") == "SKIP"])
+    # Batch finished: let the stats screen rank this subject from fresh totals
+    invalidate_subject_ranks(None if quiz_state.get("subject_code") == "MIXED" else quiz_state["subject"])
     xp_gained = int(accuracy / 10) * 10
     
     # Extract unit number for "THE END OF UNIT X" header
@@ -341,8 +490,8 @@ def show_quiz_summary(bot, telegram_id):
     extra_vars = {
         "unit_title": quiz_state.get("unit_title", quiz_state["unit"]),
         "unit_num": unit_num,
-        "correct_count": quiz_state["score"],
-        "incorrect_count": len(quiz_state["questions"]) - quiz_state["score"] - skipped,
+        "correct_count": correct,
+        "incorrect_count": incorrect,
         "skipped_count": skipped,
         "accuracy_percentage": int(accuracy),
         "streak": user.streak_count,
@@ -359,15 +508,15 @@ def show_quiz_summary(bot, telegram_id):
     elif quiz_state.get("unit") == "Random Quiz":
         target_screen = "SCR_RANDOM_SUM"
         # Ensure 'grade' is just the number for the button param
-        extra_vars["grade"] = str(quiz_state.get("grade", "9")).replace("Grade", "").strip()
+        extra_vars["grade"] = str(_grade_num(quiz_state))
         
     render_screen(bot, user.id, telegram_id, target_screen, session.last_message_id, extra_vars)
 
 def start_next_part(bot, telegram_id):
     """Transitions to the next review part."""
-    user = get_or_create_user(telegram_id, None, "User")
+    user = get_request_user(telegram_id)
     session = get_or_create_session(user.id)
-    quiz_state = json.loads(session.quiz_state) if session.quiz_state else {}
+    quiz_state = _load_quiz_state(session, user.id)
     if not quiz_state: return
     
     uid = quiz_state.get("unit_id", "")
@@ -377,27 +526,28 @@ def start_next_part(bot, telegram_id):
             return start_review_session(bot, telegram_id, quiz_state["subject_code"], quiz_state["grade"], section_num=part_num+1)
             
     # If no next part, go to review hub
-    from handlers.navigation import navigate_to
     navigate_to(bot, telegram_id, "SCR_REVIEW_HUB", add_to_stack=False)
 
 def replay_batch(bot, telegram_id):
     """Resets the current quiz session to the beginning."""
-    user = get_or_create_user(telegram_id, None, "User")
+    user = get_request_user(telegram_id)
     session = get_or_create_session(user.id)
-    quiz_state = json.loads(session.quiz_state) if session.quiz_state else {}
+    quiz_state = _load_quiz_state(session, user.id)
     if not quiz_state: return
     
     quiz_state["current_index"] = 0
     quiz_state["score"] = 0
+    quiz_state["skipped_count"] = 0
     quiz_state["history"] = []
-    update_session_state(user.id, quiz_state=quiz_state)
-    present_question(bot, telegram_id)
+    quiz_state.pop("review_flushed", None)
+    session = _save_session(user.id, quiz_state=quiz_state)
+    present_question(bot, telegram_id, user=user, session=session)
 
 def start_next_batch(bot, telegram_id):
     """Loads the next unit or round for the user."""
-    user = get_or_create_user(telegram_id, None, "User")
+    user = get_request_user(telegram_id)
     session = get_or_create_session(user.id)
-    quiz_state = json.loads(session.quiz_state) if session.quiz_state else {}
+    quiz_state = _load_quiz_state(session, user.id)
     if not quiz_state: return
     
     subject = quiz_state["subject"]
@@ -423,9 +573,8 @@ def start_review_session(bot, telegram_id, subject_code, grade, section_num=1):
     Initializes a review session by loading questions from a subset of units (1/3 of the total).
     The questions within the section are randomized.
     """
-    subject_map = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
-    subject = subject_map.get(subject_code, subject_code)
-    user = get_or_create_user(telegram_id, None, "User")
+    subject = SUBJECT_MAP.get(subject_code, subject_code)
+    user = get_request_user(telegram_id)
     
     # 1. Get all units for this grade
     units = QuestionEngine.list_units(subject, grade)
@@ -434,7 +583,6 @@ def start_review_session(bot, telegram_id, subject_code, grade, section_num=1):
         return
 
     # 2. Divide units into 3 sections
-    import math
     num_units = len(units)
     chunk_size = math.ceil(num_units / 3)
     
@@ -451,19 +599,8 @@ def start_review_session(bot, telegram_id, subject_code, grade, section_num=1):
         return
 
     # 3. Collect questions from the targeted units (Respecting Locks)
-    from database.models import SystemLock
-    from database.crud import SessionLocal
-    db = SessionLocal()
-    
-    # Fetch active unit locks for this subject/grade
     grade_val = grade.replace("Grade ", "").strip()
-    unit_locks = db.query(SystemLock.lock_target).filter(
-        SystemLock.lock_type == "UNIT",
-        SystemLock.is_locked == True,
-        SystemLock.lock_target.like(f"{subject_code}_G{grade_val}_U%")
-    ).all()
-    locked_unit_ids = [l[0] for l in unit_locks]
-    db.close()
+    locked_unit_ids = get_active_locks().get("UNIT", set())
 
     all_questions = []
     for u in target_units:
@@ -482,34 +619,37 @@ def start_review_session(bot, telegram_id, subject_code, grade, section_num=1):
         return
 
     # 4. Shuffle questions for a randomized experience
-    import random
     random.shuffle(all_questions)
     
     quiz_state = {
         "subject_code": subject_code,
         "subject": subject,
         "grade": grade,
+        "grade_num": _parse_grade(grade),
         "unit": f"Review Part {section_num}",
         "unit_title": f"Review {subject}: Part {section_num}", 
         "unit_id": f"{subject_code}_{grade.replace(' ', '')}_REV_P{section_num}",
-        "questions": all_questions,
         "current_index": 0,
         "score": 0,
+        "skipped_count": 0,
         "history": []
     }
+    refs = _set_questions(user.id, quiz_state, all_questions)
     
-    update_session_state(user.id, quiz_state=quiz_state)
-    present_question(bot, telegram_id)
+    session = _save_session(user.id, quiz_state=quiz_state, quiz_questions=refs)
+    present_question(bot, telegram_id, user=user, session=session)
 
-def show_hint(bot, telegram_id, query):
+def show_hint(bot, telegram_id, query, user=None, session=None):
     """Displays the hint for the current question."""
-    user = get_or_create_user(telegram_id, None, "User")
-    session = get_or_create_session(user.id)
-    quiz_state = json.loads(session.quiz_state) if session.quiz_state else {}
+    user = user or get_request_user(telegram_id)
+    session = session or get_or_create_session(user.id)
+    quiz_state = _load_quiz_state(session, user.id)
     if not quiz_state: return
     
     idx = quiz_state["current_index"]
-    q = quiz_state["questions"][idx]
+    questions = get_quiz_questions(user.id, quiz_state, session)
+    if idx >= len(questions): return
+    q = questions[idx]
     hint = q.get("hint") or q.get("explanation", "")[:100] + "..."
     if not hint:
         hint = "Focus on the core concept of the unit."
@@ -520,12 +660,11 @@ def start_smart_review(bot, telegram_id, subject_code, grade, review_type):
     """
     Starts a review session based on 'SKIPPED' or 'MISTAKE' items.
     """
-    subject_map = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
-    subject = subject_map.get(subject_code, subject_code)
-    user = get_or_create_user(telegram_id, None, "User")
+    subject = SUBJECT_MAP.get(subject_code, subject_code)
+    user = get_request_user(telegram_id)
     
     # 1. Get items from DB
-    items = get_review_queue_items(user.id, review_type, subject=subject, grade=int(grade.split(" ")[1]) if " " in grade else 9)
+    items = get_review_queue_items(user.id, review_type, subject=subject, grade=_parse_grade(grade))
     if not items:
         bot.send_message(chat_id=telegram_id, text=f"You have no {review_type.lower()} questions to review for {subject} {grade}! Great job!")
         return
@@ -539,37 +678,34 @@ def start_smart_review(bot, telegram_id, subject_code, grade, review_type):
         
     # 4. Load Questions Match Logic
     final_questions = []
-    
-    # Cache list of units to avoid repeated I/O if we need to scan
-    cached_all_units = []
+    missing_ids = []
 
     for unit_name, q_ids in unit_map.items():
         # [FIX] Smart Unit Loading
         # 1. Try to load from the stored unit name first
         unit_qs, _, _ = QuestionEngine.load_unit_questions(subject, grade, unit_name)
         
-        found_in_unit = False
+        wanted = set(q_ids)
+        found = set()
         for q in unit_qs:
-            if q.get("question_id") in q_ids:
+            if q.get("question_id") in wanted:
                 final_questions.append(q)
-                found_in_unit = True
+                found.add(q.get("question_id"))
+        missing_ids.extend(qid for qid in q_ids if qid not in found)
         
-        # 2. If not found (e.g. question moved, or stored unit name was generic "Random Quiz"), SCAN ALL
-        if not found_in_unit and q_ids:
-             print(f"[SMART_REVIEW] Warning: Questions {q_ids} not found in '{unit_name}'. Scanning all units...")
-             
-             if not cached_all_units:
-                 cached_all_units = QuestionEngine.list_units(subject, grade)
-                 
-             for u in cached_all_units:
-                 if u == unit_name: continue # Already checked above
-                 
-                 qs, _, _ = QuestionEngine.load_unit_questions(subject, grade, u)
-                 for q in qs:
-                     if q.get("question_id") in q_ids:
-                         final_questions.append(q)
-                         # Optimization: If we found all needed for this batch, break inner loop? 
-                         # No, q_ids might be scattered. Just continue.
+    # 2. Not in the stored unit (e.g. question moved, or stored unit name was generic "Random Quiz"):
+    #    resolve through the global question index and load only the units that hold them
+    if missing_ids:
+        print(f"[SMART_REVIEW] Warning: {len(missing_ids)} questions not found in their stored unit. Using question index...")
+        index = QuestionEngine.question_index()
+        by_unit = {}
+        for qid in missing_ids:
+            location = index.get(qid)
+            if location:
+                by_unit.setdefault(location, set()).add(qid)
+        for location, ids in by_unit.items():
+            qs, _, _ = QuestionEngine.load_unit_questions(*location)
+            final_questions.extend(q for q in qs if q.get("question_id") in ids)
 
     if not final_questions:
         bot.send_message(chat_id=telegram_id, text="Error: Could not load question data. Please contact admin.")
@@ -583,37 +719,32 @@ def start_smart_review(bot, telegram_id, subject_code, grade, review_type):
         "subject_code": subject_code,
         "subject": subject,
         "grade": grade,
+        "grade_num": _parse_grade(grade),
         "unit": f"Smart Review ({review_type})",
         "unit_title": f"Review: {review_type.title()} Questions", 
         "unit_id": f"{subject_code}_{grade.replace(' ', '')}_SMART_{review_type}",
-        "questions": final_questions,
         "current_index": 0,
         "score": 0,
+        "skipped_count": 0,
         "history": []
     }
+    refs = _set_questions(user.id, quiz_state, final_questions)
     
-    update_session_state(user.id, quiz_state=quiz_state)
-    present_question(bot, telegram_id)
+    session = _save_session(user.id, quiz_state=quiz_state, quiz_questions=refs)
+    present_question(bot, telegram_id, user=user, session=session)
 
 def start_random_quiz(bot, telegram_id, grade=None):
     """
     Starts a random quiz using 10 questions from the user's current grade across all subjects.
     Selections are randomized from 2 units per subject to ensure variety.
     """
-    user = get_or_create_user(telegram_id, None, "User")
+    user = get_request_user(telegram_id)
     # Handle case where user might not have a grade set (default to 9)
     # If grade param is provided (str or int), use it, otherwise fallback to user profile
     current_grade = user.current_grade if user.current_grade else 9
     if grade:
-        try:
-            # Handle inputs like "Grade 9" or just "9"
-            clean_grade = str(grade).replace("Grade", "").strip()
-            current_grade = int(clean_grade)
-        except:
-            if hasattr(user, 'current_grade'): 
-                current_grade = user.current_grade
-            else:
-                current_grade = 9
+        # Handle inputs like "Grade 9" or just "9"
+        current_grade = _parse_grade(grade, default=current_grade)
 
     grade_str = f"Grade {current_grade}"
     print(f"[RAND] Starting Random Quiz for {grade_str} (Param: {grade})")
@@ -623,15 +754,13 @@ def start_random_quiz(bot, telegram_id, grade=None):
     final_subject = "Review" # Will appear as "Review - Grade 12"
     
     subjects = ["Biology", "Chemistry", "Physics", "Mathematics"]
-    all_questions = []
-    
-    # 1. Gather questions from random units per subject (Respecting Locks)
-    db = SessionLocal()
-    locks = db.query(SystemLock).filter(SystemLock.is_locked == True).all()
+    candidates = []  # (subject, unit, question_count)
     
-    locked_subjects = [l.lock_target.split(":")[0] for l in locks if l.lock_type == "SUBJECT" and f":{current_grade}" in l.lock_target]
-    locked_units = [l.lock_target for l in locks if l.lock_type == "UNIT"]
-    db.close()
+    # 1. Pick random units per subject (Respecting Locks)
+    locks = get_active_locks()
+    grade_suffix = f":{current_grade}"
+    locked_subjects = {t.split(":")[0] for t in locks.get("SUBJECT", ()) if t.endswith(grade_suffix)}
+    locked_units = locks.get("UNIT", set())
     
     for subj in subjects:
         # Skip locked subjects
@@ -642,49 +771,58 @@ def start_random_quiz(bot, telegram_id, grade=None):
         units = QuestionEngine.list_units(subj, grade_str)
         if not units: continue
             
-        random.shuffle(units)
         # Select up to 2 units per subject for variety
-        selected_units = units[:2]
+        selected_units = random.sample(units, min(2, len(units)))
         
         for u in selected_units:
             # Check unit lock
             u_num = u.split(" ")[1] if " " in u else u
-            sub_code = {"Biology": "BIO", "Chemistry": "CHEM", "Physics": "PHYS", "Mathematics": "MATH"}.get(subj, subj)
+            sub_code = SUBJECT_CODE.get(subj, subj)
             unit_id = f"{sub_code}_G{current_grade}_U{u_num}"
             
             if unit_id in locked_units:
                 print(f"[RANDOM] Skipping locked unit: {unit_id}")
                 continue
 
-            qs, _, _ = QuestionEngine.load_unit_questions(subj, grade_str, u)
-            if qs:
-                # [FIX] Inject Source Unit for Smart Review
-                for q in qs:
-                    q["source_unit"] = u
-                all_questions.extend(qs)
+            size = QuestionEngine.unit_size(subj, grade_str, u)
+            if size:
+                candidates.append((subj, u, size))
                 
-    if not all_questions:
+    offsets = list(itertools.accumulate(c[2] for c in candidates))
+    pool_size = offsets[-1] if offsets else 0
+    if not pool_size:
         bot.send_message(chat_id=telegram_id, text=f"❌ No questions found for {grade_str}. Please try another grade.")
         return
 
-    # 2. Select 10 random questions from the pool
-    random.shuffle(all_questions)
-    selected_questions = all_questions[:10]
+    # 2. Select 10 random (unit, question index) slots across the combined pool,
+    #    then copy only those questions
+    unit_questions = {}
+    selected_questions = []
+    for pick in random.sample(range(pool_size), min(10, pool_size)):
+        i = bisect.bisect_right(offsets, pick)
+        subj, u, _ = candidates[i]
+        if i not in unit_questions:
+            unit_questions[i] = QuestionEngine.load_unit_questions(subj, grade_str, u)[0]
+        q = unit_questions[i][pick - (offsets[i - 1] if i else 0)]
+        # [FIX] Inject Source Unit for Smart Review (copies, dicts are cached)
+        selected_questions.append(dict(q, source_unit=u))
     
     # 3. Initialize Session
     quiz_state = {
         "subject_code": "MIXED",
         "subject": "Review", # Shows as "📖 Review - Grade X"
         "grade": grade_str,
+        "grade_num": current_grade,
         "unit": "Random Quiz",
         "unit_title": f"⚡ Random Quiz (Grade {current_grade})", 
         "unit_id": f"RANDOM_{grade_str.replace(' ', '')}_{int(time.time())}",
-        "questions": selected_questions,
         "current_index": 0,
         "score": 0,
+        "skipped_count": 0,
         "history": []
     }
+    refs = _set_questions(user.id, quiz_state, selected_questions)
     
-    update_session_state(user.id, quiz_state=quiz_state)
-    present_question(bot, telegram_id)
+    session = _save_session(user.id, quiz_state=quiz_state, quiz_questions=refs)
+    present_question(bot, telegram_id, user=user, session=session)
 
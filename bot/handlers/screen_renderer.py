@@ -2,32 +2,203 @@
 Screen renderer - converts blueprint screens to Telegram messages
 """
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-import json
+import bisect
+import html
+import logging
+import random
+import re
 import sys
 import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import case
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
+from config import ADMIN_IDS
 from utils.blueprint_loader import get_screen
-from database.crud import get_or_create_user, get_review_queue_counts, get_all_user_progress, get_leaderboard, get_weekly_leaderboard
+from utils.json_codec import loads as _loads
+from utils.question_engine import QuestionEngine
+from database.crud import get_or_create_user, get_or_create_session, get_review_queue_counts, get_all_user_progress, get_leaderboard_with_rank, get_subject_rank_map, get_admin_totals, get_locked_units, get_locks_bulk, get_active_locks
 from database.db import SessionLocal
-from database.models import User as UserModel, SystemLock
+from database.models import Challenge as ChallengeModel, FlaggedQuestion
 from utils.translations import TRANSLATIONS
 
+logger = logging.getLogger(__name__)
 
-def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None, progress_records=None):
+# {placeholder} tokens filled by apply_replacements in a single pass
+PLACEHOLDER_RE = re.compile(r"\{[a-zA-Z_][a-zA-Z0-9_]*\}")
+
+SUBJECT_NAMES = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
+# Admin lock screens: toggleable features and grade tabs
+_LOCKABLE_FEATURES = ("ADVANCED_PRACTICE", "REVIEW_HUB", "PDFS_AND_FILES", "LEADERBOARD", "PRACTICE_WITH_FRIENDS", "SEARCH")
+_GRADE_TABS = ("9", "10", "11", "12")
+# (placeholder prefix, subject) for the STATS screen bars
+_STATS_SUBJECTS = (("bio", "Biology"), ("chem", "Chemistry"), ("phys", "Physics"), ("math", "Mathematics"))
+
+# Rank name by level: the last threshold <= level wins (bisect lookup)
+_RANK_THRESHOLDS = (1, 5, 10, 20, 50)
+_RANK_NAMES = ("Novice", "Apprentice", "Scholar", "Sage", "Master")
+
+_TIPS = (
+    "Consistency is key! Regular practice leads to better results.",
+    "Review your mistakes to strengthen your understanding.",
+    "Collaborate with a friend to stay motivated!",
+    "Try Timed Practice to build your exam-day speed.",
+    "Check the Leaderboard to see your academic standing!",
+    "Master the difficult units to boost your knowledge level.",
+    "Academic mastery takes time. Keep practicing!",
+    "Biology requires memorization; focus on key terms!",
+    "Physics is about understanding concepts, not just formulas.",
+    "Chemistry reactions follow logical patterns. Study the trends!",
+    "Practice regularly to improve your recall and problem-solving skills.",
+    "Don't be afraid to ask for help when you're stuck on a concept.",
+    "Break down complex topics into smaller, manageable parts.",
+    "Set clear academic goals to stay focused and motivated.",
+    "Review past questions to identify areas for improvement.",
+)
+
+# {(telegram_id, screen_id): monotonic time} of renders whose Markdown/HTML Telegram rejected;
+# those are sent as plain text for PLAIN_TEXT_TTL seconds instead of failing first every time
+PLAIN_TEXT_TTL = 300
+_PLAIN_TEXT_RENDERS = {}
+
+# Payload hash last shown in each message {(telegram_id, message_id): hash}, least recently rendered first
+LAST_RENDER_MAX = 4096
+_LAST_RENDER = OrderedDict()
+
+# Default placeholders whose values are user-controlled text (escaped for the parse mode)
+_ESCAPED_KEYS = ("{user_name}", "{level_rank}", "{rank}", "{best_subject}", "{subject_name}", "{subject}")
+
+# Most-flagged questions listed on SCR_ADMIN_FLAGS
+ADMIN_FLAGS_LIMIT = 50
+
+# Markdown (v1) special characters escaped in user-provided values, in one translate pass
+_MD_ESCAPE = str.maketrans({"*": "\\*", "_": "\\_", "`": "\\`"})
+
+# Blueprint button label -> TRANSLATIONS key for the translation pass
+_LABEL_KEYS = {
+    "🚀 Start Practice": "START_PRACTICE",
+    "⚙️ Set Up Profile": "SETUP_PROFILE",
+    "🎓 Start Practice Hub": "START_PRACTICE_HUB",
+    "🔍 Advanced Practice": "ADVANCED_PRACTICE",
+    "💬 Practice with Friends": "PRACTICE_WITH_FRIENDS",
+    "📊 My Progress": "PROGRESS",
+    "🏆 Leaderboard": "LEADERBOARD",
+    "⚡ Random Quiz": "RANDOM_QUIZ",
+    "⚙️ Settings": "SETTINGS_HUB",
+    "❓ Help": "HELP_HUB",
+    "🛠️ Admin Dashboard": "ADMIN_HUB",
+    "🧬 Biology": "BIO", "🧪 Chemistry": "CHEM", "⚛️ Physics": "PHYS", "📐 Mathematics": "MATH",
+    "📊 Academic Progress": "ACADEMIC_PROGRESS", "🏠 Home": "HOME_LABEL",
+    "🔙 Back to Subjects": "BACK_LABEL", "🔙 Back to Settings": "BACK_LABEL",
+    "🔙 Back to Grades": "BACK_LABEL", "🔙 Back to Units": "BACK_LABEL",
+    "🔙 Back to Arena": "BACK_LABEL", "🔙 Back to Admin": "BACK_LABEL",
+    "🌐 Language: {current_lang}": "LANG_LABEL",
+    "🔔 Notifications: {notif_status}": "NOTIF_LABEL",
+    "🧹 Reset Progress": "RESET_LABEL", "👤 Profile": "PROFILE_LABEL",
+    "⚡ Review All Units": "REVIEW_ALL",
+    "📂 Unit Study Guides": "DOWNLOAD_PDFS",
+    "📂 PDFs & Files": "DOWNLOAD_PDFS", # Fallback
+    "⚡ Review: Part 1": "REVIEW_P1",
+    "⚡ Review: Part 2": "REVIEW_P2",
+    "⚡ Review: Part 3": "REVIEW_P3",
+    "🔄 Restart Unit": "RESTART_UNIT",
+    "➡️ Next Unit": "NEXT_UNIT",
+    "🔄 Restart Part": "RESTART_PART",
+    "➡️ Next Part": "NEXT_PART"
+}
+# {lang: {label: (key, translated template)}}, filled on first use of each language
+_TRANSLATED_LABELS = {}
+# Translated template -> its pieces around "{count}", split once per distinct template
+_COUNT_PARTS = {}
+
+
+def _label_template(lang, lbl, dynamic_labels=None):
+    """
+    (TRANSLATIONS key, template) for a layout label in lang, or None when the label stays as-is.
+    dynamic_labels maps labels generated during this render (e.g. review buttons with counts) to their keys.
+    """
+    table = TRANSLATIONS.get(lang)
+    if not table:
+        return None
+    if dynamic_labels and lbl in dynamic_labels:
+        t_key = dynamic_labels[lbl]
+        return (t_key, table[t_key]) if t_key in table else None
+    labels = _TRANSLATED_LABELS.get(lang)
+    if labels is None:
+        labels = _TRANSLATED_LABELS[lang] = {l: (k, table[k]) for l, k in _LABEL_KEYS.items() if k in table}
+    return labels.get(lbl)
+
+
+# Every bar the screens draw, keyed by (length, filled blocks)
+_BAR_CACHE = {(L, f): "▰" * f + "▱" * (L - f) for L in (8, 10, 12) for f in range(L + 1)}
+
+
+def create_progress_bar(perc, length=10):
+    """Creates a professional block-based progress bar."""
+    filled = 1 if 0 < perc < 100 / length else int(perc * length / 100)  # At least one block if started
+    filled = max(0, min(length, filled))
+    bar = _BAR_CACHE.get((length, filled))
+    return bar if bar is not None else "▰" * filled + "▱" * (length - filled)
+
+
+def _needs_replacements(text, extra_vars=None):
+    """False for plain text/labels that neither carry placeholders nor get grade/duration highlighting."""
+    return "{" in text or text.startswith("🎓 G") or bool(extra_vars and (" min" in text or " Qs" in text))
+
+
+def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None, progress_records=None, parse_mode="Markdown", db=None):
     """
     Replace variables in text with actual values and handle translations.
     """
+    if not _needs_replacements(text, extra_vars):
+        return text
+    replacements, active_grade = compute_replacements(user_id, telegram_id, extra_vars, user_obj=user_obj, progress_records=progress_records, parse_mode=parse_mode, db=db)
+    return apply_replacements(text, replacements, active_grade, extra_vars)
+
+
+def _escape_value(val, parse_mode):
+    """Escapes a user-supplied value for the message's parse mode."""
+    if not val or not isinstance(val, str): return str(val)
+    # HTML screens only need &, <, > escaped
+    if parse_mode == "HTML": return html.escape(val, quote=False)
+    return val.translate(_MD_ESCAPE)
+
+
+def _escaped_map(base, raw, parse_mode):
+    """The base replacement map with its user-supplied (raw) values escaped for parse_mode."""
+    replacements = dict(base)
+    for key, val in raw.items():
+        replacements[key] = _escape_value(val, parse_mode)
+    return replacements
+
+
+def compute_replacements(user_id, telegram_id, extra_vars=None, user_obj=None, progress_records=None, parse_mode="Markdown", db=None):
+    """
+    Builds the {placeholder: value} map for one render (DB lookups, badges, ranks, leaderboard).
+    Returns (replacements, active_grade); compute once per screen and reuse for every label.
+    db: optional session to run the lookups on (render_screen passes its own).
+    """
+    base, active_grade, raw = _build_replacements(user_id, telegram_id, extra_vars, user_obj, progress_records, db)
+    return _escaped_map(base, raw, parse_mode), active_grade
+
+
+def _build_replacements(user_id, telegram_id, extra_vars, user_obj, progress_records, db):
+    """
+    compute_replacements without the escaping: returns (replacements, active_grade, raw), where raw
+    holds the user-supplied values still to be escaped, so one build serves Markdown and HTML.
+    """
     
     # Get user from database if not provided
     if user_obj is None:
-        user = get_or_create_user(telegram_id, None, "User")
+        user = get_or_create_user(telegram_id, None, "User", db=db)
     else:
         user = user_obj
         
     # Calculate global progress if not provided
     if progress_records is None:
-        progress_records = get_all_user_progress(user.id)
+        progress_records = get_all_user_progress(user.id, db=db)
     if progress_records is None: progress_records = []
 
     # Active Grade Logic
@@ -36,44 +207,40 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
         try: active_grade = int(str(extra_vars["view_grade"]))
         except: pass
 
+    # One pass over the records: ACTIVE grade mastery, per-subject completion (stats bars),
+    # per-subject correct answers (best subject) and the global completion sum
+    active_progress = []
+    active_completion = 0
+    subject_completion = {}  # {subject: [completion_sum, count]}
+    subject_stats = {}
+    global_completion = 0
+    for p in progress_records:
+        global_completion += p.completion_percent
+        if p.grade != active_grade:
+            continue
+        active_progress.append(p)
+        active_completion += p.completion_percent
+        bucket = subject_completion.setdefault(p.subject, [0, 0])
+        bucket[0] += p.completion_percent
+        bucket[1] += 1
+        subject_stats[p.subject] = subject_stats.get(p.subject, 0) + p.questions_correct
+    
     # Calculate mastery for ACTIVE grade
-    active_progress = [p for p in progress_records if p.grade == active_grade]
-    total_mastery = 0
-    if active_progress:
-        total_mastery = sum(p.completion_percent for p in active_progress) / len(active_progress)
+    total_mastery = active_completion / len(active_progress) if active_progress else 0
     
     # Calculate Best Subject for ACTIVE grade
-    subject_stats = {}
-    for p in active_progress:
-        subject_stats[p.subject] = subject_stats.get(p.subject, 0) + p.questions_correct
     best_sub = max(subject_stats, key=subject_stats.get) if subject_stats else "N/A"
     
     # Calculate Badges (Global)
     badges = []
     if user.level >= 5: badges.append("🥇 High Achiever")
     if user.streak_count >= 7: badges.append("🔥 7-Day Streak")
-    global_mastery = sum(p.completion_percent for p in progress_records) / len(progress_records) if progress_records else 0
+    global_mastery = global_completion / len(progress_records) if progress_records else 0
     if global_mastery >= 90: badges.append("🏆 Mastery Expert")
     if not badges: badges = ["No medals yet."]
     
     # Rank names
-    ranks = {1: "Novice", 5: "Apprentice", 10: "Scholar", 20: "Sage", 50: "Master"}
-    rank_name = "Novice"
-    for lvl, name in sorted(ranks.items(), reverse=True):
-        if user.level >= lvl:
-            rank_name = name
-            break
-
-    def escape_md(val):
-        if not val or not isinstance(val, str): return str(val)
-        return val.replace("*", "\\*").replace("_", "\\_").replace("`", "\\`")
-
-    def create_progress_bar(perc, length=10):
-        """Creates a professional block-based progress bar."""
-        filled = int((perc / 100) * length)
-        if perc > 0 and filled == 0:
-            filled = 1 # Show at least one block if started
-        return "▰" * filled + "▱" * (length - filled)
+    rank_name = _RANK_NAMES[max(0, bisect.bisect_right(_RANK_THRESHOLDS, user.level) - 1)]
 
     # Unit Breakdown & Subject Audit for SCR_STATS_DETAIL (Uses active_grade)
     unit_break_list = "No units practiced yet."
@@ -82,10 +249,9 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
     
     if extra_vars and "subject" in extra_vars:
         sub_code = extra_vars["subject"]
-        sub_full = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}.get(sub_code, sub_code)
+        sub_full = SUBJECT_NAMES.get(sub_code, sub_code)
         
         # 1. Fetch ALL units for the ACTIVE Grade & Subject
-        from utils.question_engine import QuestionEngine
         all_units = QuestionEngine.list_units(sub_full, f"Grade {active_grade}")
         
         # Robust helper to extract unit number from various ID formats
@@ -103,7 +269,12 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
              return u_string
 
         # 2. Match progress (Filter by active_grade)
-        relevant_dict = {get_unit_num(p.unit_id): p for p in active_progress if p.subject == sub_full}
+        relevant_dict = {}  # unit number -> progress
+        by_unit_id = {}  # raw unit_id -> progress (first match wins)
+        for p in active_progress:
+            if p.subject == sub_full:
+                relevant_dict[get_unit_num(p.unit_id)] = p
+                by_unit_id.setdefault(p.unit_id, p)
         
         if all_units:
             count_mastered = 0
@@ -116,7 +287,7 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
                 # Fallback: check if unit title matches key if mapped poorly
                 if not p:
                     # Sometimes unit_id IS the title "Unit 1: Intro"
-                    p = next((p for p in active_progress if p.subject == sub_full and p.unit_id == u), None)
+                    p = by_unit_id.get(u)
                 
                 u_perc = int(p.completion_percent) if p else 0
                 u_bar = create_progress_bar(u_perc, length=8)
@@ -127,20 +298,10 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
             unit_break_list = "\n".join(lines)
             subject_coverage = f"{count_mastered}/{len(all_units)} Units Mastered"
             
-            # 3. Calculate Subject Rank (Global comparison in this sub)
-            from database.models import Progress as ProgressModel
-            from sqlalchemy import func
-            db = SessionLocal()
-            ranks_query = db.query(
-                ProgressModel.user_id, 
-                func.sum(ProgressModel.questions_correct).label('total_sub_correct')
-            ).filter(ProgressModel.subject == sub_full).group_by(ProgressModel.user_id).order_by(func.sum(ProgressModel.questions_correct).desc()).all()
-            
-            for i, (uid, _) in enumerate(ranks_query):
-                if uid == user.id:
-                    subject_rank = f"#{i+1}"
-                    break
-            db.close()
+            # 3. Calculate Subject Rank (Global comparison in this sub, ranking cached briefly)
+            position = get_subject_rank_map(sub_full, db=db).get(user.id)
+            if position:
+                subject_rank = f"#{position}"
 
     # Level Progress
     next_level_xp = ((user.level) ** 2) * 100
@@ -151,40 +312,21 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
     level_bar = create_progress_bar(max(0, min(100, level_perc)), length=12)
             
     # Dynamic Greetings & Tips
-    import random
-    from datetime import datetime
     hour = datetime.utcnow().hour + 3 # Approximate EAT
     if hour < 12: greeting = "Good Morning! ☀️"
     elif hour < 18: greeting = "Good Afternoon! 🌤️"
     else: greeting = "Good Evening! 🌙"
     
-    tips = [
-        "Consistency is key! Regular practice leads to better results.",
-        "Review your mistakes to strengthen your understanding.",
-        "Collaborate with a friend to stay motivated!",
-        "Try Timed Practice to build your exam-day speed.",
-        "Check the Leaderboard to see your academic standing!",
-        "Master the difficult units to boost your knowledge level.",
-        "Academic mastery takes time. Keep practicing!",
-        "Biology requires memorization; focus on key terms!",
-        "Physics is about understanding concepts, not just formulas.",
-        "Chemistry reactions follow logical patterns. Study the trends!",
-        "Practice regularly to improve your recall and problem-solving skills.",
-        "Don't be afraid to ask for help when you're stuck on a concept.",
-        "Break down complex topics into smaller, manageable parts.",
-        "Set clear academic goals to stay focused and motivated.",
-        "Review past questions to identify areas for improvement."
-    ]
-    random_tip = random.choice(tips)
+    random_tip = random.choice(_TIPS)
 
     replacements = {
-        "{user_name}": escape_md(user.full_name),
+        "{user_name}": user.full_name,
         "{greeting}": greeting,
         "{random_tip}": random_tip,
         "{telegram_id}": str(telegram_id),
         "{level}": str(user.level),
-        "{level_rank}": escape_md(f"{rank_name} (Lvl {user.level})"), 
-        "{rank}": escape_md(rank_name),
+        "{level_rank}": f"{rank_name} (Lvl {user.level})", 
+        "{rank}": rank_name,
         "{streak}": str(user.streak_count),
         "{streak_count}": str(user.streak_count),
         "{mastery}": f"{total_mastery:.1f}",
@@ -192,12 +334,12 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
         "{view_grade}": str(active_grade),
         "{current_grade}": str(user.current_grade),
         "{grade}": str(user.current_grade),
-        "{best_subject}": escape_md(best_sub),
+        "{best_subject}": best_sub,
         "{subject_rank}": subject_rank,
         "{subject_coverage}": subject_coverage,
         "{join_date}": user.join_date.strftime("%Y-%m-%d") if user.join_date else "Unknown",
-        "{subject_name}": escape_md(extra_vars.get("subject_name", extra_vars.get("subject", "Subject")) if extra_vars else "Subject"),
-        "{subject}": escape_md(extra_vars.get("subject", extra_vars.get("subject_name", "Subject")) if extra_vars else "Subject"),
+        "{subject_name}": extra_vars.get("subject_name", extra_vars.get("subject", "Subject")) if extra_vars else "Subject",
+        "{subject}": extra_vars.get("subject", extra_vars.get("subject_name", "Subject")) if extra_vars else "Subject",
         "{current_lang}": "English" if user.language == "EN" else "Amharic",
         "{notif_status}": "ON" if user.notifications_enabled else "OFF",
         "{badge_list}": "\n".join([f"🏅 {b}" for b in badges]),
@@ -216,12 +358,14 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
     # Leaderboard Logic - Support for Global and Weekly scopes
     leaderboard_scope = extra_vars.get("leaderboard_scope", "Global") if extra_vars else "Global"
     
+    # Top 10 and the user's own rank come back from one query
+    top_users, user_rank_num = get_leaderboard_with_rank(user.id, leaderboard_scope, 10, db=db)
+    
     if leaderboard_scope == "Weekly":
-        top_users = get_weekly_leaderboard(10)
         xp_field = "weekly_xp"
+        user_xp_display = user.weekly_xp
         
         # Calculate countdown to next Monday 00:00 UTC
-        from datetime import datetime, timedelta
         now = datetime.utcnow()
         days_until_monday = (7 - now.weekday()) % 7
         if days_until_monday == 0 and now.hour == 0 and now.minute < 5:
@@ -233,24 +377,12 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
         hours = time_diff.seconds // 3600
         countdown = f"{days}d {hours}h"
     else:
-        top_users = get_leaderboard(10)
         xp_field = "total_xp"
+        user_xp_display = user.total_xp
         countdown = "Never"  # Global leaderboard doesn't reset
     
     lines = []
-    user_rank = "100+"
-    
-    db = SessionLocal()
-    # Find active user rank efficiently using COUNT
-    if leaderboard_scope == "Weekly":
-        user_rank_num = db.query(UserModel).filter(UserModel.weekly_xp > user.weekly_xp).count() + 1
-        user_xp_display = user.weekly_xp
-    else:
-        user_rank_num = db.query(UserModel).filter(UserModel.total_xp > user.total_xp).count() + 1
-        user_xp_display = user.total_xp
-    
-    user_rank = str(user_rank_num)
-    db.close()
+    user_rank = str(user_rank_num) if user_rank_num else "100+"
 
     for i, u in enumerate(top_users):
         medal = "🥇" if i == 0 else "🥈" if i == 1 else "🥉" if i == 2 else "👤"
@@ -265,41 +397,41 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
     replacements["{user_xp}"] = str(user_xp_display)
 
     # Admin Stats
-    from config import ADMIN_IDS
     if telegram_id in ADMIN_IDS:
-        db_admin = SessionLocal()
-        from sqlalchemy import func
-        from database.models import Progress as ProgressModel, FlaggedQuestion
-        
-        replacements["{total_users}"] = str(db_admin.query(UserModel).count())
-        replacements["{total_xp_global}"] = str(db_admin.query(func.sum(UserModel.total_xp)).scalar() or 0)
-        
-        total_attempts = db_admin.query(func.sum(ProgressModel.questions_attempted)).scalar() or 0
-        total_correct = db_admin.query(func.sum(ProgressModel.questions_correct)).scalar() or 0
-        
-        replacements["{total_attempts}"] = str(total_attempts)
-        replacements["{total_mistakes}"] = str(total_attempts - total_correct)
-        replacements["{total_flagged}"] = str(db_admin.query(FlaggedQuestion).count())
-        db_admin.close()
+        totals = get_admin_totals(db=db)
+        replacements["{total_users}"] = str(totals["total_users"])
+        replacements["{total_xp_global}"] = str(totals["total_xp"])
+        replacements["{total_attempts}"] = str(totals["total_attempts"])
+        replacements["{total_mistakes}"] = str(totals["total_attempts"] - totals["total_correct"])
+        replacements["{total_flagged}"] = str(totals["total_flagged"])
     
     # Subject progress bars (for STATS screen)
-    for sub in ["bio", "chem", "phys", "math"]:
-        sub_full = {"bio": "Biology", "chem": "Chemistry", "phys": "Physics", "math": "Mathematics"}[sub]
-        relevant = [p for p in active_progress if p.subject == sub_full]
-        perc = sum(p.completion_percent for p in relevant) / len(relevant) if relevant else 0
+    for sub, sub_full in _STATS_SUBJECTS:
+        completion_sum, count = subject_completion.get(sub_full, (0, 0))
+        perc = completion_sum / count if count else 0
         p_bar = create_progress_bar(perc, length=10)
         replacements[f"{{{sub}_dots}}"] = p_bar
         replacements[f"{{{sub}_perc}}"] = str(int(perc))
         replacements[f"{{{sub}_badges}}"] = "🎖️" if perc > 80 else ""
     
+    # Values that come from users or extra_vars; escaped per parse mode by _escaped_map
+    raw = {k: replacements[k] for k in _ESCAPED_KEYS}
     if extra_vars:
         for k, v in extra_vars.items():
+            key = f"{{{k}}}"
             if k in ["ai_explanation", "question_stem"]: 
-                replacements[f"{{{k}}}"] = v
+                replacements[key] = v
+                raw.pop(key, None)
             else:
                 # [FIX]: Allow extra_vars to overwrite defaults (like {grade})
-                replacements[f"{{{k}}}"] = escape_md(v)
+                replacements[key] = v
+                raw[key] = v
     
+    return replacements, active_grade, raw
+
+
+def apply_replacements(text, replacements, active_grade, extra_vars=None):
+    """Fills a text/label from a compute_replacements() map, highlighting the selected grade/duration buttons."""
     # Logic for Grade Button Highlighting (Premium UI)
     if text.startswith("🎓 G"):
         try:
@@ -324,74 +456,122 @@ def replace_variables(text, user_id, telegram_id, extra_vars=None, user_obj=None
                     text = text.replace("🔢", "✅")
             except: pass
 
-    result = text
-    for key, value in replacements.items():
-        result = result.replace(key, str(value))
-    
-    return result
+    # Unknown placeholders are left as-is
+    return PLACEHOLDER_RE.sub(lambda m: str(replacements.get(m.group(0), m.group(0))), text)
+
+
+def _resolve_cb(callback_data, extra_vars):
+    """Fills {key} parameters in callback data from extra_vars (unknown keys are left as-is)."""
+    if not extra_vars or "{" not in callback_data:
+        return callback_data
+    return PLACEHOLDER_RE.sub(lambda m: str(extra_vars.get(m.group(0)[1:-1], m.group(0))), callback_data)
 
 
-def build_keyboard(layout, actions, user_id, telegram_id, extra_vars=None, user_obj=None, progress_records=None):
+def build_keyboard(layout, actions, user_id, telegram_id, extra_vars=None, user_obj=None, progress_records=None, db=None, prepared=None):
     """
     Build InlineKeyboardMarkup from layout and actions.
+    prepared: optional (replacements, active_grade) from compute_replacements(parse_mode="Markdown") to reuse.
     """
-    keyboard = []
+    # Shared by every label on the screen; skipped when all labels are plain text
+    if prepared is not None:
+        replacements, active_grade = prepared
+    elif any(_needs_replacements(label, extra_vars) for row in layout for label in row):
+        replacements, active_grade = compute_replacements(user_id, telegram_id, extra_vars, user_obj=user_obj, progress_records=progress_records, db=db)
+    else:
+        replacements, active_grade = {}, None
     
-    for row in layout:
-        button_row = []
-        for label in row:
-            callback_data = actions.get(label, "NOOP")
-            # Handle dynamic parameters in callback data
-            if extra_vars:
-                # Generic replacement for all variables in extra_vars
-                for k, v in extra_vars.items():
-                    placeholder = f"{{{k}}}"
-                    if placeholder in str(callback_data):
-                        callback_data = callback_data.replace(placeholder, str(v))
-                
-                # Historic/Specific handlers (legacy support or specific overrides) can remain if needed
-                if "param" in extra_vars and "{param}" in str(callback_data): # Redundant now but safe
-                    callback_data = callback_data.replace("{param}", str(extra_vars["param"]))
-                
-                # FORCE update for Random Quiz to verify it's working
-                if "START_RANDOM_QUIZ" in str(callback_data) or "ACT|QUIZ|RANDOM" in str(callback_data):
-                    if "view_grade" in extra_vars:
-                         callback_data = callback_data.replace("{view_grade}", str(extra_vars["view_grade"]))
-                
-            display_label = replace_variables(label, user_id, telegram_id, extra_vars, user_obj=user_obj, progress_records=progress_records)
-            button_row.append(InlineKeyboardButton(display_label, callback_data=callback_data))
-        keyboard.append(button_row)
+    # Only callbacks carrying {key} parameters need templating; the rest are used as-is
+    dynamic_actions = {label: _resolve_cb(cb, extra_vars) for label, cb in actions.items() if "{" in cb} if extra_vars else {}
     
+    keyboard = [
+        [InlineKeyboardButton(apply_replacements(label, replacements, active_grade, extra_vars) if replacements else label,
+                              callback_data=dynamic_actions.get(label) or actions.get(label, "NOOP"))
+         for label in row]
+        for row in layout
+    ]
     return InlineKeyboardMarkup(keyboard)
 
 
-def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_vars=None):
+def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_vars=None, parse_mode="Markdown"):
     """
     Render a screen from the blueprint with translations and dynamic logic.
+    parse_mode="HTML" expects raw extra_vars (escaped here) and pre-built HTML in question_stem.
     """
-    from utils.question_engine import QuestionEngine
-    import json
-    from utils.blueprint_loader import get_screen, reload_blueprint
+    # One DB session for every lookup while composing, released before calling Telegram
+    db = SessionLocal()
+    try:
+        text, keyboard = _compose_screen(db, user_id, telegram_id, screen_id, extra_vars, parse_mode)
+    finally:
+        db.close()
     
-    # FORCE reload for Random Setup screen to ensure new actions are picked up
-    # Also for new Resources screens during dev
-    if screen_id in ["SCR_RANDOM_SETUP", "SCR_RESOURCES_HUB", "SCR_RESOURCES_ACTIONS"]:
-        reload_blueprint()
-        
-    user_obj = get_or_create_user(telegram_id, None, "User")
-    lang = user_obj.language or "EN"
+    if keyboard is None:
+        forget_render(telegram_id, message_id)
+        return bot.send_message(chat_id=telegram_id, text=text) if not message_id else bot.edit_message_text(chat_id=telegram_id, message_id=message_id, text=text)
     
-    raw_screen = get_screen(screen_id)
-    if not raw_screen:
-        error_text = f"[ERROR] Screen '{screen_id}' not found"
-        return bot.send_message(chat_id=telegram_id, text=error_text) if not message_id else bot.edit_message_text(chat_id=telegram_id, message_id=message_id, text=error_text)
+    # Re-rendering the exact payload a message already shows would only earn "Message is not modified"
+    payload_hash = hash((text, keyboard.to_json(), parse_mode))
+    if message_id and _LAST_RENDER.get((telegram_id, message_id)) == payload_hash:
+        return None
     
-    # Data copy for security
-    screen = raw_screen.copy()
-    if extra_vars is None: extra_vars = {}
+    result = _deliver_screen(bot, telegram_id, screen_id, message_id, text, keyboard, parse_mode)
+    
+    shown_id = getattr(result, "message_id", None)
+    if shown_id:
+        _LAST_RENDER[(telegram_id, shown_id)] = payload_hash
+        _LAST_RENDER.move_to_end((telegram_id, shown_id))
+        if len(_LAST_RENDER) > LAST_RENDER_MAX:
+            _LAST_RENDER.popitem(last=False)
+    return result
+
 
-    subj_map = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
+def forget_render(telegram_id, message_id):
+    """Call after editing a message outside render_screen so its next render is not skipped as unchanged."""
+    _LAST_RENDER.pop((telegram_id, message_id), None)
+
+
+def _deliver_screen(bot, telegram_id, screen_id, message_id, text, keyboard, parse_mode):
+    """Edits message_id (or sends a new message) with the rendered screen, falling back to plain text."""
+    # Screens whose formatting Telegram just rejected for this chat go straight to plain text
+    plain_key = (telegram_id, screen_id)
+    failed_at = _PLAIN_TEXT_RENDERS.get(plain_key)
+    if failed_at is not None and time.monotonic() - failed_at >= PLAIN_TEXT_TTL:
+        del _PLAIN_TEXT_RENDERS[plain_key]
+        failed_at = None
     
+    try:
+        if failed_at is not None:
+            return bot.edit_message_text(chat_id=telegram_id, message_id=message_id, text=text, reply_markup=keyboard) if message_id else bot.send_message(chat_id=telegram_id, text=text, reply_markup=keyboard)
+        return bot.edit_message_text(chat_id=telegram_id, message_id=message_id, text=text, reply_markup=keyboard, parse_mode=parse_mode) if message_id else bot.send_message(chat_id=telegram_id, text=text, reply_markup=keyboard, parse_mode=parse_mode)
+    except Exception as e:
+        if "Message is not modified" in str(e): return None
+        if "parse entities" in str(e).lower():
+            _PLAIN_TEXT_RENDERS[plain_key] = time.monotonic()
+        logger.warning("[RENDER] %s failed, falling back to plain text: %s", parse_mode, e)
+        try:
+            return bot.edit_message_text(chat_id=telegram_id, message_id=message_id, text=text, reply_markup=keyboard) if message_id else bot.send_message(chat_id=telegram_id, text=text, reply_markup=keyboard)
+        except:
+            return bot.send_message(chat_id=telegram_id, text=text, reply_markup=keyboard)
+
+
+def _compose_screen(db, user_id, telegram_id, screen_id, extra_vars, parse_mode):
+    """
+    Builds (text, keyboard) for render_screen using the given db session for every query.
+    keyboard is None when the screen does not exist (text is then the error message).
+    """
+    
+    # Blueprint edits are picked up by the loader's mtime check, no forced reload needed
+    user_obj = get_or_create_user(telegram_id, None, "User", db=db, with_progress=True)
+    lang = user_obj.language or "EN"
+    
+    # Read-only view of the cached blueprint screen: header text and actions are tracked separately
+    screen = get_screen(screen_id)
+    if not screen:
+        return f"[ERROR] Screen '{screen_id}' not found", None
+    
+    header_text = screen.get("header_text", "")
+    if extra_vars is None: extra_vars = {}
+    # Labels built below that need a translation key of their own {label: key}
+    dynamic_labels = {}
 
     # --- STATS & PROGRESS SCREENS ---
     # Global default for view_grade
@@ -402,7 +582,7 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
         code = extra_vars.get("param")
         if code:
             extra_vars["subject"] = code
-            extra_vars["subject_name"] = subj_map.get(code, code)
+            extra_vars["subject_name"] = SUBJECT_NAMES.get(code, code)
 
     if screen_id in ["SCR_STATS", "SCR_GAMEMODE", "SCR_SUBJECTS", "SCR_RANDOM_SETUP", "SCR_RESOURCES_HUB", "SCR_LOCK_GRADES", "SCR_LOCK_SUBJECTS", "SCR_LOCK_UNITS"]:
         grade_param = extra_vars.get("param")
@@ -411,11 +591,11 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
                 extra_vars["view_grade"] = str(grade_param)
             # If ROOT, we rely on the default set above (user_obj.current_grade) if not present
             
-            print(f"[RENDER] {screen_id} view_grade updated to {extra_vars.get('view_grade')}")
+            logger.debug("[RENDER] %s view_grade updated to %s", screen_id, extra_vars.get("view_grade"))
         elif screen_id == "SCR_RANDOM_SETUP":
              if not extra_vars.get("view_grade"):
                  extra_vars["view_grade"] = str(user_obj.current_grade)
-             print(f"[RENDER] {screen_id} Final view_grade: {extra_vars['view_grade']}")
+             logger.debug("[RENDER] %s Final view_grade: %s", screen_id, extra_vars["view_grade"])
 
     if screen_id == "SCR_RESOURCES_ACTIONS":
         param = extra_vars.get("param", "")
@@ -424,7 +604,7 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
             sub_code = parts[0]
             extra_vars["subject"] = sub_code
             extra_vars["view_grade"] = parts[1]
-            extra_vars["subject_name"] = subj_map.get(sub_code, sub_code)
+            extra_vars["subject_name"] = SUBJECT_NAMES.get(sub_code, sub_code)
 
     if screen_id == "SCR_STATS_DETAIL":
         param = extra_vars.get("param", "")
@@ -433,12 +613,12 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
             sub_code = parts[0]
             extra_vars["subject"] = sub_code
             extra_vars["view_grade"] = parts[1]
-            extra_vars["subject_name"] = subj_map.get(sub_code, sub_code)
+            extra_vars["subject_name"] = SUBJECT_NAMES.get(sub_code, sub_code)
         else:
             sub_code = param
             if sub_code:
                 extra_vars["subject"] = sub_code
-                extra_vars["subject_name"] = subj_map.get(sub_code, sub_code)
+                extra_vars["subject_name"] = SUBJECT_NAMES.get(sub_code, sub_code)
 
     # Chaining view_grade through setup screens
     if screen_id in ["SCR_SPEEDRUN_HUB", "SCR_SURVIVAL_SETUP"]:
@@ -448,11 +628,10 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
             extra_vars["view_grade"] = str(param)
         
         if screen_id == "SCR_SPEEDRUN_HUB":
-            from database.crud import get_or_create_session
-            session = get_or_create_session(user_obj.id)
+            session = get_or_create_session(user_obj.id, db=db)
             if session.quiz_state:
                 try:
-                    setup = json.loads(session.quiz_state)
+                    setup = _loads(session.quiz_state)
                     # Only use if it looks like a setup dict, not an active game
                     if isinstance(setup, dict) and "dur" in setup and "mode" not in setup:
                         for k,v in setup.items():
@@ -488,14 +667,14 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
                 grade_str = f"Grade {grade_str}"
         
         if sub_code and grade_str:
-            subject_name = subj_map.get(sub_code, sub_code)
+            subject_name = SUBJECT_NAMES.get(sub_code, sub_code)
             
             # Load available units
             units = QuestionEngine.list_units(subject_name, grade_str)
             
             if units:
                 # Build header
-                screen["header_text"] = f"📂 *Study Library: {subject_name} ({grade_str})*\n\nAccess unit-based study guides with curated MCQs and detailed explanations for offline review."
+                header_text = f"📂 *Study Library: {subject_name} ({grade_str})*\n\nAccess unit-based study guides with curated MCQs and detailed explanations for offline review."
                 
                 # Build unit buttons (2 per row for better layout)
                 unit_rows = []
@@ -519,20 +698,20 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
                 actions["🏠 Home"] = "NAV|SCR_HUB|ROOT"
             else:
                 # No units found
-                screen["header_text"] = f"📂 *Download Lesson PDFs*\\n\\n{subject_name} - {grade_str}\\n\\n❌ No units available for this subject and grade."
+                header_text = f"📂 *Download Lesson PDFs*\\n\\n{subject_name} - {grade_str}\\n\\n❌ No units available for this subject and grade."
                 layout = [["🔙 Back", "🏠 Home"]]
                 actions["🔙 Back"] = "NAV|BACK|BACK"
                 actions["🏠 Home"] = "NAV|SCR_HUB|ROOT"
         else:
             # Invalid param
-            screen["header_text"] = "📂 *Download Lesson PDFs*\\n\\n❌ Invalid subject or grade selection."
+            header_text = "📂 *Download Lesson PDFs*\\n\\n❌ Invalid subject or grade selection."
             layout = [["🏠 Home"]]
             actions["🏠 Home"] = "NAV|SCR_HUB|ROOT"
     
     # SCR_GRADES
     if screen_id == "SCR_GRADES":
         code = extra_vars.get("subject", extra_vars.get("param", ""))
-        subject = subj_map.get(code, code)
+        subject = SUBJECT_NAMES.get(code, code)
         if subject:
             grades = QuestionEngine.list_grades(subject)
             if grades:
@@ -552,29 +731,23 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
             grade_full = f"Grade {grade_raw}" if grade_raw.isdigit() else grade_raw
             
             extra_vars["subject_code"] = code
-            extra_vars["subject_name"] = subj_map.get(code, code)
+            extra_vars["subject_name"] = SUBJECT_NAMES.get(code, code)
             extra_vars["grade"] = grade_full.replace("Grade ", "")
             
             # Fetch LOCKS for this subject/grade
-            from database.models import SystemLock
-            db = SessionLocal()
             grade_val = grade_raw.replace("Grade ", "").strip()
-            unit_locks = db.query(SystemLock.lock_target).filter(
-                SystemLock.lock_type == "UNIT",
-                SystemLock.lock_target.like(f"{code}_G{grade_val}_U%"),
-                SystemLock.is_locked == True
-            ).all()
-            locked_unit_ids = [l[0] for l in unit_locks]
-            db.close()
+            locked_unit_ids = get_locked_units(code, grade_val)
 
             units = QuestionEngine.list_units(extra_vars["subject_name"], grade_full)
             grid = []
             if units:
-                all_p = get_all_user_progress(user_obj.id)
+                progress_by_unit = {}
+                for p in user_obj.progress_records:
+                    progress_by_unit.setdefault(p.unit_id, p)
                 for i, u in enumerate(units):
                     unit_num = u.split(" ")[1] if " " in u else str(i+1)
                     unit_id = f"{code}_{grade_full.replace(' ', '')}_U{unit_num}"
-                    this_p = next((p for p in all_p if p.unit_id == unit_id), None)
+                    this_p = progress_by_unit.get(unit_id)
                     perc = int(this_p.completion_percent) if this_p else 0
                     
                     is_locked = unit_id in locked_unit_ids
@@ -613,7 +786,7 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
          # Force update any potential old keys just in case
          actions[f"ACT|QUIZ|START_RANDOM_QUIZ|{{view_grade}}"] = f"ACT|QUIZ|START_RANDOM_QUIZ|{vg}"
          
-         print(f"[RENDER] Forced Random Quiz Action: {actions.get('⚡ Start Random Quiz')}")
+         logger.debug("[RENDER] Forced Random Quiz Action: %s", actions.get("⚡ Start Random Quiz"))
          # Also ensure grade buttons highlight
          if f"🎓 G{vg}" in actions:
              # Need to find the key that matches "🎓 G{vg}"
@@ -638,11 +811,9 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
         
         # 2. Fallback to session if param not fully available or invalid
         if not sub_code or grade_num is None:
-            from database.crud import get_or_create_session
-            session = get_or_create_session(user_obj.id)
+            session = get_or_create_session(user_obj.id, db=db)
             if session.quiz_state:
-                import json
-                qs = json.loads(session.quiz_state)
+                qs = _loads(session.quiz_state)
                 if not sub_code: sub_code = qs.get("subject_code")
                 if grade_num is None:
                     g_val = qs.get("grade")
@@ -657,9 +828,9 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
             grade_num = 9 # A reasonable default if no context is found
 
         if sub_code:
-            extra_vars["subject_name"] = subj_map.get(sub_code, sub_code)
+            extra_vars["subject_name"] = SUBJECT_NAMES.get(sub_code, sub_code)
             # Pass real grade integer to get_review_queue_counts
-            counts = get_review_queue_counts(user_obj.id, subject=sub_code, grade=grade_num)
+            counts = get_review_queue_counts(user_obj.id, subject=sub_code, grade=grade_num, db=db)
             
             m_count = counts.get("MISTAKE", 0)
             s_count = counts.get("SKIPPED", 0)
@@ -670,11 +841,13 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
             if m_count > 0:
                 label = f"❌ Retry Mistakes {m_count}"
                 actions[label] = "ACT|QUIZ|REVIEW_MISTAKES"
+                dynamic_labels[label] = "REVIEW_MISTAKES"
                 review_rows.append([label]) # Vertical stack for small screens
                 extra_vars["mistake_count"] = m_count
             if s_count > 0:
                 label = f"⏩ Try Skipped {s_count}"
                 actions[label] = "ACT|QUIZ|REVIEW_SKIPPED"
+                dynamic_labels[label] = "REVIEW_SKIPPED"
                 review_rows.append([label]) # Vertical stack for small screens
                 extra_vars["skipped_count"] = s_count
             if p_count > 0:
@@ -692,34 +865,23 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
         context = extra_vars.get("param")
         if context and ":" in context:
             code, grade = context.split(":")
-            extra_vars["subject_name"] = subj_map.get(code, code)
+            extra_vars["subject_name"] = SUBJECT_NAMES.get(code, code)
             extra_vars["grade"] = grade.replace("Grade ", "")
             
-            # Fetch LOCKS for this subject/grade
-            from database.models import SystemLock
-            db = SessionLocal()
             grade_val = grade.replace("Grade ", "").strip()
-            # Find all UNIT locks for this subject/grade
-            unit_locks = db.query(SystemLock).filter(
-                SystemLock.lock_type == "UNIT",
-                SystemLock.lock_target.like(f"{code}_G{grade_val}_U%"),
-                SystemLock.is_locked == True
-            ).all()
-            locked_unit_ids = [l.lock_target for l in unit_locks]
-            db.close()
-
             units = QuestionEngine.list_units(extra_vars["subject_name"], grade)
             if units:
+                # Exact unit ids for this subject/grade, checked against the cached UNIT lock set
+                unit_ids = [f"{code}_G{grade_val}_U{u.split(' ')[1] if ' ' in u else i+1}" for i, u in enumerate(units)]
+                locked_unit_ids = get_active_locks().get("UNIT", set()).intersection(unit_ids)
+                
                 grid = []
                 # Add "All Volume" button at top
                 all_label = "📚 DOWNLOAD ALL UNITS"
                 actions[all_label] = f"ACT|FILE|SEND_PDF_ALL|{code}:{grade}"
                 grid.append([all_label])
                 
-                for i, u in enumerate(units):
-                    u_num = u.split(" ")[1] if " " in u else str(i+1)
-                    unit_id = f"{code}_G{grade_val}_U{u_num}"
-                    
+                for i, (u, unit_id) in enumerate(zip(units, unit_ids)):
                     is_locked = unit_id in locked_unit_ids
                     status_icon = "🔒" if is_locked else "📥"
                     
@@ -736,28 +898,24 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
 
     # SCR_INVITES - Show user's created challenges
     if screen_id == "SCR_INVITES":
-        from database.models import Challenge as ChallengeModel
-        import json
-        db = SessionLocal()
         try:
-            user_obj = db.query(UserModel).filter(UserModel.telegram_id == telegram_id).first()
-            if user_obj:
-                challenges = db.query(ChallengeModel).filter(
-                    ChallengeModel.creator_id == user_obj.id
-                ).order_by(ChallengeModel.created_at.desc()).limit(10).all()
-            else:
-                challenges = []
+            # user_obj was loaded on this session at the top of the render
+            # Only the listed columns; questions_json is fetched just for rows created before question_count existed
+            challenges = db.query(
+                ChallengeModel.subject, ChallengeModel.grade, ChallengeModel.question_count, ChallengeModel.created_at,
+                case((ChallengeModel.question_count.is_(None), ChallengeModel.questions_json)).label("questions_json")
+            ).filter(
+                ChallengeModel.creator_id == user_obj.id
+            ).order_by(ChallengeModel.created_at.desc()).limit(10).all()
         except Exception as e:
-            print(f"[INVITES] Error loading challenges: {e}")
+            logger.warning("[INVITES] Error loading challenges: %s", e)
             challenges = []
-        finally:
-            db.close()
         
         if challenges:
             grid = []
             for ch in challenges:
                 subj_name = ch.subject or "Mixed"
-                q_count = len(json.loads(ch.questions_json)) if ch.questions_json else 0
+                q_count = ch.question_count if ch.question_count is not None else (len(_loads(ch.questions_json)) if ch.questions_json else 0)
                 created = ch.created_at.strftime("%m/%d %H:%M") if ch.created_at else ""
                 label = f"⚔️ {subj_name} G{ch.grade} ({q_count}Qs) {created}"
                 # Truncate if too long for Telegram button
@@ -767,20 +925,20 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
                 grid.append([label])
             
             layout = grid + [["🔙 Back"]]
-            screen["header_text"] = f"📥 *Your Active Challenges*\n━━━━━━━━━━━━━━\n📊 {len(challenges)} challenge(s) created\n\nTap any challenge to share its link with friends!"
+            header_text = f"📥 *Your Active Challenges*\n━━━━━━━━━━━━━━\n📊 {len(challenges)} challenge(s) created\n\nTap any challenge to share its link with friends!"
         else:
             layout = [["⚔️ Create New Challenge"], ["🔙 Back"]]
             actions["⚔️ Create New Challenge"] = "NAV|SCR_MP_SUBJ_SELECT|ROOT"
-            screen["header_text"] = "📥 *Your Active Challenges*\n━━━━━━━━━━━━━━\n\n📭 You have no active challenges.\n\nCreate one and share with friends! 🚀"
+            header_text = "📥 *Your Active Challenges*\n━━━━━━━━━━━━━━\n\n📭 You have no active challenges.\n\nCreate one and share with friends! 🚀"
         
         actions["🔙 Back"] = "NAV|SCR_MULTIPLAYER_HUB|BACK"
 
     # SCR_ADMIN_FLAGS
     if screen_id == "SCR_ADMIN_FLAGS":
-        from database.models import FlaggedQuestion
-        db = SessionLocal()
-        flags = db.query(FlaggedQuestion).order_by(FlaggedQuestion.flag_count.desc()).all()
-        db.close()
+        # Only the columns the buttons show (reasons blobs are loaded per question in the review screen)
+        flags = db.query(FlaggedQuestion.question_id, FlaggedQuestion.flag_count).order_by(
+            FlaggedQuestion.flag_count.desc()
+        ).limit(ADMIN_FLAGS_LIMIT).all()
         
         if flags:
             grid = []
@@ -791,21 +949,17 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
             layout = grid + [["🔙 Back to Admin"]]
         else:
             layout = [["🔙 Back to Admin"]]
-            screen["header_text"] += "\n\n✨ *No flags found.* Everything is clean!"
+            header_text += "\n\n✨ *No flags found.* Everything is clean!"
 
     # SCR_ADMIN_FLAG_REVIEW
     if screen_id == "SCR_ADMIN_FLAG_REVIEW":
         q_id = extra_vars.get("param")
         if q_id:
-            from database.models import FlaggedQuestion
-            db = SessionLocal()
             f = db.query(FlaggedQuestion).filter(FlaggedQuestion.question_id == q_id).first()
-            db.close()
             
             if f:
                 q_data = QuestionEngine.find_question_by_id(q_id)
-                import json
-                reasons = json.loads(f.reasons)
+                reasons = _loads(f.reasons)
                 extra_vars.update({
                     "q_id": q_id,
                     "flag_count": f.flag_count,
@@ -830,24 +984,16 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
         actions["📖 Unit Locks"] = "NAV|SCR_LOCK_UNITS|ROOT"
         actions["🔙 Back to Admin"] = "NAV|SCR_ADMIN|ROOT"
         
-        screen["header_text"] = "🔐 *Admin Lock Registry*\n\nManage curriculum access and feature restrictions."
+        header_text = "🔐 *Admin Lock Registry*\n\nManage curriculum access and feature restrictions."
 
     # SCR_LOCK_FEATURES
     if screen_id == "SCR_LOCK_FEATURES":
-        from database.models import SystemLock
-        db = SessionLocal()
         
-        features = ["ADVANCED_PRACTICE", "REVIEW_HUB", "PDFS_AND_FILES", "LEADERBOARD", "PRACTICE_WITH_FRIENDS", "SEARCH"]
-        feature_locks = db.query(SystemLock).filter(
-            SystemLock.lock_type == "FEATURE",
-            SystemLock.lock_target.in_(features)
-        ).all()
-        lock_map = {l.lock_target: l.is_locked for l in feature_locks}
-        db.close()
+        lock_map = get_locks_bulk([("FEATURE", f) for f in _LOCKABLE_FEATURES], db=db)
         
         grid = []
-        for f in features:
-            is_locked = lock_map.get(f, False)
+        for f in _LOCKABLE_FEATURES:
+            is_locked = lock_map.get(("FEATURE", f), False)
             status = "🔴" if is_locked else "🔵"
             label = f"{f.replace('_', ' ').title()} {status}"
             actions[label] = f"ACT|LOCK|TOGGLE_FEATURE|{f}"
@@ -865,30 +1011,21 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
         view_grade = extra_vars.get("view_grade")
         if not view_grade: view_grade = "9"
         
-        tabs = ["9", "10", "11", "12"]
         tab_row = []
-        for g in tabs:
+        for g in _GRADE_TABS:
             lbl = f"🎓 G{g}" if str(g) != str(view_grade) else f"✅ G{g}"
             actions[lbl] = f"NAV|SCR_LOCK_SUBJECTS|{g}"
             tab_row.append(lbl)
             
-        from database.models import SystemLock
-        db = SessionLocal()
         
-        subjects = ["Biology", "Chemistry", "Physics", "Mathematics"]
         # Targets: "Biology:9"
-        targets = [f"{s}:{view_grade}" for s in subjects]
-        sub_locks = db.query(SystemLock).filter(
-            SystemLock.lock_type == "SUBJECT",
-            SystemLock.lock_target.in_(targets)
-        ).all()
-        lock_map = {l.lock_target: l.is_locked for l in sub_locks}
-        db.close()
+        targets = [f"{s}:{view_grade}" for s in SUBJECT_NAMES.values()]
+        lock_map = get_locks_bulk([("SUBJECT", t) for t in targets], db=db)
         
         grid = []
-        for s in subjects:
+        for s in SUBJECT_NAMES.values():
             target = f"{s}:{view_grade}"
-            is_locked = lock_map.get(target, False)
+            is_locked = lock_map.get(("SUBJECT", target), False)
             status = "🔴" if is_locked else "🔵"
             label = f"{s} {status}"
             actions[label] = f"ACT|LOCK|TOGGLE_SUBJECT|{target}"
@@ -906,16 +1043,14 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
         view_grade = extra_vars.get("view_grade")
         if not view_grade: view_grade = "9"
         
-        tabs = ["9", "10", "11", "12"]
         tab_row = []
-        for g in tabs:
+        for g in _GRADE_TABS:
             lbl = f"🎓 G{g}" if str(g) != str(view_grade) else f"✅ G{g}"
             actions[lbl] = f"NAV|SCR_LOCK_UNITS|{g}"
             tab_row.append(lbl)
             
-        subjects = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
         grid = []
-        for code, name in subjects.items():
+        for code, name in SUBJECT_NAMES.items():
             label = f"📂 {name}"
             # Navigate to Unit List for specific subject and grade
             actions[label] = f"NAV|SCR_LOCK_UNIT_LIST|{code}:{view_grade}"
@@ -936,8 +1071,7 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
             grade_num = grade_raw.replace("Grade ", "")
             grade_full = f"Grade {grade_num}"
             
-            subj_map = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
-            subject_name = subj_map.get(code, code)
+            subject_name = SUBJECT_NAMES.get(code, code)
             
             extra_vars["subject_name"] = subject_name
             extra_vars["grade"] = grade_num
@@ -945,8 +1079,6 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
             
             units = QuestionEngine.list_units(subject_name, grade_full)
             if units:
-                from database.models import SystemLock
-                db = SessionLocal()
                 
                 unit_ids = []
                 for i, u_title in enumerate(units):
@@ -960,17 +1092,11 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
                     unit_id = f"{code}_G{grade_num}_U{u_num}"
                     unit_ids.append((u_title, unit_id))
 
-                targets = [uid for _, uid in unit_ids]
-                locks = db.query(SystemLock).filter(
-                    SystemLock.lock_type == "UNIT",
-                    SystemLock.lock_target.in_(targets)
-                ).all()
-                lock_map = {l.lock_target: l.is_locked for l in locks}
-                db.close()
+                lock_map = get_locks_bulk([("UNIT", uid) for _, uid in unit_ids], db=db)
                 
                 grid = []
                 for u_title, u_id in unit_ids:
-                    is_locked = lock_map.get(u_id, False)
+                    is_locked = lock_map.get(("UNIT", u_id), False)
                     status = "🔴" if is_locked else "🔵"
                     
                     display_title = u_title
@@ -987,57 +1113,22 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
     # --- Translation Pass (Applied to final layout) ---
     header_key = f"{screen_id.replace('SCR_', '')}_HEADER"
     if lang in TRANSLATIONS and header_key in TRANSLATIONS[lang]:
-        screen["header_text"] = TRANSLATIONS[lang][header_key]
-    
-    label_map = {
-        "🚀 Start Practice": "START_PRACTICE",
-        "⚙️ Set Up Profile": "SETUP_PROFILE",
-        "🎓 Start Practice Hub": "START_PRACTICE_HUB",
-        "🔍 Advanced Practice": "ADVANCED_PRACTICE",
-        "💬 Practice with Friends": "PRACTICE_WITH_FRIENDS",
-        "📊 My Progress": "PROGRESS",
-        "🏆 Leaderboard": "LEADERBOARD",
-        "⚡ Random Quiz": "RANDOM_QUIZ",
-        "⚙️ Settings": "SETTINGS_HUB",
-        "❓ Help": "HELP_HUB",
-        "🛠️ Admin Dashboard": "ADMIN_HUB",
-        "🧬 Biology": "BIO", "🧪 Chemistry": "CHEM", "⚛️ Physics": "PHYS", "📐 Mathematics": "MATH",
-        "📊 Academic Progress": "ACADEMIC_PROGRESS", "🏠 Home": "HOME_LABEL",
-        "🔙 Back to Subjects": "BACK_LABEL", "🔙 Back to Settings": "BACK_LABEL",
-        "🔙 Back to Grades": "BACK_LABEL", "🔙 Back to Units": "BACK_LABEL",
-        "🔙 Back to Arena": "BACK_LABEL", "🔙 Back to Admin": "BACK_LABEL",
-        "🌐 Language: {current_lang}": "LANG_LABEL",
-        "🔔 Notifications: {notif_status}": "NOTIF_LABEL",
-        "🧹 Reset Progress": "RESET_LABEL", "👤 Profile": "PROFILE_LABEL",
-        "⚡ Review All Units": "REVIEW_ALL",
-        "📂 Unit Study Guides": "DOWNLOAD_PDFS",
-        "📂 PDFs & Files": "DOWNLOAD_PDFS", # Fallback
-        "⚡ Review: Part 1": "REVIEW_P1",
-        "⚡ Review: Part 2": "REVIEW_P2",
-        "⚡ Review: Part 3": "REVIEW_P3",
-        "🔄 Restart Unit": "RESTART_UNIT",
-        "➡️ Next Unit": "NEXT_UNIT",
-        "🔄 Restart Part": "RESTART_PART",
-        "➡️ Next Part": "NEXT_PART"
-    }
+        header_text = TRANSLATIONS[lang][header_key]
     
-    # Add dynamic labels to map to ensure they translate
-    for row in layout:
-        for lbl in row:
-            if "Retry Mistakes" in lbl: label_map[lbl] = "REVIEW_MISTAKES"
-            if "Try Skipped" in lbl: label_map[lbl] = "REVIEW_SKIPPED"
-
     translated_layout = []
     for row in layout:
         new_row = []
         for lbl in row:
-            t_key = label_map.get(lbl)
-            if lang in TRANSLATIONS and t_key and t_key in TRANSLATIONS[lang]:
-                t_lbl_template = TRANSLATIONS[lang][t_key]
+            translated = _label_template(lang, lbl, dynamic_labels)
+            if translated:
+                t_key, t_lbl_template = translated
                 # If it's a dynamic label with count
-                if "{count}" in t_lbl_template:
+                parts = _COUNT_PARTS.get(t_lbl_template)
+                if parts is None:
+                    parts = _COUNT_PARTS[t_lbl_template] = tuple(t_lbl_template.split("{count}"))
+                if len(parts) > 1:
                     count = extra_vars.get("mistake_count" if "MISTAKES" in t_key else "skipped_count", 0)
-                    t_lbl = t_lbl_template.replace("{count}", str(count))
+                    t_lbl = str(count).join(parts)
                 else:
                     t_lbl = t_lbl_template
                 
@@ -1049,29 +1140,31 @@ def render_screen(bot, user_id, telegram_id, screen_id, message_id=None, extra_v
         translated_layout.append(new_row)
     layout = translated_layout
 
-    # Build and Render
-    progress_recs = get_all_user_progress(user_obj.id)
-    text = replace_variables(screen.get("header_text", ""), user_id, telegram_id, extra_vars, user_obj=user_obj, progress_records=progress_recs)
-    # Filter layout for Admin buttons
-    from config import ADMIN_IDS
-    filtered_layout = []
-    for row in layout: # Use the translated and dynamically generated layout
-        filtered_row = []
-        for btn_label in row:
-            if "Admin" in btn_label and telegram_id not in ADMIN_IDS:
-                continue
-            filtered_row.append(btn_label)
-        if filtered_row:
-            filtered_layout.append(filtered_row)
-    
-    keyboard = build_keyboard(filtered_layout, actions, user_id, telegram_id, extra_vars, user_obj=user_obj, progress_records=progress_recs) # Use filtered_layout and existing actions
+    # Filter layout for Admin buttons (admins see every button)
+    if telegram_id in ADMIN_IDS:
+        filtered_layout = [row for row in layout if row]
+    else:
+        filtered_layout = []
+        for row in layout: # Use the translated and dynamically generated layout
+            filtered_row = [btn_label for btn_label in row if "Admin" not in btn_label]
+            if filtered_row:
+                filtered_layout.append(filtered_row)
+
+    # Build and Render: the replacement map is built only if the header or a label uses it, and
+    # then once for both (labels always use Markdown escaping, so HTML screens re-escape the raw values)
+    header_needs = _needs_replacements(header_text, extra_vars)
+    labels_need = any(_needs_replacements(label, extra_vars) for row in filtered_layout for label in row)
+    text = header_text
+    prepared = ({}, None)
+    if header_needs or labels_need:
+        base, active_grade, raw = _build_replacements(user_id, telegram_id, extra_vars, user_obj, user_obj.progress_records, db)
+        header_map = _escaped_map(base, raw, parse_mode) if header_needs else None
+        if header_needs:
+            text = apply_replacements(header_text, header_map, active_grade, extra_vars)
+        if labels_need:
+            label_map = header_map if parse_mode == "Markdown" and header_map is not None else _escaped_map(base, raw, "Markdown")
+            prepared = (label_map, active_grade)
     
-    try:
-        return bot.edit_message_text(chat_id=telegram_id, message_id=message_id, text=text, reply_markup=keyboard, parse_mode="Markdown") if message_id else bot.send_message(chat_id=telegram_id, text=text, reply_markup=keyboard, parse_mode="Markdown")
-    except Exception as e:
-        if "Message is not modified" in str(e): return None
-        print(f"[RENDER] Markdown failed, falling back to plain text: {e}")
-        try:
-            return bot.edit_message_text(chat_id=telegram_id, message_id=message_id, text=text, reply_markup=keyboard) if message_id else bot.send_message(chat_id=telegram_id, text=text, reply_markup=keyboard)
-        except:
-            return bot.send_message(chat_id=telegram_id, text=text, reply_markup=keyboard)
+    keyboard = build_keyboard(filtered_layout, actions, user_id, telegram_id, extra_vars, user_obj=user_obj, db=db,
+                              prepared=prepared) # Use filtered_layout and existing actions
+    return text, keyboard
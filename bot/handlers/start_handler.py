@@ -3,10 +3,12 @@
 """
 import sys
 import os
+import datetime
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from database.crud import get_or_create_user, get_or_create_session, update_session_state
+from database.crud import get_or_create_user, get_or_create_session, update_session_state, get_challenge
 from handlers.screen_renderer import render_screen
+from handlers.game_handler import start_challenge_session
 
 
 def handle_start(bot, update):
@@ -29,8 +31,6 @@ def handle_start(bot, update):
     
     # Handle Multiplayer Deep Links
     if param and param.startswith("CH_"):
-        from database.crud import get_challenge
-        from handlers.game_handler import start_challenge_session
         print(f"DEBUG: Start command with param: {param}")
         challenge = get_challenge(param)
         if challenge:
@@ -44,7 +44,6 @@ def handle_start(bot, update):
              return # Stop here! Do not go to Home.
 
     # Normal Flow
-    import datetime
     is_new = (datetime.datetime.utcnow() - user.join_date).total_seconds() < 5
     screen_id = "SCR_WELCOME" if is_new else "SCR_HUB"
     
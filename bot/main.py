@@ -10,7 +10,7 @@ sys.path.insert(0, os.path.dirname(__file__))
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
 from config import BOT_TOKEN
 from database import init_db
-from handlers import handle_start, route_callback
+from handlers import handle_start, handle_reload, route_callback
 from keep_alive import keep_alive
 from telegram.ext import JobQueue
 
@@ -41,6 +41,7 @@ def main():
     # Register handlers
     print("[3/3] Registering handlers...")
     dispatcher.add_handler(CommandHandler("start", handle_start))
+    dispatcher.add_handler(CommandHandler("reload", handle_reload))
     dispatcher.add_handler(CallbackQueryHandler(route_callback))
     
     # Start the job queue
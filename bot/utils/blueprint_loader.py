@@ -1,21 +1,45 @@
 """Blueprint loader utility - loads and caches the UI blueprint JSON"""
-import json
 import os
+import time
+from types import MappingProxyType
+
+from .json_codec import loads as _loads
+
+# Navigate from bot/utils/ to project root
+_BLUEPRINT_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+    "nebular_cassini_v1_blueprint.json"
+)
+# Seconds between mtime checks; edits to the file are picked up without a restart
+_MTIME_CHECK_INTERVAL = 2.0
 
 _blueprint_cache = None
+_blueprint_mtime = None
+_last_mtime_check = 0.0
+_screen_index = {}  # {screen_id: screen definition}
 
 
 def load_blueprint():
-    """Load blueprint JSON file and cache it"""
-    global _blueprint_cache
-    if _blueprint_cache is None:
-        # Navigate from bot/utils/ to project root
-        blueprint_path = os.path.join(
-            os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
-            "nebular_cassini_v1_blueprint.json"
-        )
-        with open(blueprint_path, 'r', encoding='utf-8') as f:
-            _blueprint_cache = json.load(f)
+    """Load blueprint JSON file and cache it (re-read only when the file's mtime changes)"""
+    global _blueprint_cache, _blueprint_mtime, _last_mtime_check, _screen_index
+    now = time.monotonic()
+    if _blueprint_cache is not None and now - _last_mtime_check < _MTIME_CHECK_INTERVAL:
+        return _blueprint_cache
+    _last_mtime_check = now
+
+    mtime = os.path.getmtime(_BLUEPRINT_PATH)
+    if _blueprint_cache is None or mtime != _blueprint_mtime:
+        with open(_BLUEPRINT_PATH, 'rb') as f:
+            blueprint = _loads(f.read())
+
+        # Index screens by their screen_id field value (first definition wins)
+        index = {}
+        for screen_data in blueprint.get("screens", {}).values():
+            if screen_data.get("screen_id"):
+                # Read-only view: renders copy what they change instead of poisoning the cache
+                index.setdefault(screen_data["screen_id"], MappingProxyType(screen_data))
+
+        _blueprint_cache, _blueprint_mtime, _screen_index = blueprint, mtime, index
     return _blueprint_cache
 
 
@@ -23,20 +47,15 @@ def get_screen(screen_id):
     """
     Get a specific screen definition from the blueprint.
     Searches by screen_id field value (e.g., "SCR_HUB"), not by key name.
+    The returned mapping is a read-only view of the cached screen - copy nested values before mutating.
     """
-    blueprint = load_blueprint()
-    screens = blueprint.get("screens", {})
-    
-    # Search for screen by screen_id field
-    for key, screen_data in screens.items():
-        if screen_data.get("screen_id") == screen_id:
-            return screen_data
-    
-    return None
+    load_blueprint()
+    return _screen_index.get(screen_id)
 
 
 def reload_blueprint():
     """Force reload blueprint (useful for development)"""
-    global _blueprint_cache
+    global _blueprint_cache, _screen_index
     _blueprint_cache = None
+    _screen_index = {}
     return load_blueprint()
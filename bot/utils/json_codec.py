@@ -0,0 +1,23 @@
+"""
+JSON encode/decode helpers - uses orjson when available, stdlib json otherwise.
+dumps() always returns str so results can go straight into Text columns.
+"""
+import json
+
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+except ImportError:
+    orjson = None
+
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj) -> str:
+        return json.dumps(obj)
@@ -1,13 +1,116 @@
 import os
+import re
 import sys
+import time
 
 # Ensure project root is in path
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from database.models import SystemLock, User
-from database.crud import SessionLocal
+from database.models import User
+from database.crud import SessionLocal, get_active_locks
 from config import ADMIN_IDS
 
+# Param delimiters ("BIO:9", "START_RANDOM|10")
+_DELIM_RE = re.compile(r'[|:]')
+
+def _scan_digits(s, i):
+    """Return the index just past the run of ASCII digits starting at i"""
+    n = len(s)
+    while i < n and '0' <= s[i] <= '9':
+        i += 1
+    return i
+
+
+def _find_unit_ids(s):
+    """
+    Find unit ids (CODE_G#_U#, e.g. "BIO_G12_U3") embedded in a callback param.
+    Plain str.find scan; same matches as the regex ([A-Z]+)_G([0-9]+)_U([0-9]+).
+    """
+    found = []
+    floor = 0  # Matches never overlap: the subject prefix can't reach back past the last one
+    i = s.find("_G")
+    while i != -1:
+        g_end = _scan_digits(s, i + 2)
+        if g_end > i + 2 and s.startswith("_U", g_end):
+            u_end = _scan_digits(s, g_end + 2)
+            start = i
+            while start > floor and 'A' <= s[start - 1] <= 'Z':
+                start -= 1
+            if u_end > g_end + 2 and start < i:
+                found.append(s[start:u_end])
+                floor = u_end
+                i = s.find("_G", u_end)
+                continue
+        i = s.find("_G", i + 1)
+    return found
+
+
+# Screen -> feature lock that guards it
+_FEATURE_MAP = {
+    # Advanced Practice Screens
+    "SCR_GAMEMODE": "ADVANCED_PRACTICE",
+    "SCR_SPEEDRUN_SETUP": "ADVANCED_PRACTICE",
+    "SCR_SPEEDRUN_SUBJECTS": "ADVANCED_PRACTICE",
+    "SCR_SPEEDRUN_COUNTS": "ADVANCED_PRACTICE",
+    "SCR_SURVIVAL_SETUP": "ADVANCED_PRACTICE",
+    "SCR_GAME_PRES": "ADVANCED_PRACTICE",
+    
+    # Review Hub
+    "SCR_REVIEW_HUB": "REVIEW_HUB",
+    
+    # PDF Vault
+    "SCR_PDF_VAULT": "PDFS_AND_FILES",
+    
+    # Leaderboard
+    "SCR_RANKING": "LEADERBOARD",
+    
+    # Multiplayer
+    "SCR_MULTIPLAYER_HUB": "PRACTICE_WITH_FRIENDS",
+    "SCR_MP_SUBJ_SELECT": "PRACTICE_WITH_FRIENDS",
+    "SCR_INVITES": "PRACTICE_WITH_FRIENDS",
+    
+    # AI Tutor (if screen exists, or general feature check)
+    "SCR_AI_CHAT": "AI_TUTOR"
+}
+
+_SUBJ_MAP = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
+_SUBJ_CODES = tuple(_SUBJ_MAP)  # Detection order for subject codes inside params
+_VALID_GRADES = frozenset({9, 10, 11, 12})
+# Screens whose subject lock needs a grade (falls back to the user's grade)
+_CONTENT_SCREENS = frozenset({
+    "SCR_UNITS", "SCR_QUIZ_PRES", "SCR_TOPIC_SELECTION", "SCR_UNIT_START",
+    "SCR_REVIEW_HUB", "SCR_SPEEDRUN_SUBJECTS", "SCR_SURVIVAL_SETUP",
+    "SCR_PDF_VAULT", "SCR_RANDOM_SETUP"
+})
+# Screens whose params may name a specific unit
+_UNIT_SCREENS = frozenset({"SCR_QUIZ_PRES", "SCR_PDF_VAULT", "SCR_GAME_PRES"})
+
+# Short-lived per-user grade memo for the grade fallback (callbacks tend to arrive in bursts)
+GRADE_CACHE_TTL = 30
+_grade_cache = {}  # {telegram_id: (fetched_at, current_grade)}
+
+
+def _get_user_grade(telegram_id):
+    """Return the user's current grade (or None), memoised for GRADE_CACHE_TTL seconds"""
+    now = time.monotonic()
+    hit = _grade_cache.get(telegram_id)
+    if hit and now - hit[0] < GRADE_CACHE_TTL:
+        return hit[1]
+
+    db = SessionLocal()
+    try:
+        grade = db.query(User.current_grade).filter(User.telegram_id == telegram_id).scalar()
+    finally:
+        db.close()
+    _grade_cache[telegram_id] = (now, grade)
+    return grade
+
+
+def forget_user_grade(telegram_id):
+    """Drop the memoised grade after the user's grade changes"""
+    _grade_cache.pop(telegram_id, None)
+
+
 def is_content_locked(telegram_id: int, action: str, screen: str, param: str) -> tuple[bool, str]:
     """
     Check if the requested content is locked.
@@ -21,54 +124,26 @@ def is_content_locked(telegram_id: int, action: str, screen: str, param: str) ->
     # Note: We check locks for everyone. If locked and user is Admin, 
     # we return False (Allow) but with a specific reason string.
 
-    db = SessionLocal()
     try:
         # --- FEATURE LOCKS ---
-        feature_map = {
-            # Advanced Practice Screens
-            "SCR_GAMEMODE": "ADVANCED_PRACTICE",
-            "SCR_SPEEDRUN_SETUP": "ADVANCED_PRACTICE",
-            "SCR_SPEEDRUN_SUBJECTS": "ADVANCED_PRACTICE",
-            "SCR_SPEEDRUN_COUNTS": "ADVANCED_PRACTICE",
-            "SCR_SURVIVAL_SETUP": "ADVANCED_PRACTICE",
-            "SCR_GAME_PRES": "ADVANCED_PRACTICE",
-            
-            # Review Hub
-            "SCR_REVIEW_HUB": "REVIEW_HUB",
-            
-            # PDF Vault
-            "SCR_PDF_VAULT": "PDFS_AND_FILES",
-            
-            # Leaderboard
-            "SCR_RANKING": "LEADERBOARD",
-            
-            # Multiplayer
-            "SCR_MULTIPLAYER_HUB": "PRACTICE_WITH_FRIENDS",
-            "SCR_MP_SUBJ_SELECT": "PRACTICE_WITH_FRIENDS",
-            "SCR_INVITES": "PRACTICE_WITH_FRIENDS",
-            
-            # AI Tutor (if screen exists, or general feature check)
-            "SCR_AI_CHAT": "AI_TUTOR"
-        }
+        target_feature = _FEATURE_MAP.get(screen)
         
-        target_feature = feature_map.get(screen)
+        # The param is normalised and split once; every check below reuses these
+        param_str = str(param) if param else ""
+        param_upper = param_str.upper()
+        parts = _DELIM_RE.split(param_str) if param_str else []
         
         # Also check ACT params that imply features
         if action == "ACT":
-             if param and "SPEEDRUN" in param: target_feature = "ADVANCED_PRACTICE"
-             if param and "SURVIVAL" in param: target_feature = "ADVANCED_PRACTICE"
-             if param and "MP" in param: target_feature = "PRACTICE_WITH_FRIENDS"
+             if "SPEEDRUN" in param_str: target_feature = "ADVANCED_PRACTICE"
+             if "SURVIVAL" in param_str: target_feature = "ADVANCED_PRACTICE"
+             if "MP" in param_str: target_feature = "PRACTICE_WITH_FRIENDS"
 
+        # Candidate locks are collected first and checked together at the end:
+        # [((lock_type, lock_target), message)] in precedence order (feature > subject > unit)
+        candidates = []
         if target_feature:
-            lock = db.query(SystemLock).filter(
-                SystemLock.lock_type == "FEATURE", 
-                SystemLock.lock_target == target_feature,
-                SystemLock.is_locked == True
-            ).first()
-            if lock:
-                msg = f"{target_feature.replace('_', ' ').title()} is currently locked."
-                if telegram_id in ADMIN_IDS: return False, f"🛡️ LOCKED (Admin Bypass): {msg}"
-                return True, f"🔒 {msg}"
+            candidates.append((("FEATURE", target_feature), f"{target_feature.replace('_', ' ').title()} is currently locked."))
 
         # --- GRADE LOCKS ---
         # Infer grade from param
@@ -76,33 +151,35 @@ def is_content_locked(telegram_id: int, action: str, screen: str, param: str) ->
         grade_str = None
         
         # Try to extract grade
-        if param:
+        if param_str:
             # 1. Direct digit (e.g., "9")
-            if str(param).isdigit() and int(param) in [9,10,11,12]:
-                grade_str = str(param)
+            if param_str.isdigit() and int(param_str) in _VALID_GRADES:
+                grade_str = param_str
             # 2. Key-Value style or delimited (e.g., "BIO:9" or "START_RANDOM|10")
             else:
-                # Try splitting by common delimiters
-                parts = str(param).replace("|", ":").split(":")
                 for p in parts:
                     clean_p = p.replace("Grade", "").replace("G", "").strip()
-                    if clean_p.isdigit() and int(clean_p) in [9,10,11,12]:
+                    if clean_p.isdigit() and int(clean_p) in _VALID_GRADES:
                         grade_str = clean_p
                         break
 
+        # --- SUBJECT LOCKS ---
+        target_subject_code = None
+        
+        if param_upper:
+            for code in _SUBJ_CODES:
+                if code in param_upper:
+                   target_subject_code = code
+                   break
+        
         # --- GRADE INFERENCE FALLBACK ---
-        # If no grade in param, checking content screens requires User's Grade
-        if not grade_str:
-             content_screens = [
-                 "SCR_UNITS", "SCR_QUIZ_PRES", "SCR_TOPIC_SELECTION", "SCR_UNIT_START", 
-                 "SCR_REVIEW_HUB", "SCR_SPEEDRUN_SUBJECTS", "SCR_SURVIVAL_SETUP", 
-                 "SCR_PDF_VAULT", "SCR_RANDOM_SETUP"
-             ]
-             if screen in content_screens or (action == "ACT" and ("QUIZ" in param or "SPEEDRUN" in param or "SURVIVAL" in param)):
-                 # Fetch user to get current grade
-                 u_obj = db.query(User).filter(User.id == telegram_id).first()
-                 if u_obj and u_obj.current_grade:
-                     grade_str = str(u_obj.current_grade)
+        # If no grade in param, checking content screens requires User's Grade.
+        # The grade only feeds the subject lock, so the user is looked up only once a subject matched.
+        if target_subject_code and not grade_str:
+             if screen in _CONTENT_SCREENS or (action == "ACT" and ("QUIZ" in param_str or "SPEEDRUN" in param_str or "SURVIVAL" in param_str)):
+                 user_grade = _get_user_grade(telegram_id)
+                 if user_grade:
+                     grade_str = str(user_grade)
 
         # Check for Grade Lock (implicit or explicit)
         # Note: Grade-level locks are deprecated per user request. 
@@ -111,32 +188,13 @@ def is_content_locked(telegram_id: int, action: str, screen: str, param: str) ->
         if grade_str:
             target_grade = int(grade_str)
 
-        # --- SUBJECT LOCKS ---
-        subj_map = {"BIO": "Biology", "CHEM": "Chemistry", "PHYS": "Physics", "MATH": "Mathematics"}
-        target_subject_code = None
-        
-        if param:
-            upper_p = str(param).upper()
-            for code in subj_map:
-                if code in upper_p:
-                   target_subject_code = code
-                   break
-        
         if target_subject_code:
-            subj_name = subj_map[target_subject_code]
+            subj_name = _SUBJ_MAP[target_subject_code]
             
             # Check Grade-Specific lock
             if target_grade:
                 specific_target = f"{subj_name}:{target_grade}"
-                lock = db.query(SystemLock).filter(
-                    SystemLock.lock_type == "SUBJECT", 
-                    SystemLock.lock_target == specific_target,
-                    SystemLock.is_locked == True
-                ).first()
-                if lock:
-                    msg = f"{subj_name} for Grade {target_grade} is locked."
-                    if telegram_id in ADMIN_IDS: return False, f"🛡️ LOCKED (Admin Bypass): {msg}"
-                    return True, f"🔒 {msg}"
+                candidates.append((("SUBJECT", specific_target), f"{subj_name} for Grade {target_grade} is locked."))
             
             # Global Subject Locks are deprecated in favor of Grade-Specific locks.
             # We skip the global check to avoid 'hidden' locks that can't be toggled in the new UI.
@@ -144,25 +202,20 @@ def is_content_locked(telegram_id: int, action: str, screen: str, param: str) ->
         # --- UNIT LOCKS ---
         potential_ids = []
         # Support detection in QUIZ, FILE, and GAME actions
-        if screen in ["SCR_QUIZ_PRES", "SCR_PDF_VAULT", "SCR_GAME_PRES"] or (action == "ACT" and ("QUIZ" in param or "FILE" in param or "SPEEDRUN" in param)):
-            if param:
+        if screen in _UNIT_SCREENS or (action == "ACT" and ("QUIZ" in param_str or "FILE" in param_str or "SPEEDRUN" in param_str)):
+            if param_str:
                # Try to find unit ID pattern CODE_G#_U#
-               import re
-               matches = re.findall(r'([A-Z]+)_G([0-9]+)_U([0-9]+)', str(param))
-               if matches:
-                   for m in matches:
-                       potential_ids.append(f"{m[0]}_G{m[1]}_U{m[2]}")
+               potential_ids.extend(_find_unit_ids(param_str))
                
                # Fallback to delimited parsing
-               if not potential_ids and (":" in str(param) or "|" in str(param)):
-                  parts = str(param).replace("|", ":").split(":") 
+               if not potential_ids and len(parts) > 1:
                   try:
                       s_code = None
                       g_code = None
                       u_code = None
                       for p in parts:
                           p = p.strip()
-                          if p in subj_map: s_code = p
+                          if p in _SUBJ_MAP: s_code = p
                           elif "G" in p or "Grad" in p: 
                               g_code = p.replace("Grade", "").replace("G", "").strip()
                           elif "U" in p or "init" in p:
@@ -172,20 +225,18 @@ def is_content_locked(telegram_id: int, action: str, screen: str, param: str) ->
                           potential_ids.append(unit_id)
                   except: pass
 
-        if potential_ids:
-            locks = db.query(SystemLock).filter(
-                SystemLock.lock_type == "UNIT",
-                SystemLock.lock_target.in_(potential_ids),
-                SystemLock.is_locked == True
-            ).all()
-            if locks:
-                msg = f"This unit is currently locked."
-                if telegram_id in ADMIN_IDS: return False, f"🛡️ LOCKED (Admin Bypass): {msg}"
-                return True, f"🔒 {msg}"
+        for unit_id in potential_ids:
+            candidates.append((("UNIT", unit_id), "This unit is currently locked."))
+
+        if candidates:
+            # Active locks come from the process-wide TTL cache (reset by the admin lock toggles)
+            active = get_active_locks()
+            for (lock_type, target), msg in candidates:
+                if target in active.get(lock_type, ()):
+                    if telegram_id in ADMIN_IDS: return False, f"🛡️ LOCKED (Admin Bypass): {msg}"
+                    return True, f"🔒 {msg}"
                 
         return False, ""
     except Exception as e:
         print(f"[LOCK ERROR] {e}")
         return False, ""
-    finally:
-        db.close()
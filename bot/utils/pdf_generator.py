@@ -1,48 +1,77 @@
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
 from fpdf import FPDF
 from datetime import datetime
 
+# UTF-8 Support via System Font (Cross-Platform for Render/Windows)
+_FONT_PATHS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", # Render Default
+    "C:\\Windows\\Fonts\\DejaVuSans.ttf", # Windows if installed
+    "C:\\Windows\\Fonts\\arial.ttf", # Windows Fallback
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf", # Linux Fallback
+    os.path.join(os.path.dirname(__file__), "fonts", "DejaVuSans.ttf")
+]
+# Font discovery runs once per process; every PDFGenerator reuses the resolved paths
+_FONT_CACHE = {"target": None, "bold": None, "resolved": False}
+_FONT_LOCK = threading.Lock()
+
+
+def _resolve_fonts():
+    """Return (regular_path, bold_path) of the first available UTF-8 font, or (None, None)"""
+    if not _FONT_CACHE["resolved"]:
+        with _FONT_LOCK:
+            if not _FONT_CACHE["resolved"]:
+                target_font = next((path for path in _FONT_PATHS if os.path.exists(path)), None)
+                bold_font = target_font
+                if target_font:
+                    # Check for bold version
+                    bold_path = target_font.replace(".ttf", "-Bold.ttf").replace("Sans", "Sans-Bold")
+                    if os.path.exists(bold_path):
+                        bold_font = bold_path
+                _FONT_CACHE.update(target=target_font, bold=bold_font, resolved=True)
+    return _FONT_CACHE["target"], _FONT_CACHE["bold"]
+
+
+# Typographic characters outside latin-1, mapped in a single translate() pass
+_LATIN1_TRANS = str.maketrans({
+    '\u201c': '"', '\u201d': '"', '\u2018': "'", '\u2019': "'",
+    '\u2013': '-', '\u2014': '-', '\u2026': '...'
+})
+
+
+# Measured word widths per (font family, style, size), shared by every document in the process
+_WORD_WIDTHS = {}
+
+
 class PDFGenerator(FPDF):
+    # Colors (shared by every document)
+    primary_color = (33, 150, 243)  # Material Blue
+    secondary_color = (25, 118, 210) # Darker Blue
+    text_color = (33, 33, 33)
+    muted_text = (117, 117, 117)
+    white = (255, 255, 255)
+
     def __init__(self, subject, grade, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.subject = subject
         self.grade = grade
         self.set_auto_page_break(auto=True, margin=15)
         
-        # Colors
-        self.primary_color = (33, 150, 243)  # Material Blue
-        self.secondary_color = (25, 118, 210) # Darker Blue
-        self.text_color = (33, 33, 33)
-        self.muted_text = (117, 117, 117)
-        self.white = (255, 255, 255)
-        
-        # UTF-8 Support via System Font (Cross-Platform for Render/Windows)
+        # UTF-8 Support via System Font (paths resolved once, see _resolve_fonts)
         self.unicode_enabled = False
-        font_paths = [
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", # Render Default
-            "C:\\Windows\\Fonts\\DejaVuSans.ttf", # Windows if installed
-            "C:\\Windows\\Fonts\\arial.ttf", # Windows Fallback
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf", # Linux Fallback
-            os.path.join(os.path.dirname(__file__), "fonts", "DejaVuSans.ttf") 
-        ]
-        
-        target_font = None
-        for path in font_paths:
-            if os.path.exists(path):
-                target_font = path
-                break
+        target_font, bold_font = _resolve_fonts()
         
         if target_font:
             try:
-                # fpdf2 does NOT use uni=True, it handles it automatically
+                # fpdf2 does NOT use uni=True, it handles it automatically.
+                # Registered per document: the parsed font carries this document's glyph subset.
                 self.add_font("CustomFont", "", target_font)
-                
-                # Check for bold version
-                bold_path = target_font.replace(".ttf", "-Bold.ttf").replace("Sans", "Sans-Bold")
-                if os.path.exists(bold_path):
-                    self.add_font("CustomFont", "B", bold_path)
-                else:
-                    self.add_font("CustomFont", "B", target_font)
+                self.add_font("CustomFont", "B", bold_font)
 
                 self.font_family = "CustomFont"
                 self.unicode_enabled = True
@@ -57,13 +86,7 @@ class PDFGenerator(FPDF):
         if not text: return "N/A"
         if not self.unicode_enabled:
             # Fallback for latin-1
-            replacements = {
-                '\u201c': '"', '\u201d': '"', '\u2018': "'", '\u2019': "'",
-                '\u2013': '-', '\u2014': '-', '\u2026': '...'
-            }
-            for char, repl in replacements.items():
-                text = text.replace(char, repl)
-            return text.encode('latin-1', 'replace').decode('latin-1')
+            return text.translate(_LATIN1_TRANS).encode('latin-1', 'replace').decode('latin-1')
         return text # Keep as is if Arial loaded
 
     def header(self):
@@ -128,11 +151,110 @@ class PDFGenerator(FPDF):
         self.cell(0, 20, self.sanitize_text(unit_name.upper()), border='B', ln=True, align='C')
         self.ln(10)
 
+    def _wrap(self, text, width):
+        """
+        Greedy word wrap of text to width (mm) in the current font.
+        Widths are measured once per word; returns None if a single word is wider than the line.
+        """
+        widths = _WORD_WIDTHS.setdefault((self.font_family, self.font_style, self.font_size_pt), {})
+
+        def measure(word):
+            w = widths.get(word)
+            if w is None:
+                w = widths[word] = self.get_string_width(word)
+            return w
+
+        space = measure(" ")
+        lines = []
+        for para in text.replace("\r", "").split("\n"):
+            line, line_w = [], 0.0
+            for word in para.split(" "):
+                w = measure(word)
+                if w > width:
+                    return None
+                if line and line_w + space + w > width:
+                    lines.append(" ".join(line))
+                    line, line_w = [word], w
+                else:
+                    line_w += (space if line else 0.0) + w
+                    line.append(word)
+            lines.append(" ".join(line))
+        return lines
+
+    def write_wrapped(self, h, text):
+        """
+        multi_cell(0, h, text) replacement: pre-wrapped lines written with plain cells from the current x.
+        Text with an over-long word goes through multi_cell, which can break inside words.
+        """
+        x = self.get_x()
+        width = self.w - self.r_margin - x
+        lines = self._wrap(text, width - 2 * self.c_margin)
+        if lines is None:
+            self.multi_cell(0, h, text)
+            return
+        for line in lines:
+            self.set_x(x)
+            self.cell(width, h, line, ln=2)
+
+    def _line_count(self, text, width):
+        """Lines write_wrapped would use for text at width (mm) in the current font"""
+        lines = self._wrap(text, width - 2 * self.c_margin)
+        if lines is None:  # multi_cell path: estimate from the full width
+            return int(self.get_string_width(text) // (width - 2 * self.c_margin)) + 1
+        return len(lines)
+
+    def _question_height(self, q):
+        """Height (mm) add_questions_section needs for one question block"""
+        body_w = self.w - self.l_margin - self.r_margin
+        self.set_font(self.default_font, '', 11)
+        height = 8 + 2 + 6 * self._line_count(q["question"], body_w) + 3
+        self.set_font(self.default_font, '', 10)
+        option_w = self.w - self.r_margin - 30  # Options start at x=20 after a 10mm label
+        for val in q["options"].values():
+            height += 6 * self._line_count(val, option_w)
+        return height + 8
+
+    def _answer_height(self, q):
+        """Height (mm) add_answer_key needs for one answer block"""
+        self.set_font(self.default_font, 'I', 10)
+        body_w = self.w - self.l_margin - self.r_margin
+        return 8 + 6 * self._line_count(f'Explanation: {q["explanation"]}', body_w) + 6 + 4
+
+    def _ensure_room(self, height):
+        """Start a new page unless a block of height mm fits on this one (keeps blocks whole)"""
+        # Blocks taller than a page can't be kept whole; let them flow instead of leaving a blank page
+        if self.get_y() + height > self.page_break_trigger and height < self.page_break_trigger - 20:
+            self.add_page()
+
+    def _prep_questions(self, questions):
+        """
+        Sanitize every question's text once per PDF.
+        add_questions_section and add_answer_key share the result for the same list.
+        """
+        cached = getattr(self, "_prepped", None)
+        if cached is not None and cached[0] is questions:
+            return cached[1]
+
+        # With a Unicode font sanitize_text only substitutes "N/A" for empty text
+        sanitize = (lambda x: x or "N/A") if self.unicode_enabled else self.sanitize_text
+        prepared = [
+            {
+                "question": sanitize(q.get("question", q.get("question_stem", "N/A"))),
+                "options": {opt: sanitize(str(val)) for opt, val in q.get("options", {}).items()},
+                "explanation": sanitize(q.get("explanation", "No explanation available for this item.")),
+                "correct_answer": q.get("correct_answer", "N/A"),
+            }
+            for q in questions
+        ]
+        self._prepped = (questions, prepared)
+        return prepared
+
     def add_questions_section(self, questions):
         self.set_font(self.default_font, '', 11)
         self.set_text_color(*self.text_color)
         
-        for i, q in enumerate(questions):
+        for i, q in enumerate(self._prep_questions(questions)):
+            self._ensure_room(self._question_height(q))
             # Question Box
             self.set_font(self.default_font, 'B', 11)
             self.set_fill_color(245, 245, 245)
@@ -140,20 +262,17 @@ class PDFGenerator(FPDF):
             
             self.set_font(self.default_font, '', 11)
             self.ln(2)
-            self.multi_cell(0, 6, self.sanitize_text(q.get("question", q.get("question_stem", "N/A"))))
+            self.write_wrapped(6, q["question"])
             self.ln(3)
             
-            options = q.get("options", {})
-            for opt, val in options.items():
+            for opt, val in q["options"].items():
                 self.set_x(20)
                 self.set_font(self.default_font, 'B', 10)
                 self.cell(10, 6, f'{opt}: ', ln=False)
                 self.set_font(self.default_font, '', 10)
-                self.multi_cell(0, 6, self.sanitize_text(str(val)))
+                self.write_wrapped(6, val)
             
             self.ln(8)
-            if self.get_y() > 250:
-                self.add_page()
 
     def add_answer_key(self, questions):
         self.add_page()
@@ -162,36 +281,121 @@ class PDFGenerator(FPDF):
         self.cell(0, 15, 'ANSWER KEY & DETAILED EXPLANATIONS', border='B', ln=True, align='C')
         self.ln(10)
         
-        for i, q in enumerate(questions):
+        for i, q in enumerate(self._prep_questions(questions)):
+            self._ensure_room(self._answer_height(q))
             self.set_font(self.default_font, 'B', 12)
             self.set_text_color(*self.secondary_color)
-            self.cell(0, 8, f'Question {i+1}: Correct Answer [{q.get("correct_answer", "N/A")}]', ln=True)
+            self.cell(0, 8, f'Question {i+1}: Correct Answer [{q["correct_answer"]}]', ln=True)
             
             self.set_font(self.default_font, 'I', 10)
             self.set_text_color(*self.muted_text)
-            explanation = q.get("explanation", "No explanation available for this item.")
-            self.multi_cell(0, 6, f'Explanation: {self.sanitize_text(explanation)}')
+            self.write_wrapped(6, f'Explanation: {q["explanation"]}')
             self.ln(6)
             self.set_draw_color(230, 230, 230)
             self.line(self.get_x(), self.get_y(), self.get_x() + 190, self.get_y())
             self.ln(4)
-            
-            if self.get_y() > 250:
-                self.add_page()
 
 # Caching directory
 CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "pdfs")
 os.makedirs(CACHE_DIR, exist_ok=True)
 
+def _fast_copy(src, dst):
+    """
+    Copy a cached PDF without pushing its bytes through Python.
+    Hardlinks when src and dst share a filesystem, otherwise falls back to a kernel-side sendfile copy.
+    """
+    # Replace rather than truncate: an existing dst may already be a link to the cached file
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    if not hasattr(os, "sendfile"):  # Windows
+        shutil.copyfile(src, dst)
+        return
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        size = os.fstat(s.fileno()).st_size
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(d.fileno(), s.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
+# Hot cached PDFs kept in memory so repeat downloads skip the filesystem.
+# Cache paths embed a content hash, so an entry never goes stale while its file exists.
+PDF_MEMORY_CACHE_MAX = 16
+_PDF_BYTES = OrderedDict()  # {cache path: bytes}, least recently used first
+_PDF_BYTES_LOCK = threading.Lock()
+
+def load_cached_pdf(path):
+    """Return the bytes of a cached PDF (memory first, then disk), or None if it isn't cached yet"""
+    with _PDF_BYTES_LOCK:
+        data = _PDF_BYTES.get(path)
+        if data is not None:
+            _PDF_BYTES.move_to_end(path)
+            return data
+
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    with _PDF_BYTES_LOCK:
+        _PDF_BYTES[path] = data
+        _PDF_BYTES.move_to_end(path)
+        while len(_PDF_BYTES) > PDF_MEMORY_CACHE_MAX:
+            _PDF_BYTES.popitem(last=False)
+    return data
+
+# Question fields that end up in a PDF; handler-injected keys (_display, source_unit, ...) stay out of the key
+_HASHED_FIELDS = ("question_id", "question", "question_stem", "options", "correct_answer", "explanation")
+
+def _questions_hash(questions):
+    """Short content hash of a question list; any edit to the printed fields yields a new cache key"""
+    content = [[q.get(k) for k in _HASHED_FIELDS] for q in questions]
+    payload = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=8).hexdigest()
+
+def unit_pdf_cache_path(subject, grade, unit_name, questions):
+    """Cache file for a single-unit guide, keyed on its inputs and question content"""
+    cache_key = f"{subject}_{grade}_{unit_name}".replace(" ", "_").replace(":", "_")
+    return os.path.join(CACHE_DIR, f"{cache_key}_{_questions_hash(questions)}.pdf")
+
+def all_units_pdf_cache_path(subject, grade, unit_data_list):
+    """Cache file for a comprehensive guide; the key combines the per-unit content hashes"""
+    h = hashlib.blake2b(digest_size=8)
+    for unit_title, questions in unit_data_list:
+        h.update(f"{unit_title}\0{_questions_hash(questions)}\0".encode("utf-8"))
+    cache_key = f"COMPREHENSIVE_{subject}_{grade}_{len(unit_data_list)}".replace(" ", "_")
+    return os.path.join(CACHE_DIR, f"{cache_key}_{h.hexdigest()}.pdf")
+
+def _write_pdf(pdf, output_path):
+    """
+    Renders pdf to a temp file next to output_path and moves it into place.
+    output_path may be a hardlink to a cache entry (see _fast_copy); writing it in place would truncate the cached PDF.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(os.path.abspath(output_path)))
+    os.close(fd)
+    try:
+        pdf.output(tmp_path)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 def generate_unit_pdf(subject, grade, unit_name, questions, output_path):
     # Check Cache first
-    cache_key = f"{subject}_{grade}_{unit_name}".replace(" ", "_").replace(":", "_")
-    cached_file = os.path.join(CACHE_DIR, f"{cache_key}.pdf")
+    cached_file = unit_pdf_cache_path(subject, grade, unit_name, questions)
     
     if os.path.exists(cached_file):
         print(f"[PDF CACHE] Using cached file: {cached_file}")
-        import shutil
-        shutil.copy(cached_file, output_path)
+        _fast_copy(cached_file, output_path)
         return output_path
 
     pdf = PDFGenerator(subject, grade)
@@ -199,21 +403,18 @@ def generate_unit_pdf(subject, grade, unit_name, questions, output_path):
     pdf.add_page() # Content Page
     pdf.add_questions_section(questions)
     pdf.add_answer_key(questions)
-    pdf.output(output_path)
+    _write_pdf(pdf, output_path)
     
     # Save to Cache
-    import shutil
-    shutil.copy(output_path, cached_file)
+    _fast_copy(output_path, cached_file)
     return output_path
 
 def generate_all_units_pdf(subject, grade, unit_data_list, output_path):
     # Cache for "Comprehensive" guides
-    cache_key = f"COMPREHENSIVE_{subject}_{grade}_{len(unit_data_list)}".replace(" ", "_")
-    cached_file = os.path.join(CACHE_DIR, f"{cache_key}.pdf")
+    cached_file = all_units_pdf_cache_path(subject, grade, unit_data_list)
 
     if os.path.exists(cached_file):
-        import shutil
-        shutil.copy(cached_file, output_path)
+        _fast_copy(cached_file, output_path)
         return output_path
 
     pdf = PDFGenerator(subject, grade)
@@ -232,9 +433,8 @@ def generate_all_units_pdf(subject, grade, unit_data_list, output_path):
         pdf.cell(0, 10, f"Unit: {unit_title}", ln=True)
         pdf.add_answer_key(questions)
         
-    pdf.output(output_path)
+    _write_pdf(pdf, output_path)
     
     # Save to Cache
-    import shutil
-    shutil.copy(output_path, cached_file)
+    _fast_copy(output_path, cached_file)
     return output_path
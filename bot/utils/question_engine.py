@@ -1,11 +1,20 @@
+import mmap
 import os
-import json
 import sys
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional, Tuple
 
 # Add parent directory to path to reach config
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import DATA_DIR
+from .json_codec import loads as _loads, orjson
+
+# R-files above this size are parsed straight from a read-only mmap (orjson only)
+MMAP_MIN_SIZE = 64 * 1024
+
+# {question_id: (subject, grade, unit)} - built lazily by QuestionEngine.question_index()
+_QUESTION_INDEX = None
 
 class QuestionEngine:
     """
@@ -42,38 +51,112 @@ class QuestionEngine:
     def load_unit_questions(subject: str, grade: str, unit: str) -> Tuple[List[Dict], Dict, str]:
         """
         Loads ALL available questions for a unit (aggregating R1, R2, R3...).
+        Parsed once per version of the unit's files: callers get a fresh list but share the question dicts,
+        so per-session fields (e.g. source_unit) must be set on copies.
+        """
+        questions, final_state, unit_title = QuestionEngine._read_unit_questions(subject, grade, unit)
+        return list(questions), final_state, unit_title
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def _read_json_cached(path: str, mtime_ns: int) -> Optional[Dict]:
+        """
+        Parses one R-file, memoised per (path, mtime).
+        load_batch reads through it directly; when a unit's file signature changes, _parse_unit
+        only re-parses the rounds whose mtime moved.
+        Returns None for blank files. The result is shared - callers must not mutate it.
+        """
+        with open(path, 'rb') as f:
+            if orjson is not None and os.fstat(f.fileno()).st_size > MMAP_MIN_SIZE:
+                # Parse from the page cache without first copying the file into a bytes object
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    return orjson.loads(view)
+            content = f.read().strip()
+        if not content:
+            return None
+        return _loads(content)
+
+    @staticmethod
+    def _unit_files(subject: str, grade: str, unit: str) -> Tuple[Tuple[str, int, int], ...]:
+        """
+        (path, size, mtime_ns) of a unit's R-files in round order, stopping at the first missing round.
+        One directory listing instead of probing each round with os.path.exists.
+        """
+        unit_dir = os.path.dirname(QuestionEngine.resolve_path(subject, grade, unit, 1))
+        try:
+            with os.scandir(unit_dir) as it:
+                entries = {e.name: e for e in it}
+        except OSError:
+            return ()
+
+        files = []
+        # Rounds 1 to 10 (reasonable limit)
+        for r in range(1, 11):
+            entry = entries.get(f"R{r}.json")
+            if entry is None:
+                break
+            st = entry.stat()
+            files.append((entry.path, st.st_size, st.st_mtime_ns))
+        return tuple(files)
+
+    @staticmethod
+    def _read_unit_questions(subject: str, grade: str, unit: str) -> Tuple[Tuple[Dict, ...], Dict, str]:
+        """
+        Reads and parses every R-file of a unit.
+        Cached per file signature, so an edited, added or removed round is picked up on the next call.
         """
+        return QuestionEngine._parse_unit(unit, QuestionEngine._unit_files(subject, grade, unit))[:3]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def _parse_unit(unit: str, files: Tuple[Tuple[str, int, int], ...]) -> Tuple[Tuple[Dict, ...], Dict, str, Dict[str, Dict]]:
+        """Aggregates a unit's R-files into (questions, state, unit title, {question_id: question})."""
         all_questions = []
         final_state = {}
         unit_title = unit
         
-        # Loop through rounds 1 to 10 (reasonable limit)
-        for r in range(1, 11):
-            path = QuestionEngine.resolve_path(subject, grade, unit, r)
-            if not os.path.exists(path):
-                break
-                
-            if os.path.getsize(path) == 0:
+        for path, size, mtime_ns in files:
+            if size == 0:
                 print(f"[ENGINE] Skipping empty file: {path}")
                 continue
                 
             try:
-                with open(path, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                    if not content:
-                        continue
-                    data = json.loads(content)
-                    batch_questions = data.get("questions", [])
-                    all_questions.extend(batch_questions)
-                    if data.get("unit"):
-                        unit_title = data.get("unit")
-                    if not final_state:
-                        final_state = data.get("__STATE__", {})
+                data = QuestionEngine._read_json_cached(path, mtime_ns)
+                if data is None:
+                    continue
+                batch_questions = data.get("questions", [])
+                all_questions.extend(batch_questions)
+                if data.get("unit"):
+                    unit_title = data.get("unit")
+                if not final_state:
+                    final_state = data.get("__STATE__", {})
             except Exception as e:
                 print(f"Error loading questions from {path}: {e}")
                 continue # Try next round instead of breaking
         
-        return all_questions, final_state, unit_title
+        # First occurrence of an id wins
+        by_id = {}
+        for q in all_questions:
+            qid = q.get("question_id")
+            if qid:
+                by_id.setdefault(qid, q)
+        return tuple(all_questions), final_state, unit_title, by_id
+
+    @staticmethod
+    def load_units_questions(subject: str, grade: str, units: List[str]) -> List[Tuple[List[Dict], Dict, str]]:
+        """
+        load_unit_questions for several units, in the given order.
+        Larger sets are read on a small thread pool, since cold units are file-I/O bound.
+        """
+        if len(units) < 4:
+            return [QuestionEngine.load_unit_questions(subject, grade, u) for u in units]
+        with ThreadPoolExecutor(max_workers=min(8, len(units))) as pool:
+            return list(pool.map(lambda u: QuestionEngine.load_unit_questions(subject, grade, u), units))
+
+    @staticmethod
+    def unit_size(subject: str, grade: str, unit: str) -> int:
+        """Number of questions in a unit (served from the parsed-unit cache while its files are unchanged)."""
+        return len(QuestionEngine._read_unit_questions(subject, grade, unit)[0])
 
     @staticmethod
     def load_batch(subject: str, grade: str, unit: str, round_num: int) -> Tuple[Optional[List[Dict]], Optional[Dict], Optional[str]]:
@@ -83,13 +166,15 @@ class QuestionEngine:
         """
         path = QuestionEngine.resolve_path(subject, grade, unit, round_num)
         
-        if not os.path.exists(path):
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
             return None, None, None
             
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get("questions", []), data.get("__STATE__", {}), data.get("unit")
+            data = QuestionEngine._read_json_cached(path, mtime_ns)
+            # Fresh list over the shared (cached) question dicts
+            return list(data.get("questions", [])), data.get("__STATE__", {}), data.get("unit")
         except Exception as e:
             print(f"Error loading questions from {path}: {e}")
             return None, None, None
@@ -108,6 +193,14 @@ class QuestionEngine:
             "total_questions": state.get("last_question_id", "").split("_Q")[-1] if "last_question_id" in state else 0
         }
 
+    @staticmethod
+    def _dir_mtime(path: str) -> Optional[int]:
+        """Directory mtime in ns (None if missing); keys the listing caches so new folders show up."""
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
     @staticmethod
     def list_grades(subject: str) -> List[str]:
         """
@@ -115,13 +208,17 @@ class QuestionEngine:
         Returns: ["Grade 9", "Grade 10", ...]
         """
         subject_dir = os.path.join(QuestionEngine.BASE_DATA_DIR, subject)
-        if not os.path.exists(subject_dir):
+        mtime = QuestionEngine._dir_mtime(subject_dir)
+        if mtime is None:
             return []
-            
-        grades = []
-        for d in os.listdir(subject_dir):
-            if d.startswith("Grade_") and os.path.isdir(os.path.join(subject_dir, d)):
-                grades.append(d.replace("_", " "))
+        return list(QuestionEngine._scan_grades(subject_dir, mtime))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _scan_grades(subject_dir: str, mtime_ns: int) -> Tuple[str, ...]:
+        """Directory scan behind list_grades (cached per directory mtime)."""
+        with os.scandir(subject_dir) as it:
+            grades = [e.name.replace("_", " ") for e in it if e.name.startswith("Grade_") and e.is_dir()]
         
         # Sort Grade 12 down to Grade 9
         def sort_key(s):
@@ -129,7 +226,7 @@ class QuestionEngine:
             return int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
 
         grades.sort(key=sort_key, reverse=True)
-        return grades
+        return tuple(grades)
 
     @staticmethod
     def list_units(subject: str, grade: str) -> List[str]:
@@ -139,13 +236,17 @@ class QuestionEngine:
         """
         fs_grade = grade.replace(" ", "_")
         grade_dir = os.path.join(QuestionEngine.BASE_DATA_DIR, subject, fs_grade)
-        if not os.path.exists(grade_dir):
+        mtime = QuestionEngine._dir_mtime(grade_dir)
+        if mtime is None:
             return []
-            
-        units = []
-        for d in os.listdir(grade_dir):
-            if d.startswith("Unit_") and os.path.isdir(os.path.join(grade_dir, d)):
-                units.append(d.replace("_", " "))
+        return list(QuestionEngine._scan_units(grade_dir, mtime))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def _scan_units(grade_dir: str, mtime_ns: int) -> Tuple[str, ...]:
+        """Directory scan behind list_units (cached per directory mtime)."""
+        with os.scandir(grade_dir) as it:
+            units = [e.name.replace("_", " ") for e in it if e.name.startswith("Unit_") and e.is_dir()]
         
         # Sort Unit 1, Unit 2...
         def sort_key(s):
@@ -153,23 +254,28 @@ class QuestionEngine:
             return int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
 
         units.sort(key=sort_key)
-        return units
+        return tuple(units)
 
     @staticmethod
-    def find_question_by_id(question_id: str) -> Optional[Dict]:
+    def _locate_unit(question_id: str) -> Optional[Tuple[str, str, str]]:
         """
-        Locates a question across all subjects/grades/units based on its ID.
+        Maps a question ID to its (subject, grade, unit) folder labels.
         Format: G9_Bio_U1_Q001
         """
         parts = question_id.split("_")
         if len(parts) < 4: return None
         
-        grade_str = parts[0].replace("G", "Grade ")
-        subj_code = parts[1] # Bio, Chem, Phys, Math
+        grade_num = "".join(ch for ch in parts[0] if ch.isdigit()) # G9 (a few files use B12)
+        if not grade_num: return None
+        grade_str = f"Grade {grade_num}"
+        subj_code = parts[1] # Bio, Chem, Phys, Math (Physics files also use Phy/Physics)
         unit_num = parts[2].replace("U", "") # 1
         unit_str = f"Unit {unit_num}"
         
-        subj_map = {"Bio": "Biology", "Chem": "Chemistry", "Phys": "Physics", "Math": "Mathematics"}
+        subj_map = {
+            "Bio": "Biology", "Chem": "Chemistry", "Phys": "Physics", "Math": "Mathematics",
+            "Phy": "Physics", "Physics": "Physics"
+        }
         subject = subj_map.get(subj_code)
         if not subject: return None
 
@@ -177,9 +283,79 @@ class QuestionEngine:
         target_unit = next((u for u in units if u.startswith(unit_str)), None)
         
         if not target_unit: return None
+        return subject, grade_str, target_unit
+
+    @staticmethod
+    def _unit_question_map(subject: str, grade: str, unit: str) -> Dict[str, Dict]:
+        """{question_id: question} for one unit, built alongside the parsed unit (first occurrence wins)."""
+        return QuestionEngine._parse_unit(unit, QuestionEngine._unit_files(subject, grade, unit))[3]
 
-        questions, _, _ = QuestionEngine.load_unit_questions(subject, grade_str, target_unit)
-        for q in questions:
-            if q.get("question_id") == question_id:
+    @staticmethod
+    def find_question_by_id(question_id: str) -> Optional[Dict]:
+        """
+        Locates a question across all subjects/grades/units based on its ID.
+        Format: G9_Bio_U1_Q001
+        The ID names its unit; IDs that don't parse or have moved fall back to the global question index.
+        """
+        location = QuestionEngine._locate_unit(question_id)
+        if location:
+            q = QuestionEngine._unit_question_map(*location).get(question_id)
+            if q is not None:
                 return q
-        return None
+
+        location = QuestionEngine.question_index().get(question_id)
+        if not location: return None
+        return QuestionEngine._unit_question_map(*location).get(question_id)
+
+    @staticmethod
+    def load_questions_by_ids(question_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Loads several questions by ID, reading each referenced unit only once.
+        Returns {question_id: question}; unknown IDs are left out.
+        """
+        found = {}
+        unit_maps = {}
+        for qid in question_ids:
+            location = QuestionEngine._locate_unit(qid)
+            if location:
+                if location not in unit_maps:
+                    unit_maps[location] = QuestionEngine._unit_question_map(*location)
+                q = unit_maps[location].get(qid)
+                if q is not None:
+                    found[qid] = q
+        return found
+
+    @staticmethod
+    def question_index() -> Dict[str, Tuple[str, str, str]]:
+        """
+        Maps every question ID to the (subject, grade, unit) labels that contain it.
+        Built on first use by scanning all units, then kept for the process lifetime.
+        """
+        global _QUESTION_INDEX
+        if _QUESTION_INDEX is None:
+            index = {}
+            base = QuestionEngine.BASE_DATA_DIR
+            subjects = sorted(d for d in os.listdir(base) if os.path.isdir(os.path.join(base, d))) if os.path.exists(base) else []
+            for subject in subjects:
+                for grade in QuestionEngine.list_grades(subject):
+                    for unit in QuestionEngine.list_units(subject, grade):
+                        questions, _, _ = QuestionEngine.load_unit_questions(subject, grade, unit)
+                        for q in questions:
+                            qid = q.get("question_id")
+                            if qid:
+                                index.setdefault(qid, (subject, grade, unit))
+            _QUESTION_INDEX = index
+        return _QUESTION_INDEX
+
+    @staticmethod
+    def clear_caches():
+        """
+        Drops cached grade/unit lists, parsed units and the question index (data files changed).
+        Called by the admin /reload command and when a game pool sees newer data files.
+        """
+        global _QUESTION_INDEX
+        QuestionEngine._scan_grades.cache_clear()
+        QuestionEngine._parse_unit.cache_clear()
+        QuestionEngine._read_json_cached.cache_clear()
+        QuestionEngine._scan_units.cache_clear()
+        _QUESTION_INDEX = None